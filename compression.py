@@ -0,0 +1,135 @@
+"""
+Algae ~ Automated Target Positioning System
+Electromagnetic Imaging Lab, University of Manitoba
+
+Streaming compression of the .json output, see out.compression.
+
+Files are written as a series of gzip members or zstd frames, a new one
+is started each time the scan journals a unit, so the file can be cut at
+any journaled offset and appended to when a scan is resumed. Both formats
+allow concatenated members, use open_text() to read any output file.
+
+zstd requires the zstandard package.
+
+Author: Noah Stieler, 2023
+"""
+
+import gzip
+import io
+import time
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+EXTENSIONS = {'gzip': '.gz', 'zstd': '.zst'}
+OPTIONS = ('None', 'gzip 1', 'gzip 6', 'zstd 3', 'zstd 9')
+
+# Bytes before and after compression, and seconds of CPU time spent
+# compressing, summed over every file written by this process
+stats = {'bytes_in': 0, 'bytes_out': 0, 'cpu_time': 0.0}
+
+
+def parse_option(option: str) -> tuple:
+    """Returns (method, level) of one of OPTIONS, method is None for no compression."""
+    if option == 'None':
+        return None, 0
+    method, level = option.split()
+    return method, int(level)
+
+
+def check_available(method: str) -> None:
+    if method == 'zstd' and zstandard is None:
+        raise ImportError('zstd compression requires the zstandard package.')
+
+
+class CompressedWriter:
+    def __init__(self, file, method: str, level: int):
+        """Compresses text written to file, an open binary file."""
+        check_available(method)
+        self.file = file
+        self.method = method
+        self.level = level
+        self._compressor = None
+
+    @property
+    def closed(self) -> bool:
+        return self.file.closed
+
+    def write(self, text: str) -> None:
+        if self._compressor is None:
+            self._compressor = self._new_compressor()
+        data = text.encode('utf-8')
+        time_start = time.thread_time()
+        compressed = self._compressor.compress(data)
+        stats['cpu_time'] += time.thread_time() - time_start
+        stats['bytes_in'] += len(data)
+        self._write_raw(compressed)
+
+    def end_member(self) -> None:
+        """Ends the current member, the file is complete up to tell()."""
+        if self._compressor is None:
+            return
+        time_start = time.thread_time()
+        if self.method == 'gzip':
+            compressed = self._compressor.flush(zlib.Z_FINISH)
+        else:
+            compressed = self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_FINISH)
+        stats['cpu_time'] += time.thread_time() - time_start
+        self._write_raw(compressed)
+        self._compressor = None
+
+    def flush(self) -> None:
+        """Writes out everything compressed so far, without ending the member."""
+        if self._compressor is not None:
+            if self.method == 'gzip':
+                self._write_raw(self._compressor.flush(zlib.Z_SYNC_FLUSH))
+            else:
+                self._write_raw(self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK))
+        self.file.flush()
+
+    def fileno(self) -> int:
+        return self.file.fileno()
+
+    def tell(self) -> int:
+        return self.file.tell()
+
+    def close(self) -> None:
+        self.end_member()
+        self.file.close()
+
+    def _new_compressor(self):
+        if self.method == 'gzip':
+            return zlib.compressobj(self.level, zlib.DEFLATED, 31)  # 31 writes a gzip header
+        return zstandard.ZstdCompressor(level=self.level).compressobj()
+
+    def _write_raw(self, data: bytes) -> None:
+        stats['bytes_out'] += len(data)
+        self.file.write(data)
+
+
+def open_text(path: str):
+    """Opens an output file for reading as text, decompressing it if
+    it ends in one of EXTENSIONS."""
+    if path.endswith(EXTENSIONS['gzip']):
+        return gzip.open(path, 'rt', encoding='utf-8')
+    if path.endswith(EXTENSIONS['zstd']):
+        check_available('zstd')
+        reader = zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), read_across_frames=True,
+                                                           closefd=True)
+        return io.TextIOWrapper(reader, encoding='utf-8')
+    return open(path, 'r', encoding='utf-8')
+
+
+def summary() -> str:
+    """Returns the compression ratio and CPU time since reset()."""
+    if stats['bytes_out'] == 0:
+        return 'No compressed output.'
+    return f'compressed {stats["bytes_in"] / stats["bytes_out"]:.1f}x ' \
+           f'in {stats["cpu_time"]:.1f} s CPU'
+
+
+def reset() -> None:
+    stats.update(bytes_in=0, bytes_out=0, cpu_time=0.0)
@@ -0,0 +1,243 @@
+"""
+Algae ~ Automated Target Positioning System
+Electromagnetic Imaging Lab, University of Manitoba
+
+Converts the output of a run into one chunks dataset, 'data.zarr'
+in the run directory, see dataset.py.
+
+    python consolidate.py <run directory> [--workers N] [--force]
+
+Works on device0 'pos<n>/<S>.json' trees, plain or compressed, and
+device1 'output_<n>.s24p' files, or their binary '.s24p.npy' alone.
+Each position is converted by a process of a pool, which writes its
+chunks directly, so the conversion scales with the number of cores.
+No sidecars are written to the run, see touchstone.read().
+
+The frequency axis is taken from the first file and every other file
+must match it. The run metadata is carried over, and the result is
+verified: every position present, the same s-parameters and entries at
+each, every file closed and the scan journaled as done. Any problems
+are listed in the dataset's 'issues' attribute and printed.
+
+The dataset is built in 'data.zarr.partial' and renamed once complete.
+Positions are recorded there as they are converted, so running the
+command again after an interruption continues where it stopped.
+
+Author: Noah Stieler, 2023
+"""
+
+import argparse
+import json
+import os
+import os.path
+import shutil
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy
+
+import dataset
+import journal
+import reader
+import touchstone
+
+_PROGRESS_NAME = 'progress.jsonl'
+
+
+def consolidate(path: str, workers: int = None, force: bool = False) -> list:
+    """Converts the run at path, returns the verification issues.
+    workers is the number of processes, the number of cores if None.
+    An existing 'data.zarr' is replaced if force is set."""
+    destination = os.path.join(path, 'data.zarr')
+    if os.path.exists(destination):
+        if not force:
+            raise FileExistsError(f'\'{destination}\' exists, use --force to replace it.')
+        shutil.rmtree(destination)
+
+    layout, files = reader.list_files(path)
+    if len(files) == 0:
+        raise FileNotFoundError(f'No run output in \'{path}\'.')
+    freqs, port_count = _shared_axis(layout, files)
+
+    partial = destination + '.partial'
+    os.makedirs(partial, exist_ok=True)
+    done = _load_progress(partial)
+
+    remaining = [pos_index for pos_index in sorted(files) if pos_index not in done]
+    print(f'{len(files)} positions, {len(done)} already converted, {len(freqs)} frequencies')
+    with ProcessPoolExecutor(workers) as executor, \
+            open(os.path.join(partial, _PROGRESS_NAME), 'a', encoding='utf-8') as progress:
+        futures = [executor.submit(_convert_position, layout, partial, pos_index, files[pos_index],
+                                   freqs, port_count) for pos_index in remaining]
+        for future in as_completed(futures):
+            result = future.result()
+            done[result['pos_index']] = result
+            # A position is only recorded once all its chunks are written
+            progress.write(json.dumps(result) + '\n')
+            progress.flush()
+            print(f'\r{len(done)}/{len(files)} positions', end='', flush=True)
+    print()
+
+    issues = _verify(path, layout, done)
+    positions = _positions(path, layout, done)
+    attrs = {
+        'axes': ['position', 'tran', 'refl', 's_parameter', 'freq'],
+        's_parameters': list(dataset.S_PARAMETERS),
+        's_parameters_measured': [s_parameter for s_parameter in dataset.S_PARAMETERS
+                                  if any(s_parameter in result['keys'] for result in done.values())],
+        'meta': _run_meta(path, layout, done),
+        'positions': positions,
+        'complete': len(issues) == 0,
+        'issues': issues
+    }
+    shape = [len(positions), port_count, port_count, len(dataset.S_PARAMETERS), len(freqs)]
+    dataset.write_chunks_meta(partial, shape, freqs, attrs)
+
+    os.remove(os.path.join(partial, _PROGRESS_NAME))
+    os.replace(partial, destination)
+    return issues
+
+
+def _shared_axis(layout: str, files: dict) -> tuple:
+    """Returns the frequencies and port count, from the first file."""
+    first = files[min(files)]
+    if layout == 'snp':
+        freqs, values = touchstone.read(first, cache=False)
+        return numpy.asarray(freqs), values.shape[1]
+    return reader.read_file(next(iter(first.values())))['freq'], dataset.DatasetWriter.port_count
+
+
+def _convert_position(layout: str, partial: str, pos_index: int, files,
+                      freqs: numpy.ndarray, port_count: int) -> dict:
+    """Writes the chunks of one position, run in a worker process.
+    files are the position's files from reader.list_files().
+    Returns what is needed to verify the position."""
+    result = {'pos_index': pos_index, 'keys': {}, 'complete': {}, 'freq_match': True,
+              'meta': None, 'bytes': 0}
+
+    blocks = {}
+    if layout == 'snp':
+        file_freqs, values = touchstone.read(files, cache=False)
+        result['freq_match'] = _freq_match(file_freqs, freqs)
+        matrix = values.transpose(1, 2, 0)  # [receive, drive, freq]
+        reflection = matrix[numpy.arange(port_count), numpy.arange(port_count)]
+        # The same mapping as reader.open_run(), port 1 of the pair is tran and port 2 refl
+        blocks['S11'] = numpy.repeat(reflection[:, None, :], port_count, axis=1)
+        blocks['S21'] = matrix.transpose(1, 0, 2)
+        blocks['S12'] = matrix
+        blocks['S22'] = numpy.repeat(reflection[None, :, :], port_count, axis=0)
+        for s_parameter in blocks:
+            result['keys'][s_parameter] = port_count ** 2
+            result['complete'][s_parameter] = True
+    else:
+        for s_parameter, file_path in files.items():
+            content = reader.read_file(file_path)
+            result['freq_match'] &= _freq_match(content['freq'], freqs)
+            result['complete'][s_parameter] = content['complete']
+            result['keys'][s_parameter] = sorted(content['entries'])
+            if content['meta'] is not None:
+                result['meta'] = content['meta']
+
+            block = numpy.full((port_count, port_count, len(freqs)), complex('nan'))
+            for key, values in content['entries'].items():
+                if len(values) == len(freqs):
+                    block[dataset.entry_index(key)] = values
+            blocks[s_parameter] = block
+
+    for s_parameter, block in blocks.items():
+        result['bytes'] += dataset.write_chunk(partial, pos_index, dataset.S_PARAMETERS.index(s_parameter), block)
+    return result
+
+
+def _freq_match(file_freqs, freqs: numpy.ndarray) -> bool:
+    return len(file_freqs) == len(freqs) and numpy.allclose(file_freqs, freqs, rtol=1e-9, atol=0)
+
+
+def _load_progress(partial: str) -> dict:
+    done = {}
+    path = os.path.join(partial, _PROGRESS_NAME)
+    if os.path.isfile(path):
+        with open(path, 'r', encoding='utf-8') as file:
+            for line in file:
+                try:
+                    result = json.loads(line)
+                except json.JSONDecodeError:  # Cut short by the interruption
+                    break
+                done[result['pos_index']] = result
+    return done
+
+
+def _verify(path: str, layout: str, done: dict) -> list:
+    issues = []
+    missing = sorted(set(range(max(done) + 1)) - set(done))
+    if missing:
+        issues.append(f'Positions missing: {missing}.')
+
+    s_parameters = set()
+    expected = {}
+    for result in done.values():
+        s_parameters.update(result['keys'])
+        for s_parameter, keys in result['keys'].items():
+            if layout == 'json' and len(keys) > len(expected.get(s_parameter, [])):
+                expected[s_parameter] = keys
+
+    for pos_index, result in sorted(done.items()):
+        if not result['freq_match']:
+            issues.append(f'Position {pos_index} has a different frequency axis.')
+        for s_parameter in sorted(s_parameters - set(result['keys'])):
+            issues.append(f'Position {pos_index} has no {s_parameter}.')
+        for s_parameter, keys in result['keys'].items():
+            if not result['complete'][s_parameter]:
+                issues.append(f'Position {pos_index} {s_parameter} was not closed.')
+            if layout == 'json' and len(keys) < len(expected[s_parameter]):
+                issues.append(f'Position {pos_index} {s_parameter} is missing '
+                              f'{len(expected[s_parameter]) - len(keys)} entries.')
+
+    records = journal.load(path)
+    if len(records) > 0 and not journal.resume_point(records)['done']:
+        issues.append('The scan was not journaled as done.')
+    return issues
+
+
+def _run_meta(path: str, layout: str, done: dict) -> dict:
+    run = reader.read_meta_file(path)
+    if 'meta' in run:
+        return run['meta']
+
+    for pos_index, result in sorted(done.items()):
+        if result['meta'] is not None:
+            return {key: value for key, value in result['meta'].items()
+                    if key not in dataset.POSITION_KEYS and key != 's_parameter'}
+    return {}
+
+
+def _positions(path: str, layout: str, done: dict) -> list:
+    positions = [{} for i in range(max(done) + 1)]
+    for pos_index, result in done.items():
+        if result['meta'] is not None:
+            positions[pos_index] = {key: result['meta'][key] for key in dataset.POSITION_KEYS
+                                    if key in result['meta']}
+
+    records = journal.load(path)
+    if layout == 'snp' and len(records) > 0:
+        for position, pos in zip(positions, records[0]['positions']):
+            position.update(zip(('posx', 'posy', 'posz'), pos))
+    return positions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Converts the output of a run into one dataset.')
+    parser.add_argument('path', help='run directory, created by out.init_root()')
+    parser.add_argument('--workers', type=int, default=None, help='processes, the number of cores by default')
+    parser.add_argument('--force', action='store_true', help='replace an existing data.zarr')
+    args = parser.parse_args()
+
+    issues = consolidate(args.path, args.workers, args.force)
+    for issue in issues:
+        print(issue)
+    print(f'Wrote {os.path.join(args.path, "data.zarr")}' + (', incomplete.' if issues else '.'))
+    sys.exit(1 if issues else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,293 @@
+"""
+Algae ~ Automated Target Positioning System
+Electromagnetic Imaging Lab, University of Manitoba
+
+Chunked binary dataset, an alternative to the per position .json files.
+
+A run is stored in one container as complex values indexed
+[position, tran, refl, s_parameter, freq]. Port indices are the
+port numbers minus one, s_parameter follows S_PARAMETERS, and
+reflections measured once per port, 'p<port>', are stored on the
+diagonal tran == refl. Entries that were not measured are NaN.
+The run metadata and frequencies are stored once, per position
+metadata is stored as a list indexed by position.
+
+Containers:
+    hdf5    'data.h5', the dataset 'data', requires h5py
+    chunks  'data.zarr', a Zarr v2 array directory, one zlib compressed
+            chunk per position and s-parameter. Needs only NumPy to write
+            and can be opened with the zarr package.
+
+Author: Noah Stieler, 2023
+"""
+
+import json
+import os.path
+import re
+import zlib
+
+import numpy
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+S_PARAMETERS = ('S11', 'S21', 'S12', 'S22')
+# S_ij of the pair (tran, refl) is S_ji of (refl, tran), see device0.port_pairs
+MIRROR_S_PARAMETERS = {'S11': 'S22', 'S21': 'S12', 'S12': 'S21', 'S22': 'S11'}
+
+# Metadata that changes between positions, everything else is stored once
+POSITION_KEYS = ('posx', 'posy', 'date', 'time')
+
+_KEY_PAIR = re.compile(r't(\d+)r(\d+)')
+_KEY_PORT = re.compile(r'p(\d+)')
+
+
+def entry_index(key: str) -> tuple:
+    """Converts an output key, 't<tran>r<refl>' or 'p<port>', to (tran, refl) indices."""
+    match = _KEY_PAIR.fullmatch(key)
+    if match is not None:
+        return int(match.group(1)) - 1, int(match.group(2)) - 1
+
+    match = _KEY_PORT.fullmatch(key)
+    if match is not None:
+        return int(match.group(1)) - 1, int(match.group(1)) - 1
+
+    raise ValueError(f'Invalid output key \'{key}\'.')
+
+
+class DatasetWriter:
+    # 'auto' uses hdf5 if h5py is installed, otherwise chunks
+    container = 'auto'
+    compression_level = 1  # zlib, 1 is fastest
+    port_count = 24
+
+    def __init__(self, directory: str, meta: dict, freqs: list, resume: bool = False, sync: bool = False):
+        """Creates the container in directory. meta is the metadata of the first
+        position, the keys in POSITION_KEYS are stored per position.
+        If resume is set an existing container in directory is reopened,
+        positions written again replace the stored ones. If sync is set each
+        s-parameter is on disk once end_s_parameter() returns."""
+        self.sync = sync
+        self.freqs = numpy.asarray(freqs, dtype=float)
+        self.meta = {key: value for key, value in meta.items()
+                     if key not in POSITION_KEYS and key != 's_parameter'}
+        self.positions = []
+        self.s_params_measured = []
+
+        # One block [tran, refl, freq] per s-parameter of the current position
+        self._blocks = {}
+        self._pos_index = 0
+        self.bytes_written = 0
+
+        container = DatasetWriter.container
+        if resume and os.path.isfile(os.path.join(directory, 'data.h5')):
+            container = 'hdf5'
+        elif resume and os.path.isdir(os.path.join(directory, 'data.zarr')):
+            container = 'chunks'
+        else:
+            resume = False
+        if container == 'auto':
+            container = 'hdf5' if h5py is not None else 'chunks'
+        if container == 'hdf5' and h5py is None:
+            raise ImportError('The hdf5 container requires h5py.')
+        self.container = container
+
+        self._shape = [0, self.port_count, self.port_count, len(S_PARAMETERS), len(self.freqs)]
+        if resume:
+            self._reopen(directory)
+        elif container == 'hdf5':
+            self.path = os.path.join(directory, 'data.h5')
+            self._file = h5py.File(self.path, 'w')
+            self._data = self._file.create_dataset(
+                'data', shape=tuple(self._shape), maxshape=(None,) + tuple(self._shape[1:]),
+                chunks=(1, self.port_count, self.port_count, 1, len(self.freqs)),
+                dtype=numpy.complex128, fillvalue=complex('nan'),
+                compression='gzip', compression_opts=DatasetWriter.compression_level)
+            self._file.create_dataset('freq', data=self.freqs)
+        else:
+            self.path = os.path.join(directory, 'data.zarr')
+            os.mkdir(self.path)
+        self._write_meta()
+
+    def begin_position(self, pos_index: int, meta: dict) -> None:
+        """Starts a position, meta is its metadata."""
+        self._pos_index = pos_index
+        position = {key: meta[key] for key in POSITION_KEYS if key in meta}
+        if pos_index < len(self.positions):
+            self.positions[pos_index] = position
+        else:
+            self.positions.append(position)
+
+    def begin_s_parameter(self, s_parameter: str) -> None:
+        block = numpy.empty((self.port_count, self.port_count, len(self.freqs)), dtype=numpy.complex128)
+        block.fill(complex('nan'))
+        self._blocks[s_parameter] = block
+        if s_parameter not in self.s_params_measured:
+            self.s_params_measured.append(s_parameter)
+
+    def write(self, s_parameter: str, key: str, real: list, imag: list) -> None:
+        tran, refl = entry_index(key)
+        block = self._blocks[s_parameter]
+        block[tran, refl].real = real
+        block[tran, refl].imag = imag
+
+    def end_s_parameter(self, s_parameter: str) -> None:
+        """Writes the s-parameter's chunk of the current position."""
+        if s_parameter not in self._blocks:
+            return
+        block = self._blocks.pop(s_parameter)
+        sp_index = S_PARAMETERS.index(s_parameter)
+
+        self._shape[0] = max(self._shape[0], self._pos_index + 1)
+        if self.container == 'hdf5':
+            if self._data.shape[0] < self._shape[0]:
+                self._data.resize(self._shape[0], axis=0)
+            self._data[self._pos_index, :, :, sp_index, :] = block
+        else:
+            self.bytes_written += write_chunk(self.path, self._pos_index, sp_index, block, self.sync)
+        self._write_meta()
+        if self.container == 'hdf5':
+            self._file.flush()
+            if self.sync:
+                os.fsync(self._file.id.get_vfd_handle())
+
+    def close(self) -> None:
+        for s_parameter in list(self._blocks):
+            self.end_s_parameter(s_parameter)
+        if self.container == 'hdf5' and self._file.id.valid:
+            self._file.close()
+
+    def _reopen(self, directory: str) -> None:
+        """Reads the state of an existing container."""
+        self.path = os.path.join(directory, 'data.h5' if self.container == 'hdf5' else 'data.zarr')
+        reader = DatasetReader(self.path)
+        self._shape[0] = reader.shape[0]
+        self.positions = reader.positions
+        self.s_params_measured = reader.s_params_measured
+        reader.close()
+
+        if self.container == 'hdf5':
+            self._file = h5py.File(self.path, 'r+')
+            self._data = self._file['data']
+
+    def _write_meta(self) -> None:
+        attrs = {
+            'axes': ['position', 'tran', 'refl', 's_parameter', 'freq'],
+            's_parameters': list(S_PARAMETERS),
+            's_parameters_measured': self.s_params_measured,
+            'meta': self.meta,
+            'positions': self.positions
+        }
+        if self.container == 'hdf5':
+            for key, value in attrs.items():
+                self._data.attrs[key] = json.dumps(value)
+            return
+
+        write_chunks_meta(self.path, self._shape, self.freqs, attrs, self.sync)
+
+
+class DatasetReader:
+    def __init__(self, path: str):
+        """path is a 'data.h5' file or 'data.zarr' directory."""
+        self.path = path
+        self._file = None
+        if os.path.isdir(path):
+            with open(os.path.join(path, '.zarray'), 'r', encoding='utf-8') as file:
+                self._zarray = json.load(file)
+            with open(os.path.join(path, '.zattrs'), 'r', encoding='utf-8') as file:
+                attrs = json.load(file)
+            self.shape = tuple(self._zarray['shape'])
+            self.freqs = numpy.asarray(attrs['freq'])
+        else:
+            if h5py is None:
+                raise ImportError('Reading .h5 datasets requires h5py.')
+            self._file = h5py.File(path, 'r')
+            data = self._file['data']
+            attrs = {key: json.loads(value) for key, value in data.attrs.items()}
+            self.shape = data.shape
+            self.freqs = self._file['freq'][:]
+
+        self.meta = attrs['meta']
+        self.positions = attrs['positions']
+        self.s_params_measured = attrs['s_parameters_measured']
+
+    def block(self, pos_index: int, s_parameter: str) -> numpy.ndarray:
+        """Returns the [tran, refl, freq] values of one position and s-parameter."""
+        sp_index = S_PARAMETERS.index(s_parameter)
+        if self._file is not None:
+            return self._file['data'][pos_index, :, :, sp_index, :]
+
+        shape = self._zarray['chunks'][1], self._zarray['chunks'][2], self._zarray['chunks'][4]
+        name = os.path.join(self.path, chunk_name(pos_index, sp_index))
+        if not os.path.isfile(name):
+            return numpy.full(shape, complex('nan'))
+        with open(name, 'rb') as file:
+            return numpy.frombuffer(zlib.decompress(file.read()), dtype='<c16').reshape(shape)
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+
+
+def chunk_name(pos_index: int, sp_index: int) -> str:
+    """Zarr v2 chunk key, one chunk spans the tran, refl and freq axes."""
+    return f'{pos_index}.0.0.{sp_index}.0'
+
+
+def write_chunk(path: str, pos_index: int, sp_index: int, block: numpy.ndarray, sync: bool = False) -> int:
+    """Writes the [tran, refl, freq] block of a position and s-parameter to
+    the chunks container at path, returns the compressed size.
+    If sync is set the chunk is on disk once this returns."""
+    chunk = zlib.compress(numpy.ascontiguousarray(block, dtype='<c16').tobytes(),
+                          DatasetWriter.compression_level)
+    with open(os.path.join(path, chunk_name(pos_index, sp_index)), 'wb') as file:
+        file.write(chunk)
+        if sync:
+            file.flush()
+            os.fsync(file.fileno())
+    if sync:
+        _sync_directory(path)
+    return len(chunk)
+
+
+def write_chunks_meta(path: str, shape: list, freqs: numpy.ndarray, attrs: dict, sync: bool = False) -> None:
+    """Writes the array description and attributes of the chunks container at path.
+    Each file is replaced whole, so an interrupted write leaves the previous one."""
+    attrs = dict(attrs, freq=numpy.asarray(freqs).tolist())
+    zarray = {
+        'zarr_format': 2,
+        'shape': list(shape),
+        'chunks': [1, shape[1], shape[2], 1, len(freqs)],
+        'dtype': '<c16',
+        'compressor': {'id': 'zlib', 'level': DatasetWriter.compression_level},
+        'fill_value': ['NaN', 'NaN'],
+        'order': 'C',
+        'filters': None
+    }
+    _write_json(os.path.join(path, '.zarray'), zarray, sync)
+    _write_json(os.path.join(path, '.zattrs'), attrs, sync)
+    if sync:
+        _sync_directory(path)
+
+
+def _write_json(path: str, value, sync: bool) -> None:
+    with open(path + '.tmp', 'w', encoding='utf-8') as file:
+        json.dump(value, file)
+        if sync:
+            file.flush()
+            os.fsync(file.fileno())
+    os.replace(path + '.tmp', path)
+
+
+def _sync_directory(path: str) -> None:
+    """Syncs the entries of a directory, so files created in it survive a power loss.
+    Windows has no directory handles, NTFS journals the entries itself."""
+    if os.name == 'nt':
+        return
+    descriptor = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(descriptor)
+    finally:
+        os.close(descriptor)
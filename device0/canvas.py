@@ -26,6 +26,7 @@ _radius_in = 0.85
 _radius_out = 1.10
 
 _port_state = []
+_port_active = []
 _line_list = []
 
 _tran = -1
@@ -43,6 +44,7 @@ _target_radius = 0
 
 for j in range(0, Switches.PORT_MAX):
     _port_state.append(0)
+    _port_active.append(True)
 
 
 def update() -> None:
@@ -61,6 +63,8 @@ def update() -> None:
             fill = '#2E2E2E'  # black
         else:
             fill = '#F6F6F6'  # gray
+        if not _port_active[i]:
+            fill = '#A8A8A8'  # dark gray, not in any measured pair
 
         if _tran == i:
             fill = '#30C03F'  # green
@@ -142,6 +146,12 @@ def port_reset() -> None:
     _refl = -1
 
 
+def port_set_active(ports: set) -> None:
+    """Ports not in the set are drawn as inactive."""
+    for i in range(0, Switches.PORT_MAX):
+        _port_active[i] = (i + 1) in ports
+
+
 def port_complete(port: int) -> None:
     _port_state[port - 1] = 1
 
@@ -16,13 +16,26 @@ Author: Noah Stieler, 2023
 
 import time
 
-from visa import VisaResource
+import numpy
+
+import segment
+from visa import VisaResource, Operation, MissingDataException, record
 from gui.parameter import input_dict
 
 
 class VNA(VisaResource):
     s_params = ['S11', 'S21', 'S12', 'S22']
 
+    # 'binary' transfers traces as REAL,64 blocks, 'ascii' is the slower fallback
+    transfer_format = 'binary'
+
+    # 'per_trace' selects and queries each s-parameter separately,
+    # 'bulk' retrieves all four in one SNP query and splits them on the host
+    readout_mode = 'per_trace'
+
+    # Compares the computed frequency axis with the VNA's own once per run
+    verify_freq_axis = False
+
     def __init__(self, address: str):
         super().__init__(address)
 
@@ -34,15 +47,33 @@ class VNA(VisaResource):
         self.sp_to_measure = []
         self.p_ranges = {}
 
+        # Set once the VNA has been preset, see initialize()
+        self._state_known = False
+
+        # Preallocated trace buffers for binary transfers, one per s-parameter
+        self._buffers = {}
+        self._bulk_buffer = None
+        self.transfer_stats = {}
+
+        # Snapshot of the sweep frequencies taken by initialize(), read only
+        self._freq_axis = numpy.empty(0)
+        self._freq_list = []
+        # Segments of the current run, None for a linear sweep
+        self.segments = None
+        # Largest difference from the VNA's axis in Hz, None if not verified
+        self.freq_axis_error = None
+
         self._set_parameter_ranges()
 
+    @property
+    def freq_axis(self) -> numpy.ndarray:
+        """Sweep frequencies of the current run as a read only array."""
+        return self._freq_axis
+
     @property
     def freq_list(self) -> list:
-        li = []
-        inc = (input_dict['freq_stop'].value - input_dict['freq_start'].value) / (input_dict['num_points'].value - 1)
-        for i in range(int(input_dict['num_points'].value)):
-            li.append(input_dict['freq_start'].value + i * inc)
-        return li
+        """Sweep frequencies of the current run, the list must not be modified."""
+        return self._freq_list
 
     def __del__(self):
         super().__del__()
@@ -53,77 +84,257 @@ class VNA(VisaResource):
 
         self.name = self.query('*IDN?')
 
-        self.write('SYSTEM:FPRESET')
-
-        self.display_on(False)
+        self.sp_to_measure = []
+        for s_param in VNA.s_params:
+            if s_param in input_dict:
+                if input_dict[s_param].value == 1:
+                    self.sp_to_measure.append(s_param)
 
-        # Using convention that parameter names are prefixed with 'parameter_'
-        self.write('CALCULATE1:PARAMETER:DEFINE \'parameter_S11\', S11')
-        self.write('CALCULATE1:PARAMETER:DEFINE \'parameter_S12\', S12')
-        self.write('CALCULATE1:PARAMETER:DEFINE \'parameter_S21\', S21')
-        self.write('CALCULATE1:PARAMETER:DEFINE \'parameter_S22\', S22')
-
-        self.write('INITIATE:CONTINUOUS OFF')
-        self.write('TRIGGER:SOURCE MANUAL')
-        self.write('SENSE1:SWEEP:MODE HOLD')
-        self.write('SENSE1:AVERAGE OFF')
-
-        self.write('SENSE1:SWEEP:TYPE LINEAR')
-        self.write('SENSE1:SWEEP:POINTS ' + str(int(input_dict['num_points'].value)))
-        self.write('SENSE1:BANDWIDTH ' + str(input_dict['ifbw'].value))
-        self.write('SENSE1:FREQUENCY:START ' + str(input_dict['freq_start'].value))
-        self.write('SENSE1:FREQUENCY:STOP ' + str(input_dict['freq_stop'].value))
-        # This is from the old software but the manual has a different syntax
-        self.write('SOURCE1:POWER1 ' + str(input_dict['power'].value) + 'DBM')
+        # None for a linear sweep
+        self.segments = segment.from_input()
+        if self.segments is None:
+            num_points = int(input_dict['num_points'].value)
+        else:
+            num_points = sum(seg.points for seg in self.segments)
+
+        # Sent as a few long messages rather than one transaction per command.
+        # Settings already applied by a previous run are skipped.
+        with self.batch():
+            # Only needed to bring the VNA from an unknown state to a known one,
+            # after that the shadow tracks the state.
+            if not self._state_known:
+                self.write('SYSTEM:FPRESET')
+                self._state_known = True
+
+            self.display_on(False)
+
+            # Using convention that parameter names are prefixed with 'parameter_'
+            for s_param in ('S11', 'S12', 'S21', 'S22'):
+                self.set('CALCULATE1:PARAMETER:DEFINE', f'\'parameter_{s_param}\', {s_param}',
+                         key='parameter_' + s_param)
+
+            self.set('INITIATE:CONTINUOUS', 'OFF')
+            self.set('TRIGGER:SOURCE', 'MANUAL')
+            self.set('SENSE1:SWEEP:MODE', 'HOLD')
+            self.set('SENSE1:AVERAGE', 'OFF')
+
+            if self.segments is None:
+                self.set('SENSE1:SWEEP:TYPE', 'LINEAR')
+                self.set('SENSE1:SWEEP:POINTS', num_points)
+                self.set('SENSE1:BANDWIDTH', input_dict['ifbw'].value)
+                self.set('SENSE1:FREQUENCY:START', input_dict['freq_start'].value)
+                self.set('SENSE1:FREQUENCY:STOP', input_dict['freq_stop'].value)
+            else:
+                segment.apply(self, self.segments)
+            # This is from the old software but the manual has a different syntax
+            self.set('SOURCE1:POWER1', str(input_dict['power'].value) + 'DBM')
+
+            if self.transfer_format == 'binary':
+                # Swapped byte order is little endian, native to the controller
+                self.set('FORMAT:BORDER', 'SWAPPED')
+                self.set('FORMAT:DATA', 'REAL,64')
+            else:
+                self.set('FORMAT:DATA', 'ASCII,0')
+
+            # SNP data is the frequencies followed by real and imaginary blocks
+            # for S11, S21, S12, S22 in that order. Set in either readout_mode
+            # so it can be switched to 'bulk' after initializing.
+            self.set('MMEMORY:STORE:TRACE:FORMAT:SNP', 'RI')
 
         # Kind of arbitrary, chosen like this to ensure plenty of time to complete sweep
         # Extra important if data_point_count is large.
         self.resource.timeout = 100 * 1000  # time in milliseconds
 
-        self.sp_to_measure = []
-        for s_param in VNA.s_params:
-            if s_param in input_dict:
-                if input_dict[s_param].value == 1:
-                    self.sp_to_measure.append(s_param)
+        self._buffers = {}
+        for s_param in self.sp_to_measure:
+            self._buffers[s_param] = numpy.empty(2 * num_points)
+
+        self._set_freq_axis(num_points)
+
+        self.transfer_stats = {
+            'format': self.transfer_format,
+            'traces': 0,
+            'bytes': 0,
+            'transfer_time': 0.0,
+            'parse_time': 0.0
+        }
+
+    def _set_freq_axis(self, num_points: int) -> None:
+        """Computes the sweep frequencies from the validated parameters.
+        If verify_freq_axis is set the VNA's axis is queried once and used
+        instead, freq_axis_error is the largest difference, in Hz."""
+        if self.segments is None:
+            axis = numpy.linspace(input_dict['freq_start'].value,
+                                  input_dict['freq_stop'].value, num_points)
+        else:
+            axis = segment.freq_axis(self.segments)
+
+        self.freq_axis_error = None
+        if VNA.verify_freq_axis:
+            if self.transfer_format == 'binary':
+                vna_axis = numpy.empty(num_points)
+                self.query_binary('SENSE1:X?', vna_axis)
+            else:
+                vna_axis = numpy.array(self.query('SENSE1:X?').split(','), dtype=float)
+            if len(vna_axis) != num_points:
+                raise MissingDataException(len(vna_axis), num_points)
+
+            self.freq_axis_error = float(numpy.max(numpy.abs(vna_axis - axis)))
+            axis = vna_axis
+
+        axis.setflags(write=False)
+        self._freq_axis = axis
+        self._freq_list = axis.tolist()
+
+    def predict_sweep_time(self) -> float:
+        """Rough prediction of the seconds one sweep takes, points over IF bandwidth.
+        Only used until the first sweep has been timed."""
+        if self.segments is None:
+            return input_dict['num_points'].value / input_dict['ifbw'].value
+        return sum(seg.points / seg.ifbw for seg in self.segments)
 
     def display_on(self, setting: bool) -> None:
         """Old software said VNA runs faster with display off,
         as mentioned in programming guide"""
         if setting:
-            self.write('DISPLAY:VISIBLE ON')
+            self.set('DISPLAY:VISIBLE', 'ON')
         else:
-            self.write('DISPLAY:VISIBLE OFF')
+            self.set('DISPLAY:VISIBLE', 'OFF')
 
     def fire(self) -> dict:
-        """Trigger the VNA and return the data it collected."""
-        self.write('INIT:IMM')
+        """Trigger the VNA and return the data it collected.
+        Binary transfers return the trace buffers, which are overwritten
+        by the next call, ASCII transfers return the raw strings."""
         # self.write('*WAI')  # *OPC? might be better because it stops the controller from attempting a read
-        self.query('*OPC?')  # Controller waits until all commands are completed.
+        self.start_sweep().wait()  # Controller waits until all commands are completed.
+
+        return self.read_traces()
+
+    def start_sweep(self) -> Operation:
+        """Triggers a sweep, the returned handle reports when it is done."""
+        return self.start_operation('INIT:IMM')
+
+    def read_traces(self, s_params: list = None) -> dict:
+        """Reads the traces of the last sweep, see fire().
+        s_params selects which of sp_to_measure are read, default all."""
+        if s_params is None:
+            s_params = self.sp_to_measure
+        if self.readout_mode == 'bulk':
+            output = self._fire_bulk()
+            return {s_parameter: output[s_parameter] for s_parameter in s_params}
 
         # Using convention that parameter names are prefixed with 'parameter_'
         output = {}
-        for s_parameter in self.sp_to_measure:
+        for s_parameter in s_params:
             self.write('CALCULATE1:PARAMETER:SELECT \'' + 'parameter_' + s_parameter + '\'')
-            output[s_parameter] = self.query('CALCULATE:DATA? SDATA')
+
+            time_start = time.perf_counter()
+            if self.transfer_format == 'binary':
+                byte_count = self.query_binary('CALCULATE:DATA? SDATA', self._buffers[s_parameter])
+                output[s_parameter] = self._buffers[s_parameter]
+            else:
+                output[s_parameter] = self.query('CALCULATE:DATA? SDATA')
+                byte_count = len(output[s_parameter])
+
+            self.transfer_stats['transfer_time'] += time.perf_counter() - time_start
+            self.transfer_stats['bytes'] += byte_count
+            self.transfer_stats['traces'] += 1
 
         return output
 
-    def _set_parameter_ranges(self) -> None:
+    def _fire_bulk(self) -> dict:
+        """Retrieves all s-parameters of the sweep in a single query and
+        splits them into the per s-parameter trace buffers.
+        The bulk buffer is sized here for the sweep set up by initialize(),
+        as readout_mode can be changed after initializing."""
+        num_points = len(self._freq_axis)
+        if self._bulk_buffer is None or len(self._bulk_buffer) != 9 * num_points:
+            self._bulk_buffer = numpy.empty(9 * num_points)
+
+        time_start = time.perf_counter()
+        if self.transfer_format == 'binary':
+            byte_count = self.query_binary('CALCULATE1:DATA:SNP:PORTS? \"1,2\"', self._bulk_buffer)
+        else:
+            str_points = self.query('CALCULATE1:DATA:SNP:PORTS? \"1,2\"')
+            byte_count = len(str_points)
+
+            float_points = numpy.array(str_points.split(','), dtype=float)
+            if len(float_points) != len(self._bulk_buffer):
+                raise MissingDataException(len(float_points), len(self._bulk_buffer))
+            self._bulk_buffer[:] = float_points
+
+        self.transfer_stats['transfer_time'] += time.perf_counter() - time_start
+        self.transfer_stats['bytes'] += byte_count
+
+        output = {}
+        for s_parameter in self.sp_to_measure:
+            # Skip the frequency block
+            start = num_points * (1 + 2 * VNA.s_params.index(s_parameter))
+            buffer = self._buffers[s_parameter]
+            buffer[0::2] = self._bulk_buffer[start:start + num_points]
+            buffer[1::2] = self._bulk_buffer[start + num_points:start + 2 * num_points]
+
+            output[s_parameter] = buffer
+            self.transfer_stats['traces'] += 1
+
+        return output
+
+    def format_output(self, output: dict) -> dict:
+        """Converts the output of fire() into real and imaginary lists
+        for each s-parameter, timing the conversion."""
+        time_start = time.perf_counter()
+        for s_parameter in output:
+            output[s_parameter] = VNA.format_data_one_sweep(output[s_parameter], self._freq_axis)
+        duration = time.perf_counter() - time_start
+
+        self.transfer_stats['parse_time'] += duration
+        if VisaResource.instrumented:
+            record('host:parse', duration)
+
+        return output
+
+    def transfer_summary(self) -> str:
+        """Returns the measured transfer rate and parse time per trace."""
+        stats = self.transfer_stats
+        if stats.get('traces', 0) == 0:
+            return 'No traces transferred.'
+
+        rate = stats['bytes'] / stats['transfer_time'] if stats['transfer_time'] > 0 else 0
+        parse_ms = 1000 * stats['parse_time'] / stats['traces']
+        return f'{stats["format"]} transfer: {rate / 1e3:.1f} kB/s, ' \
+               f'parse: {parse_ms:.2f} ms/trace'
+
+    def refresh_parameter_ranges(self) -> None:
+        """Queries the parameter ranges from the VNA, replacing the cached values."""
+        self._set_parameter_ranges(refresh=True)
+
+    def _set_parameter_ranges(self, refresh: bool = False) -> None:
         """Gets all valid parameter ranges from the VNA.
         this is used when the 'run' button is pressed to ensure the
-        user submitted valid data."""
+        user submitted valid data.
+        Ranges are cached on disk per instrument identity, as querying them
+        requires a preset, unless refresh is set."""
         self.resource.read_termination = '\n'
         self.resource.write_termination = '\n'
 
+        if not refresh:
+            cached = self.cache_load('p_ranges')
+            if cached is not None:
+                self.p_ranges = {key: tuple(value) for key, value in cached.items()}
+                return
+
         # Testing has confirmed this set up is required.
-        self.write('SYSTEM:FPRESET')
-        parameter_name = 'parameter_S21'
-        self.write('CALCULATE1:PARAMETER:DEFINE \'' + parameter_name + '\', S21')
-        self.write('INITIATE:CONTINUOUS OFF')
-        self.write('TRIGGER:SOURCE MANUAL')
-        self.write('SENSE1:SWEEP:MODE HOLD')
-        self.write('SENSE1:AVERAGE OFF')
-        self.write('SENSE1:SWEEP:TYPE LINEAR')
+        with self.batch():
+            self.write('SYSTEM:FPRESET')
+            self._state_known = True
+            parameter_name = 'parameter_S21'
+            self.set('CALCULATE1:PARAMETER:DEFINE', '\'' + parameter_name + '\', S21',
+                     key=parameter_name)
+            self.set('INITIATE:CONTINUOUS', 'OFF')
+            self.set('TRIGGER:SOURCE', 'MANUAL')
+            self.set('SENSE1:SWEEP:MODE', 'HOLD')
+            self.set('SENSE1:AVERAGE', 'OFF')
+            self.set('SENSE1:SWEEP:TYPE', 'LINEAR')
 
         self.p_ranges['num_points'] = (
             int(self.query('SENSE1:SWEEP:POINTS? MIN')),
@@ -146,10 +357,20 @@ class VNA(VisaResource):
             float(self.query('SOURCE1:POWER1? MAX'))
         )
 
+        self.cache_store('p_ranges', self.p_ranges)
+
     @staticmethod
-    def format_data_one_sweep(str_points: str, freq_list: list) -> list:
+    def format_data_one_sweep(str_points, freq_list: numpy.ndarray) -> list:
         """Returns a list that contains lists of the real and imaginary
-        components at each frequency."""
+        components at each frequency.
+        str_points is either the ASCII string or the binary trace buffer."""
+        if isinstance(str_points, numpy.ndarray):
+            if len(str_points) != 2 * len(freq_list):
+                raise MissingDataException(len(str_points), 2 * len(freq_list))
+
+            # Values are interleaved real, imaginary
+            return [str_points[0::2].tolist(), str_points[1::2].tolist()]
+
         float_points = str_points.split(',')
 
         for i in range(len(float_points)):
@@ -181,27 +402,45 @@ class Switches(VisaResource):
     def __init__(self, address: str):
         super().__init__(address)
 
+        # Ports currently switched in, a port that is already set
+        # is not set again so its relay is not actuated.
+        self.port_tran = None
+        self.port_refl = None
+
     def __del__(self):
         super().__del__()
 
     def initialize(self) -> None:
         self.write('*rst')  # reset
+        self.port_tran = None
+        self.port_refl = None
 
     def set_tran(self, port: int) -> None:
         """Port indices are 1-24 inclusive"""
         if port < Switches.PORT_MIN or port > Switches.PORT_MAX:
             raise SwitchInvalidPortException(port)
+        if port == self.port_tran:
+            return
 
         self.write(f'tran_{Switches.pad_port_number(port)};')
-        time.sleep(Switches.debounce_time)
+        self._debounce()
+        self.port_tran = port
 
     def set_refl(self, port: int) -> None:
         """Port indices are 1-24 inclusive"""
         if port < Switches.PORT_MIN or port > Switches.PORT_MAX:
             raise SwitchInvalidPortException(port)
+        if port == self.port_refl:
+            return
 
         self.write(f'refl_{Switches.pad_port_number(port)}')
+        self._debounce()
+        self.port_refl = port
+
+    def _debounce(self) -> None:
         time.sleep(Switches.debounce_time)
+        if VisaResource.instrumented:
+            record('host:debounce', Switches.debounce_time)
 
     @staticmethod
     def pad_port_number(port: int) -> str:
@@ -240,15 +479,3 @@ class SwitchInvalidPortException(Exception):
         print(f'SwitchInvalidPortException:'
               f'\n\tPort {self.attempted_port} is invalid.')
 
-
-class MissingDataException(Exception):
-    """Raised when the parsed vna data does not match two floats per frequency"""
-
-    def __init__(self, actual_num_count: int, expected_num_count: int):
-        self.actual_num_count = actual_num_count
-        self.expected_num_count = expected_num_count
-
-    def get_message(self) -> str:
-        msg = f'MissingDataException:\n\texpected {self.expected_num_count} floating point numbers' \
-              f'\n\treceived from vna {self.actual_num_count} floating point numbers'
-        return msg
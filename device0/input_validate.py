@@ -9,9 +9,12 @@ Author: Noah Stieler, 2023
 
 import os.path
 
+import compression
 import gui
+import segment
 from gui.parameter import input_dict
 from .imaging import VNA
+from . import port_pairs
 from pygrbl import PyGRBLMachine
 
 
@@ -19,12 +22,25 @@ def input_validate(vna: VNA, grbl_machine: PyGRBLMachine) -> bool:
     """Checks all user input for errors/invalid entries"""
     check_list = ['num_points', 'ifbw', 'freq_start', 'freq_stop', 'power']
 
+    try:
+        segments = segment.from_input()
+    except (ValueError, OSError) as e:
+        gui.bottom_bar.message_display(f'Invalid segment table: {e}', 'red')
+        return False
+    if segments is not None:
+        # Frequencies, points and IF bandwidth are taken from the segment table
+        check_list = ['power']
+        error = segment.validate(segments, vna.p_ranges)
+        if error != '':
+            gui.bottom_bar.message_display(error, 'red')
+            return False
+
     for item in check_list:
         if not (vna.p_ranges[item][0] <= input_dict[item].value <= vna.p_ranges[item][1]):
             gui.bottom_bar.message_display('\"' + input_dict[item].name + f'\" must be in range: ' +
                                            str(vna.p_ranges[item]), 'red')
             return False
-    if not (input_dict['freq_stop'].value > input_dict['freq_start'].value):
+    if segments is None and not (input_dict['freq_stop'].value > input_dict['freq_start'].value):
         gui.bottom_bar.message_display('Start frequency must be less than stop frequency.', 'red')
         return False
     elif not _valid_s_params():
@@ -34,6 +50,18 @@ def input_validate(vna: VNA, grbl_machine: PyGRBLMachine) -> bool:
         gui.bottom_bar.message_display('Invalid output directory.', 'red')
         return False
 
+    try:
+        port_pairs.from_input()
+    except (ValueError, OSError) as e:
+        gui.bottom_bar.message_display(f'Invalid port pairs: {e}', 'red')
+        return False
+
+    try:
+        compression.check_available(compression.parse_option(input_dict['output_compression'].value)[0])
+    except ImportError as e:
+        gui.bottom_bar.message_display(str(e), 'red')
+        return False
+
     """     IF POSITIONING IS ENABLED
     """
     if input_dict['cnc_enable'].value:
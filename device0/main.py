@@ -19,26 +19,44 @@ Thrown by: pyvisa/highlevel.py
 -Not sure how to fix something thrown within the package
 -Not a fatal error either as everything works if USB is
     connected again
+-The interrupted scan can be continued with 'Resume', see journal.py
 
 Author: Noah Stieler, 2023
 """
 
+import time
 import tkinter as tk
+from tkinter import filedialog
 import serial.tools.list_ports
 from datetime import date, datetime
 
 import gui
 from gui.button import button_dict
 from gui.parameter import input_dict
+import compression
+import dataset
+import journal
 import out
+import segment
+import visa
 from display_resources import display_resources
 from . import canvas
 from .imaging import *
 from .input_validate import input_validate
+from .pipeline import ScanPipeline
+from .plan import compile_plan
+from engine import Engine, Step, format_duration
+from . import port_pairs
 import pygrbl
 from . import pygrbl_handler
 
-abort = False
+# Seconds between gui refreshes during a scan, so the gui
+# does not compete with the engine thread
+OBSERVE_INTERVAL = 0.02
+
+# 'JSON' is a folder per position, 'JSON normalized' the same with the run's
+# metadata and frequencies only in meta.json, 'Dataset' one binary container per run, see out.py
+OUTPUT_FORMATS = ('JSON', 'JSON normalized', 'Dataset')
 
 WORKING_AREA_RADIUS = 120  # Default for this device
 WORKING_AREA_PADDING = 20  # Default for this device
@@ -49,16 +67,26 @@ grbl_machine = None
 
 state = 'idle'
 
-tran_range = (Switches.PORT_MIN, Switches.PORT_MAX)
-refl_range = (Switches.PORT_MIN, Switches.PORT_MAX)
-port_tran = tran_range[0]
-port_refl = refl_range[0]
+# Trans/refl port pairs visited at each position,
+# and the sweeps planned from them, see port_pairs.steps()
+pair_list = port_pairs.dense()
+step_list = port_pairs.steps(pair_list, [], 'per pair')
+pair_index = 0
+port_tran, port_refl = pair_list[0]
+pair_mask = 'all'
+# Pairs left to measure at the current position that use each port
+ports_remaining = {}
 
 vna, switches = None, None
+pipeline = None
+
+# Runs the compiled scan, the gui observes it up to observed_index
+engine = None
+observed_index = 0
 
 
 def main() -> None:
-    global port_tran, port_refl
+    global port_tran, port_refl, pair_index
     global state
     global pos_list, pos_index
 
@@ -70,6 +98,8 @@ def main() -> None:
     input_dict['freq_start'] = gui.tab_home.add_parameter_num('Start frequency (Hz)')
     input_dict['freq_stop'] = gui.tab_home.add_parameter_num('Stop frequency (Hz)')
     input_dict['power'] = gui.tab_home.add_parameter_num('Power (dBm)')
+    input_dict['sweep_type'] = gui.tab_home.add_parameter_option('Sweep type', segment.SWEEP_OPTIONS)
+    input_dict['segment_table'] = gui.tab_home.add_parameter_string('Segment table (.csv or list)')
 
     gui.tab_home.checkbox_row_begin()
     input_dict['S11'] = gui.tab_home.add_parameter_checkbox('S11')
@@ -80,6 +110,20 @@ def main() -> None:
 
     input_dict['S21'].toggle()
 
+    input_dict['reciprocity'] = gui.tab_home.add_parameter_option('Reciprocity',
+                                                                  port_pairs.RECIPROCITY_OPTIONS)
+    input_dict['reflection'] = gui.tab_home.add_parameter_option('Reflection',
+                                                                 port_pairs.REFLECTION_OPTIONS)
+    input_dict['port_mask'] = gui.tab_home.add_parameter_option('Port pairs',
+                                                                port_pairs.MASK_OPTIONS)
+    input_dict['mask_k'] = gui.tab_home.add_parameter_num('Neighbour range (ports)')
+    input_dict['mask_list'] = gui.tab_home.add_parameter_string('Port pair list (.csv or t,r; ...)')
+    input_dict['output_format'] = gui.tab_home.add_parameter_option('Output format', OUTPUT_FORMATS)
+    input_dict['output_precision'] = gui.tab_home.add_parameter_option('Output precision',
+                                                                       out.PRECISION_OPTIONS)
+    input_dict['output_compression'] = gui.tab_home.add_parameter_option('Output compression',
+                                                                         compression.OPTIONS)
+
     # Set up hardware gui
     input_dict['address_vna'] = gui.tab_hardware.add_hardware('VNA', default_value='GPIB0::16::INSTR')
     input_dict['address_switch'] = gui.tab_hardware.add_hardware('Switches', default_value='GPIB0::15::INSTR')
@@ -93,7 +137,9 @@ def main() -> None:
     # Define button functionality
     button_dict['connect'].command(on_button_connect)
     button_dict['disp_res'].command(display_resources)
+    button_dict['refresh_ranges'].command(on_button_refresh_ranges)
     button_dict['run'].command(on_button_run)
+    button_dict['resume'].command(on_button_resume)
     button_dict['stop'].command(abort_scan)
 
     button_dict['set_origin'].command(on_set_origin)
@@ -116,105 +162,157 @@ def main() -> None:
         if state == 'idle':
             gui.parameter.update()
         if state == 'scan':
-            if port_refl == port_tran:
-                scan_finished = update_ports()
-                if scan_finished:
-                    state = 'scan_finished'
-                continue
-
-            switches.set_tran(port_tran)
-            switches.set_refl(port_refl)
-
-            vna_output = vna.fire()
-
-            # Convert output from string to a list of floats
-            for s_parameter in vna.sp_to_measure:
-                try:
-                    vna_output[s_parameter] = VNA.format_data_one_sweep(vna_output[s_parameter], vna.freq_list)
-                except MissingDataException as error:
-                    gui.bottom_bar.message_display(error.get_message(), 'red')
-                    abort_scan()
-
-            if not abort:
-                # Write to output files
-                for s_parameter in vna.sp_to_measure:
-                    data_close = False
-                    if port_tran == tran_range[1] and port_refl == refl_range[1] - 1:
-                        data_close = True
-
-                    out.out_file_data_write(s_parameter, port_tran, port_refl,
-                                            vna_output[s_parameter][0],
-                                            vna_output[s_parameter][1], data_close)
-
-                scan_finished = update_ports()
-                update_progress_bar()
-
-                if scan_finished:
-                    state = scan_finished
-
-        if state == 'scan_finished':
-            for s_parameter in vna.sp_to_measure:
-                out.out_file_complete(s_parameter)
-
-            # All positions visited
-            if pos_index + 1 >= len(pos_list):
-                if input_dict['cnc_enable'].value:
-                    try:
-                        grbl_machine.set_position(pygrbl.Point(0, 0))
-                        canvas.set_target_pos(0, 0)
-                    except pygrbl.PyGRBLException as e:
-                        pygrbl_handler.pygrbl_exception(e)
-                        abort_scan()
-
-                button_dict['stop'].toggle_state()
-
-                state = 'idle'
-            # Go to next position
-            else:
-                pos_index += 1
-                pos = pos_list[pos_index]
-
-                try:
-                    grbl_machine.set_position(pos)
-                    canvas.set_target_pos(pos.x, pos.y)
-                except pygrbl.PyGRBLException as e:
-                    pygrbl_handler.pygrbl_exception(e)
-                    abort_scan()
-
-                if not abort:
-                    # Set up new output folder
-                    out.mkdir_new_pos()
-                    for s_parameter in vna.sp_to_measure:
-                        meta_dict = format_meta_data(s_parameter,
-                                                                  pos.x, pos.y)
-                        out.out_file_init(s_parameter, meta_dict, vna.freq_list)
-
-                    port_tran = tran_range[0]
-                    port_refl = refl_range[0]
-
-                    state = 'scan'
-
-            gui.bottom_bar.progress_bar_set(0)
+            observe_scan()
+            time.sleep(OBSERVE_INTERVAL)
+
+
+def observe_scan() -> None:
+    """Follows the engine from the gui thread. Steps completed since the last
+    call are shown on the canvas and progress bar, acquisition itself
+    never waits for the gui."""
+    global observed_index, pos_index, state
+
+    index = engine.index
+    if index == observed_index and not engine.done:
+        return
+
+    while observed_index < index:
+        step = engine.plan[observed_index]
+        if step.kind == 'move':
+            canvas.set_target_pos(step.args['pos'].x, step.args['pos'].y)
+        elif step.kind == 'open_position':
+            pos_index = step.args['pos_index']
+            reset_ports()
+        elif step.kind == 'reopen_position':
+            pos_index = step.args['pos_index']
+            reset_ports()
+            for i in range(step.args['pairs']):
+                update_ports()
+        elif step.kind == 'measure':
+            update_ports()
+        observed_index += 1
+
+    update_progress_bar()
+    if not engine.done:
+        if not engine.stopping:
+            gui.bottom_bar.message_display(
+                f'Scanning, {format_duration(engine.remaining_time())} remaining.', 'blue')
+        return
+
+    if engine.error is not None:
+        report_error(engine.error)
+        abort_scan()
+        return
+    if engine.aborted:
+        abort_scan()
+        return
+
+    pipeline.close()
+    button_dict['stop'].set_state(0)
+    canvas.port_reset()
+    gui.bottom_bar.progress_bar_set(0)
+    summary = [vna.transfer_summary(), pipeline.summary(), out.compression_summary()]
+    gui.bottom_bar.message_display(f'Scan complete in {format_duration(engine.elapsed)}, ' +
+                                   ', '.join(item for item in summary if item), 'green')
+    visa.instrumentation_dump(out.output['full_path'])
+
+    state = 'idle'
+
+
+def report_error(error: Exception) -> None:
+    """Displays an error raised on the engine thread."""
+    if isinstance(error, MissingDataException):
+        gui.bottom_bar.message_display(error.get_message(), 'red')
+    elif isinstance(error, pygrbl.PyGRBLException):
+        pygrbl_handler.pygrbl_exception(error)
+    else:
+        gui.bottom_bar.message_display(f'Scan failed: {error}', 'red')
+
+
+"""
+    Plan step handlers, run on the engine thread, see plan.py
+"""
+
+
+def _step_move(step: Step) -> None:
+    grbl_machine.set_position(step.args['pos'])
+
+
+def _step_open_position(step: Step) -> None:
+    pos = step.args['pos']
+    out.mkdir_new_pos(first_position=step.args['pos_index'] == 0)
+    for s_parameter in vna.sp_to_measure:
+        meta_dict = format_meta_data(s_parameter, pos.x, pos.y)
+        out.out_file_init(s_parameter, meta_dict, vna.freq_list)
+
+
+def _step_reopen_position(step: Step) -> None:
+    out.reopen_position(step.args['pos_index'], step.args['offsets'], step.args['entries'])
+
+
+def _step_measure(step: Step) -> None:
+    # Each pair is journaled once written, the dataset is
+    # only written once per position so it is journaled then
+    commit = None
+    if out.backend == 'json':
+        commit = {'event': 'pair', 'pos_index': step.args['pos_index'], 'pairs': step.args['pair'] + 1}
+
+    # Sweeps, then parses and writes to output files,
+    # while the switches are set for the next pair
+    pipeline.measure(step.args['tran'], step.args['refl'],
+                     step.args['reads'], step.args['next_pair'], commit)
+
+
+def _step_close_position(step: Step) -> None:
+    pipeline.flush()
+    for s_parameter in vna.sp_to_measure:
+        out.out_file_complete(s_parameter)
+    out.journal_commit({'event': 'position', 'pos_index': step.args['pos_index']})
+
+
+def _step_finish(step: Step) -> None:
+    # Output is written on out's writer thread, errors are raised here
+    pipeline.flush()
+    out.journal_commit({'event': 'done'})
+    out.close()
+
+
+def reset_ports() -> None:
+    """Goes back to the first pair of step_list for a new position."""
+    global port_tran, port_refl, pair_index, ports_remaining
+    pair_index = 0
+    port_tran, port_refl = step_list[0][:2]
+
+    ports_remaining = {}
+    for step in step_list:
+        for port in step[:2]:
+            ports_remaining[port] = ports_remaining.get(port, 0) + 1
+
+    canvas.port_reset()
+    canvas.port_set_active(set(ports_remaining))
+    canvas.port_pair(port_tran, port_refl)
 
 
 def update_ports() -> bool:
-    """Cycles the trans and refl port of the switches.
+    """Cycles the trans and refl port of the switches through step_list.
     Returns a bool to indicate when all trans/refl pairs have
     been cycled through. Also updates canvas info."""
-    global port_tran, port_refl
+    global port_tran, port_refl, pair_index
     is_complete = False
 
-    port_refl += 1
-    if port_refl > refl_range[1]:
-        port_tran += 1
-        port_refl = refl_range[0]
-    if port_tran > tran_range[1]:
+    # A port is complete once every pair using it has been measured
+    for port in step_list[pair_index][:2]:
+        ports_remaining[port] -= 1
+        if ports_remaining[port] == 0:
+            canvas.port_complete(port)
+
+    pair_index += 1
+    if pair_index >= len(step_list):
         is_complete = True
         canvas.port_reset()
     else:
-        canvas.port_complete(port_tran)
-
-    canvas.port_pair(port_tran, port_refl)
+        port_tran, port_refl = step_list[pair_index][:2]
+        canvas.port_pair(port_tran, port_refl)
 
     return is_complete
 
@@ -224,20 +322,64 @@ def on_button_run() -> None:
     Checks that hardware is connected and ready,
     that all user input is valid, and sets up output directory and files.
     Assuming no user errors, state is changed to 'scan'."""
+    if not scan_ready():
+        return
+
+    start_scan()
+
+
+def on_button_resume() -> None:
+    """Continues an interrupted scan, selected by its output directory,
+    after the last pair recorded in its journal. The scan's settings
+    must not have been changed."""
+    if not scan_ready():
+        return
+
+    root = filedialog.askdirectory(initialdir=input_dict['output_dir'].value,
+                                   title='Select the output of the interrupted scan')
+    if not root:
+        return
+
+    records = journal.load(root)
+    if len(records) == 0 or records[0]['device'] != 'device0':
+        gui.bottom_bar.message_display('No scan journal in the selected directory.', 'red')
+        return
+    if journal.resume_point(records)['done']:
+        gui.bottom_bar.message_display('The scan is already complete.', 'red')
+        return
+
+    differ = journal.compare_inputs(records[0]['inputs'], input_dict)
+    if len(differ) > 0:
+        gui.bottom_bar.message_display('Settings differ from the interrupted scan: ' +
+                                       ', '.join(differ) + '.', 'red')
+        return
+
+    start_scan(root, records)
 
-    global abort
-    abort = False
 
-    """Check that hardware is connected and ready."""
+def scan_ready() -> bool:
+    """Checks that hardware is connected and ready, and that all user input is valid."""
+    if state != 'idle':
+        gui.bottom_bar.message_display('A scan is still stopping.', 'red')
+        return False
     if vna is None or switches is None or grbl_machine is None:
         gui.bottom_bar.message_display('Hardware setup failed.', 'red')
-        return
+        return False
 
     valid = input_validate(vna, grbl_machine)
     if not valid:
-        return
+        return False
 
     gui.bottom_bar.message_clear()
+    return True
+
+
+def start_scan(resume_root: str = None, records: list = None) -> None:
+    """Sets up the hardware and output and starts the engine. If resume_root
+    is given the scan journaled in records is continued in that directory,
+    with the positions and port pairs it was started with."""
+    visa.instrumentation_reset()
+    visa.instrumentation_enable(input_dict['log_timing'].value)
 
     """Initialize hardware"""
     vna.initialize()
@@ -246,56 +388,98 @@ def on_button_run() -> None:
     pygrbl.set_chamber(pygrbl_handler.chamber)
 
     global pos_list, pos_index
-    first_pos = pygrbl.Point(0, 0)
+    pos_index = 0
+    home = None
     if input_dict['cnc_enable'].value:
-        if input_dict['pos_gen_type'].value == 'random uniform 2d':
+        if resume_root is not None:
+            pos_list = [pygrbl.Point(*pos) for pos in records[0]['positions']]
+        elif input_dict['pos_gen_type'].value == 'random uniform 2d':
             pos_list = pygrbl.ChamberCircle2D.gen_rand_uniform(input_dict['num_pos'].value,
                                                                pygrbl_handler.chamber.true_radius,
                                                                order='nearest_neighbour')
         elif input_dict['pos_gen_type'].value == 'list':
             pos_list = pygrbl.load_csv(input_dict['pos_list_path'].value, 2)
-
-        first_pos = pos_list[0]
-
-        try:
-            grbl_machine.set_position(first_pos)
-            canvas.set_target_pos(first_pos.x, first_pos.y)
-        except pygrbl.PyGRBLException as e:
-            pygrbl_handler.pygrbl_exception(e)
-            abort_scan()
-            return
+        positions = pos_list
+        home = pygrbl.Point(0, 0)
     else:
         pos_list = []
-
-    """Initialize output file structure"""
-    out.init_root(input_dict['output_dir'].value, input_dict['output_name'].value)
-    out.mkdir_new_pos(first_position=True)
-
-    for s_parameter in vna.sp_to_measure:
-        meta_dict = format_meta_data(s_parameter, first_pos.x, first_pos.y)
-        out.out_file_init(s_parameter, meta_dict, vna.freq_list)
+        positions = [pygrbl.Point(0, 0)]
 
     """Initialize switches"""
-    global port_tran, port_refl
-    port_tran = tran_range[0]
-    port_refl = refl_range[0]
+    global pair_list, step_list, pair_mask
+    if resume_root is not None:
+        pair_list = [tuple(pair) for pair in records[0]['pairs']]
+        pair_mask = records[0]['pair_mask']
+    else:
+        pair_list, pair_mask = port_pairs.from_input()
+    step_list = port_pairs.steps(pair_list, vna.sp_to_measure,
+                                 input_dict['reflection'].value.lower())
+    reset_ports()
     switches.initialize()
 
-    button_dict['stop'].toggle_state()
+    """Initialize output file structure"""
+    out.backend = 'dataset' if input_dict['output_format'].value == 'Dataset' else 'json'
+    out.normalized = input_dict['output_format'].value == 'JSON normalized'
+    out.set_precision(input_dict['output_precision'].value)
+    out.set_compression(input_dict['output_compression'].value)
+    resume = None
+    if resume_root is not None:
+        resume = journal.resume_point(records)
+        out.resume_root(resume_root, resume['pos_index'])
+        out.journal_open({'event': 'resume', 'pos_index': resume['pos_index'], 'pairs': resume['pairs']})
+    else:
+        out.init_root(input_dict['output_dir'].value, input_dict['output_name'].value)
+        if out.normalized:
+            out.create_meta_file({key: value for key, value in format_meta_data('').items()
+                                  if key not in out.RECORD_KEYS}, vna.freq_list)
+        out.journal_open(journal.start_record('device0', input_dict,
+                                              [[pos.x, pos.y] for pos in positions],
+                                              pairs=[list(pair) for pair in pair_list],
+                                              pair_mask=pair_mask))
+
+    global pipeline
+    pipeline = ScanPipeline(vna, switches)
+
+    """Compile the scan and run it on the engine thread"""
+    global engine, observed_index
+    scan_plan = compile_plan(positions, step_list, home, vna.predict_sweep_time(), resume)
+    engine = Engine(scan_plan, {
+        'move': _step_move,
+        'open_position': _step_open_position,
+        'reopen_position': _step_reopen_position,
+        'measure': _step_measure,
+        'close_position': _step_close_position,
+        'finish': _step_finish
+    })
+    observed_index = 0
+    engine.start()
+
+    button_dict['stop'].set_state(1)
+    if vna.freq_axis_error:
+        gui.bottom_bar.message_display('The VNA frequency axis differs from the entered one by up to '
+                                       f'{vna.freq_axis_error:g} Hz, the VNA\'s is written.', 'blue')
 
     global state
     state = 'scan'
 
 
 def abort_scan() -> None:
-    global abort
-    abort = True
+    """Stops the scan after the step in progress. The gui is not held up
+    waiting for it, observe_scan() calls this again once the engine has stopped."""
+    if engine is not None and not engine.done:
+        engine.abort()
+        button_dict['stop'].set_state(0)
+        gui.bottom_bar.message_display('Stopping after the current step...', 'blue')
+        return
 
-    for s_parameter in vna.sp_to_measure:
-        out.out_file_complete(s_parameter)
+    if pipeline is not None:
+        pipeline.close()
+
+    out.abort()
+    visa.instrumentation_dump(out.output['full_path'])
 
     gui.bottom_bar.progress_bar_set(0)
-    button_dict['stop'].toggle_state()
+    button_dict['stop'].set_state(0)
 
     canvas.port_reset()
 
@@ -331,12 +515,24 @@ def on_button_connect() -> None:
             gui.tab_hardware.set_indicator(i, 'Resource not found.', 'red')
 
 
+def on_button_refresh_ranges() -> None:
+    """Queries the VNA parameter ranges again instead of using the cached ones."""
+    if vna is None:
+        gui.bottom_bar.message_display('VNA is not connected.', 'red')
+        return
+
+    vna.refresh_parameter_ranges()
+    gui.bottom_bar.message_display('VNA parameter ranges refreshed.', 'green')
+
+
 def update_progress_bar() -> None:
-    if len(pos_list) == 0:
+    """Progress is the predicted fraction of the scan time completed,
+    so sparse pair lists advance the bar at the rate they are measured."""
+    if engine is None:
         return
 
     try:
-        gui.bottom_bar.progress_bar_set(pos_index / len(pos_list))
+        gui.bottom_bar.progress_bar_set(engine.progress)
     except tk.TclError:
         pass
 
@@ -378,13 +574,24 @@ def format_meta_data(s_parameter: str, posx: float = 0, posy: float = 0) -> dict
         'date': str(date.today()),
         'time': (datetime.now()).strftime('%H:%M:%S'),
         'description': input_dict['description'].value,
-        'rotation': input_dict['rotation'].value
+        'rotation': input_dict['rotation'].value,
+        # Mirrored pairs are not measured, see port_pairs
+        'reciprocity': port_pairs.reciprocity_key(input_dict['reciprocity'].value),
+        'mirror_s_parameters': dataset.MIRROR_S_PARAMETERS,
+        'port_mask': pair_mask,
+        # 'per port' reflections are keyed 'p<port>', see port_pairs
+        'reflection': input_dict['reflection'].value.lower(),
+        'port_pairs': [list(pair) for pair in pair_list],
+        # Significant digits of the values, see out.precision
+        'precision': out.precision_meta(),
+        # Largest difference of the VNA's axis from the entered one, None if not verified
+        'freq_axis_error': vna.freq_axis_error
     }
+    out_dict.update(segment.meta_data(vna.segments))
     return out_dict
 
 
 def _debug_play_graphics() -> None:
-    import time
     update_ports()
     update_progress_bar()
     time.sleep(0.25)
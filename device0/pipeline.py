@@ -0,0 +1,188 @@
+"""
+Algae ~ Automated Target Positioning System
+Electromagnetic Imaging Lab, University of Manitoba
+
+Overlaps the stages of the device0 scan loop.
+
+Once a sweep is done its traces stay in VNA memory, so the switches
+can be set and debounced for the next port pair while the traces are
+read out. Parsing and writing to the output files are done on a
+separate thread, fed through a bounded queue, so the next sweep can
+start before the last one has been written.
+
+Author: Noah Stieler, 2023
+"""
+
+import queue
+import threading
+import time
+
+import numpy
+
+import out
+from .imaging import VNA, Switches
+
+
+class ScanPipeline:
+    # False runs every stage one after another on the calling thread,
+    # the same as the original scan loop, for comparison.
+    overlap = True
+
+    # Sweeps that can be waiting to be parsed and written
+    queue_size = 4
+
+    def __init__(self, vna: VNA, switches: Switches):
+        self.vna = vna
+        self.switches = switches
+
+        self._queue = queue.Queue(maxsize=ScanPipeline.queue_size)
+        self._error = None
+
+        self._switch_thread = None
+        self._switch_pair = None
+        self._switch_error = None
+
+        # Seconds spent in each stage, summed over the scan
+        self.stage_time = {'switch': 0.0, 'sweep': 0.0, 'read': 0.0, 'write': 0.0}
+        self.pair_count = 0
+        self._time_start = None
+        self._time_stop = None
+
+        self._worker = None
+        if ScanPipeline.overlap:
+            self._worker = threading.Thread(target=self._write_loop, daemon=True)
+            self._worker.start()
+
+    def measure(self, tran: int, refl: int, reads: dict, next_pair: tuple, commit: dict = None) -> None:
+        """Measures one port pair. reads maps each s-parameter to read to its
+        output key, see port_pairs.steps(). next_pair is the (tran, refl) pair
+        that will be measured after this one, or None. commit is appended to
+        the journal once the pair is written, see out.journal_commit().
+        Raises any error from parsing or writing a previous pair."""
+        if self._time_start is None:
+            self._time_start = time.perf_counter()
+        self._raise_error()
+
+        self._wait_switch(tran, refl)
+
+        time_start = time.perf_counter()
+        self.vna.start_sweep().wait()
+        self.stage_time['sweep'] += time.perf_counter() - time_start
+
+        # Traces are in VNA memory, the path for the next pair can be set
+        if ScanPipeline.overlap and next_pair is not None:
+            self._start_switch(*next_pair)
+
+        time_start = time.perf_counter()
+        output = self.vna.read_traces(list(reads))
+        self.stage_time['read'] += time.perf_counter() - time_start
+
+        if ScanPipeline.overlap:
+            # Binary trace buffers are reused by the next read
+            for s_parameter in output:
+                if isinstance(output[s_parameter], numpy.ndarray):
+                    output[s_parameter] = output[s_parameter].copy()
+            self._queue.put((reads, output, commit))
+        else:
+            self._write(reads, output, commit)
+
+        self.pair_count += 1
+        self._time_stop = time.perf_counter()
+
+    def flush(self) -> None:
+        """Blocks until every measured pair has been written,
+        raises any error from parsing or writing."""
+        if self._worker is not None:
+            self._queue.join()
+        self._time_stop = time.perf_counter()
+        self._raise_error()
+
+    def close(self) -> None:
+        """Writes any remaining pairs and stops the writer thread.
+        Errors are discarded as the scan is over."""
+        if self._switch_thread is not None:
+            self._switch_thread.join()
+            self._switch_thread = None
+
+        if self._worker is not None:
+            self._queue.join()
+            self._queue.put(None)
+            self._worker.join()
+            self._worker = None
+
+    def summary(self) -> str:
+        """Returns the measured pairs per second, and the rate if every
+        stage had run one after another."""
+        if self.pair_count == 0 or self._time_stop is None:
+            return 'No pairs measured.'
+
+        elapsed = self._time_stop - self._time_start
+        serial = sum(self.stage_time.values())
+        rate = self.pair_count / elapsed
+        rate_serial = self.pair_count / serial if serial > 0 else rate
+        return f'{rate:.2f} pairs/s, serial {rate_serial:.2f} pairs/s ' \
+               f'({rate - rate_serial:+.2f} pairs/s)'
+
+    def _wait_switch(self, tran: int, refl: int) -> None:
+        """Makes sure the switches are set to the pair, either by an earlier
+        call to _start_switch() or by setting them now."""
+        if self._switch_thread is not None:
+            self._switch_thread.join()
+            self._switch_thread = None
+            if self._switch_error is not None:
+                error, self._switch_error = self._switch_error, None
+                raise error
+            if self._switch_pair == (tran, refl):
+                return
+
+        self._set_switches(tran, refl)
+
+    def _start_switch(self, tran: int, refl: int) -> None:
+        self._switch_pair = (tran, refl)
+        self._switch_thread = threading.Thread(target=self._set_switches_thread,
+                                               args=(tran, refl), daemon=True)
+        self._switch_thread.start()
+
+    def _set_switches_thread(self, tran: int, refl: int) -> None:
+        try:
+            self._set_switches(tran, refl)
+        except Exception as e:  # Raised on the scan thread by _wait_switch()
+            self._switch_error = e
+
+    def _set_switches(self, tran: int, refl: int) -> None:
+        time_start = time.perf_counter()
+        self.switches.set_tran(tran)
+        self.switches.set_refl(refl)
+        self.stage_time['switch'] += time.perf_counter() - time_start
+
+    def _write_loop(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                return
+
+            try:
+                # Once an error occurs the scan is aborted, skip the rest
+                if self._error is None:
+                    self._write(*item)
+            except Exception as e:  # Raised on the scan thread by measure() or flush()
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _write(self, reads: dict, output: dict, commit: dict) -> None:
+        time_start = time.perf_counter()
+        output = self.vna.format_output(output)
+        for s_parameter in reads:
+            out.out_file_data_write(s_parameter, reads[s_parameter],
+                                    output[s_parameter][0],
+                                    output[s_parameter][1])
+        if commit is not None:
+            out.journal_commit(commit)
+        self.stage_time['write'] += time.perf_counter() - time_start
+
+    def _raise_error(self) -> None:
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
@@ -0,0 +1,64 @@
+"""
+Algae ~ Automated Target Positioning System
+Electromagnetic Imaging Lab, University of Manitoba
+
+Compiles a device0 scan into an acquisition plan, see engine.
+
+Steps:
+    move            moves the CNC to args['pos']
+    open_position   creates the position's folder and output files
+    reopen_position reopens the output files of a resumed position, see journal
+    measure         sweeps and writes one port pair, see ScanPipeline.measure()
+    close_position  waits for the position's data to be parsed, closes the files
+    finish          waits for the output to be written to disk, last step of the plan
+
+Pairs are measured in the order planned by port_pairs, which groups
+them to reduce relay actuations, and each measure step carries the
+pair after it so the switches can be set ahead of time.
+A resumed scan skips the positions and pairs already written.
+
+Author: Noah Stieler, 2023
+"""
+
+from engine import Step
+
+
+def compile_plan(positions: list, step_list: list, home=None, sweep_estimate: float = 0.0,
+                 resume: dict = None) -> list:
+    """Returns the steps that scan each position with the sweeps of step_list,
+    see port_pairs.steps(). If home is given the CNC moves to each position
+    and then to home at the end, otherwise the target is not moved.
+    sweep_estimate is the predicted seconds per measure step.
+    resume is where to continue an interrupted scan, see journal.resume_point()."""
+    if resume is None:
+        resume = {'pos_index': 0, 'pairs': 0}
+
+    plan = []
+    for pos_index, pos in enumerate(positions):
+        if pos_index < resume['pos_index']:
+            continue
+        first_pair = resume['pairs'] if pos_index == resume['pos_index'] else 0
+
+        if home is not None:
+            plan.append(Step('move', {'pos': pos}))
+        if first_pair == 0:
+            plan.append(Step('open_position', {'pos_index': pos_index, 'pos': pos}))
+        else:
+            plan.append(Step('reopen_position', {'pos_index': pos_index, 'pos': pos, 'pairs': first_pair,
+                                                 'offsets': resume['offsets'],
+                                                 'entries': resume['entries']}))
+
+        for i in range(first_pair, len(step_list)):
+            tran, refl, reads = step_list[i]
+            next_pair = step_list[i + 1][:2] if i + 1 < len(step_list) else None
+            plan.append(Step('measure', {'tran': tran, 'refl': refl, 'reads': reads,
+                                         'next_pair': next_pair,
+                                         'pos_index': pos_index, 'pair': i}, sweep_estimate))
+
+        plan.append(Step('close_position', {'pos_index': pos_index}))
+
+    if home is not None:
+        plan.append(Step('move', {'pos': home}))
+    plan.append(Step('finish'))
+
+    return plan
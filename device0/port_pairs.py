@@ -0,0 +1,233 @@
+"""
+Algae ~ Automated Target Positioning System
+Electromagnetic Imaging Lab, University of Manitoba
+
+Generates the list of trans/refl port pairs visited at each position.
+
+Masks:
+    All             every pair of distinct ports
+    Neighbours      pairs within k ports of each other around the ring
+    Opposite half   pairs at least a quarter of the ring apart
+    List            pairs read from a .csv file, or typed as a list,
+                    one 'tran,refl' pair per line or separated by ';'
+
+Reflection:
+    In 'per port' mode S11 and S22 are read once per physical port
+    instead of once per pair. S11 is stored for each port used as a
+    tran port and S22 for each port used as a refl port, under the key
+    'p<port>'. Transmission parameters are read for every pair under
+    the key 't<tran>r<refl>'.
+
+Reciprocity:
+    For passive, reciprocal targets the pair (r, t) carries the same
+    information as (t, r) with the VNA ports swapped, so only one triangle
+    of the port pair matrix needs to be measured. The mirrored entries are
+    not written. The output metadata records 'reciprocity', and in
+    'mirror_s_parameters' the s-parameter each mirrored entry is derived
+    from, dataset.MIRROR_S_PARAMETERS:
+        S11(r, t) = S22(t, r)    S21(r, t) = S12(t, r)
+        S12(r, t) = S21(t, r)    S22(r, t) = S11(t, r)
+    Each s-parameter read per pair needs its mirror selected as well.
+
+Author: Noah Stieler, 2023
+"""
+
+import os.path
+
+import dataset
+from gui.parameter import input_dict
+from .imaging import Switches, VNA
+
+MASK_OPTIONS = ('All', 'Neighbours', 'Opposite half', 'List')
+RECIPROCITY_OPTIONS = ('Off', 'Upper (t<r)', 'Lower (t>r)')
+REFLECTION_OPTIONS = ('Per pair', 'Per port')
+
+PORT_COUNT = Switches.PORT_MAX - Switches.PORT_MIN + 1
+
+
+def dense(port_min: int = Switches.PORT_MIN, port_max: int = Switches.PORT_MAX) -> list:
+    """Every ordered pair of distinct ports, in the order the original
+    scan loop visited them."""
+    pairs = []
+    for tran in range(port_min, port_max + 1):
+        for refl in range(port_min, port_max + 1):
+            if tran != refl:
+                pairs.append((tran, refl))
+    return pairs
+
+
+def reciprocal(pairs: list, reciprocity: str) -> list:
+    """Keeps one triangle of the pairs, reciprocity is 'upper' for t<r,
+    'lower' for t>r, or 'off' to keep every pair."""
+    if reciprocity == 'upper':
+        return [pair for pair in pairs if pair[0] < pair[1]]
+    if reciprocity == 'lower':
+        return [pair for pair in pairs if pair[0] > pair[1]]
+    return list(pairs)
+
+
+def unmirrored(s_params: list, reflection: str) -> list:
+    """Returns the s-parameters of s_params that reciprocity can not derive
+    for the skipped pairs, as their mirror in dataset.MIRROR_S_PARAMETERS is
+    not measured. 'per port' reflections are not stored per pair."""
+    missing = []
+    for s_parameter in s_params:
+        if reflection == 'per port' and s_parameter in ('S11', 'S22'):
+            continue
+        if dataset.MIRROR_S_PARAMETERS[s_parameter] not in s_params:
+            missing.append(s_parameter)
+    return missing
+
+
+def reciprocity_key(option: str) -> str:
+    """Converts a RECIPROCITY_OPTIONS entry to 'off', 'upper' or 'lower'."""
+    return option.split(' ')[0].lower()
+
+
+def ring_distance(port_a: int, port_b: int) -> int:
+    """Number of ports between two ports going the short way around the ring."""
+    distance = abs(port_a - port_b) % PORT_COUNT
+    return min(distance, PORT_COUNT - distance)
+
+
+def neighbours(pairs: list, k: int) -> list:
+    """Keeps pairs within k ports of each other."""
+    return [pair for pair in pairs if ring_distance(*pair) <= k]
+
+
+def opposite_half(pairs: list) -> list:
+    """Keeps pairs where the refl port lies in the half of the ring
+    opposite the tran port."""
+    return [pair for pair in pairs if ring_distance(*pair) >= PORT_COUNT // 4]
+
+
+def parse(text: str) -> list:
+    """Parses 'tran,refl' pairs separated by new lines or semicolons.
+    Lines that do not start with a number, ex. a csv header, are skipped.
+    Raises ValueError for invalid ports."""
+    pairs = []
+    for entry in text.replace(';', '\n').splitlines():
+        values = [value.strip() for value in entry.split(',')]
+        if len(values) < 2 or not values[0].isdigit():
+            continue
+
+        tran, refl = int(values[0]), int(values[1])
+        for port in (tran, refl):
+            if not Switches.PORT_MIN <= port <= Switches.PORT_MAX:
+                raise ValueError(f'Port {port} is out of range.')
+        if tran == refl:
+            raise ValueError(f'Pair {tran},{refl} uses the same port twice.')
+        if (tran, refl) not in pairs:
+            pairs.append((tran, refl))
+    return pairs
+
+
+def load(text: str) -> list:
+    """Loads pairs from a .csv file if text is a path, otherwise parses text as a list."""
+    if os.path.isfile(text):
+        with open(text, 'r', encoding='utf-8') as file:
+            return parse(file.read())
+    return parse(text)
+
+
+def order(pairs: list) -> list:
+    """Orders pairs to reduce relay actuations. The switches skip setting a port
+    that is already set, so pairs are grouped by whichever of the tran or refl
+    port takes fewer distinct values, and that switch changes once per group."""
+    trans = set(pair[0] for pair in pairs)
+    refls = set(pair[1] for pair in pairs)
+    if len(trans) <= len(refls):
+        return sorted(pairs)
+    return sorted(pairs, key=lambda pair: (pair[1], pair[0]))
+
+
+def from_input() -> tuple:
+    """Builds the ordered pair list from the gui parameters.
+    Returns the pairs and a description of the mask.
+    Raises ValueError if the parameters do not give a valid list."""
+    mask = input_dict['port_mask'].value.lower()
+    pairs = dense()
+
+    if mask == 'neighbours':
+        k = input_dict['mask_k'].value
+        if not (1 <= k <= PORT_COUNT // 2 and k == int(k)):
+            raise ValueError(f'Neighbour range must be a whole number from 1 to {PORT_COUNT // 2}.')
+        pairs = neighbours(pairs, int(k))
+        mask = f'neighbours {int(k)}'
+    elif mask == 'opposite half':
+        pairs = opposite_half(pairs)
+    elif mask == 'list':
+        pairs = load(input_dict['mask_list'].value)
+
+    reciprocity = reciprocity_key(input_dict['reciprocity'].value)
+    pairs = reciprocal(pairs, reciprocity)
+    if len(pairs) == 0:
+        raise ValueError('No port pairs selected.')
+
+    if reciprocity != 'off':
+        s_params = [sp for sp in VNA.s_params if sp in input_dict and input_dict[sp].value == 1]
+        missing = unmirrored(s_params, input_dict['reflection'].value.lower())
+        if len(missing) > 0:
+            raise ValueError('Reciprocity derives ' + ', '.join(missing) + ' of the skipped pairs from ' +
+                             ', '.join(dataset.MIRROR_S_PARAMETERS[sp] for sp in missing) +
+                             ', which must be selected too.')
+
+    return order(pairs), mask
+
+
+def pair_key(tran: int, refl: int) -> str:
+    return f't{tran}r{refl}'
+
+
+def port_key(port: int) -> str:
+    return f'p{port}'
+
+
+def steps(pairs: list, s_params: list, reflection: str) -> list:
+    """Plans the sweeps of one position. Returns a list of (tran, refl, reads)
+    where reads maps each s-parameter to read from the sweep to its output key.
+    reflection is 'per pair' or 'per port', see the module docstring.
+    Pairs with nothing to read are not swept."""
+    if reflection != 'per port':
+        return [(tran, refl, {sp: pair_key(tran, refl) for sp in s_params}) for tran, refl in pairs]
+
+    # Port whose reflection each reflection parameter measures
+    reflection_port = {'S11': 0, 'S22': 1}
+    measured = {sp: set() for sp in reflection_port}
+
+    def new_reads(pair: tuple) -> int:
+        return sum(1 for sp in s_params if sp in reflection_port
+                   and pair[reflection_port[sp]] not in measured[sp])
+
+    # With only reflections selected, not every pair has to be swept.
+    # Pairs that measure the most new ports are taken first.
+    if all(sp in reflection_port for sp in s_params):
+        remaining = list(pairs)
+        pairs = []
+        while len(remaining) > 0:
+            pair = max(remaining, key=new_reads)
+            if new_reads(pair) == 0:
+                break
+            remaining.remove(pair)
+            pairs.append(pair)
+            for sp in s_params:
+                measured[sp].add(pair[reflection_port[sp]])
+        pairs = order(pairs)
+        measured = {sp: set() for sp in reflection_port}
+
+    step_list = []
+    for pair in pairs:
+        reads = {}
+        for s_parameter in s_params:
+            if s_parameter not in reflection_port:
+                reads[s_parameter] = pair_key(*pair)
+                continue
+
+            port = pair[reflection_port[s_parameter]]
+            if port not in measured[s_parameter]:
+                measured[s_parameter].add(port)
+                reads[s_parameter] = port_key(port)
+
+        if len(reads) > 0:
+            step_list.append((pair[0], pair[1], reads))
+    return step_list
@@ -9,6 +9,7 @@ Author: Noah Stieler, 2023
 
 from datetime import date, datetime
 
+import segment
 from .imaging import VNA
 from gui.parameter import input_dict
 
@@ -27,4 +28,8 @@ def format_meta_data(vna: VNA, description: str) -> dict:
         'time': (datetime.now()).strftime('%H:%M:%S'),
         'description': description
     }
+    out_dict.update(segment.meta_data(vna.segments))
+    if vna.segments is not None:
+        # Non-uniform frequency axis of the .s24p files
+        out_dict['freq'] = segment.freq_axis(vna.segments).tolist()
     return out_dict
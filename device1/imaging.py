@@ -12,15 +12,24 @@ Hardware:
 Author: Noah Stieler, 2023
 """
 import threading
+
+import numpy
+
 import gui
-from visa import VisaResource
+import segment
+from visa import VisaResource, Operation
 from gui.parameter import input_dict
 
 
 class VNA(VisaResource):
     PORT_RANGE = (1, 24)
+    port_count = PORT_RANGE[1] - PORT_RANGE[0] + 1
     port_list = ''
 
+    # 'save' has the VNA write each .s24p to disk itself, 'query' reads the
+    # SNP data over the session as REAL,64 blocks for the host to write, see read_snp()
+    snp_transfer = 'save'
+
     def __init__(self, address: str):
         super().__init__(address)
 
@@ -31,7 +40,11 @@ class VNA(VisaResource):
         self.p_ranges = {}
         self.calibration = ''
         self.calibration_list = []
-        self._trigger_set = False
+
+        # Set once the VNA has been preset, see initialize()
+        self._state_known = False
+        # Segments of the current run, None for a linear sweep
+        self.segments = None
 
         self._set_parameter_ranges()
 
@@ -43,19 +56,27 @@ class VNA(VisaResource):
         and input parameters."""
         self.resource.timeout = 60 * 1000  # Time in milliseconds
 
-        self.name = self.resource.query('*IDN?')
+        self.name = self.query('*IDN?')
 
-        if self.calibration == '':
+        # A preset is only needed to bring the VNA from an unknown state to a known one,
+        # calibrate() also presets. After that the shadow tracks the state.
+        if self.calibration == '' and not self._state_known:
             self.write('SYSTEM:PRESET')
+            self._state_known = True
 
         # Trigger set up
-        # Doing this every scan causes large slowdowns
-        if not self._trigger_set:
+        # Doing this every scan causes large slowdowns, so it is only
+        # sent when the settings are not already applied
+        trigger_settings = (
+            ('TRIGGER:SEQUENCE:SOURCE', 'MANUAL'),
+            ('INITIATE:CONTINUOUS', 'OFF'),
+            ('SENSE1:SWEEP:MODE', 'CONTINUOUS')
+        )
+        if any(self.shadow.get(header) != value for header, value in trigger_settings):
             def cmd():
-                self.write('TRIGGER:SEQUENCE:SOURCE MANUAL')
-                self.write('INITIATE:CONTINUOUS OFF')
-                self.write('SENSE1:SWEEP:MODE CONTINUOUS')
-                self.write('SENSE1:SWEEP:TYPE LINEAR')
+                with self.batch():
+                    for header, value in trigger_settings:
+                        self.set(header, value)
                 self.query('*OPC?')
 
             t = threading.Thread(target=cmd)
@@ -64,15 +85,48 @@ class VNA(VisaResource):
             gui.bottom_bar.message_display('Setting up measurement...', 'blue')
             gui.core.update_during_thread_wait(t)
 
-            self._trigger_set = True
-
         # Parameters
-        self.write('SENSE1:SWEEP:POINTS ' + str(input_dict['num_points'].value))
-        self.write('SENSE1:BANDWIDTH ' + str(input_dict['ifbw'].value))
-        self.write('SENSE1:FREQUENCY:START ' + str(input_dict['freq_start'].value))
-        self.write('SENSE1:FREQUENCY:STOP ' + str(input_dict['freq_stop'].value))
+        self.segments = segment.from_input()
+        with self.batch():
+            if self.segments is None:
+                self.set('SENSE1:SWEEP:TYPE', 'LINEAR')
+                self.set('SENSE1:SWEEP:POINTS', input_dict['num_points'].value)
+                self.set('SENSE1:BANDWIDTH', input_dict['ifbw'].value)
+                self.set('SENSE1:FREQUENCY:START', input_dict['freq_start'].value)
+                self.set('SENSE1:FREQUENCY:STOP', input_dict['freq_stop'].value)
+            else:
+                segment.apply(self, self.segments)
+
+            if self.snp_transfer == 'query':
+                # Swapped byte order is little endian, native to the controller
+                self.set('FORMAT:BORDER', 'SWAPPED')
+                self.set('FORMAT:DATA', 'REAL,64')
+                self.set('MMEMORY:STORE:TRACE:FORMAT:SNP', 'RI')
+
+    def num_points(self) -> int:
+        if self.segments is None:
+            return input_dict['num_points'].value
+        return sum(seg.points for seg in self.segments)
+
+    def predict_sweep_time(self) -> float:
+        """Rough prediction of the seconds one sweep takes, points over IF bandwidth.
+        Only used until the first sweep has been timed."""
+        if self.segments is None:
+            return input_dict['num_points'].value / input_dict['ifbw'].value
+        return sum(seg.points / seg.ifbw for seg in self.segments)
+
+    def refresh_parameter_ranges(self) -> None:
+        """Queries the parameter ranges from the VNA, replacing the cached values."""
+        self._set_parameter_ranges(refresh=True)
+
+    def _set_parameter_ranges(self, refresh: bool = False) -> None:
+        """Ranges are cached on disk per instrument identity, unless refresh is set."""
+        if not refresh:
+            cached = self.cache_load('p_ranges')
+            if cached is not None:
+                self.p_ranges = {key: tuple(value) for key, value in cached.items()}
+                return
 
-    def _set_parameter_ranges(self) -> None:
         self.p_ranges['num_points'] = (
             int(self.query('SENSE1:SWEEP:POINTS? MIN')),
             int(self.query('SENSE1:SWEEP:POINTS? MAX'))
@@ -90,6 +144,8 @@ class VNA(VisaResource):
             float(self.query('SENSE1:FREQUENCY:STOP? MAX'))
         )
 
+        self.cache_store('p_ranges', self.p_ranges)
+
     def set_calibration_list(self) -> None:
         """Query list of VNA calibrations and parse them."""
         cal = self.query('CSET:CATALOG?')
@@ -101,23 +157,42 @@ class VNA(VisaResource):
     def calibrate(self) -> None:
         self.resource.timeout = 60 * 1000  # Time in milliseconds
         self.write('SYSTEM:PRESET')
-        self.write('SENSE1:CORRECTION:CSET:ACTIVATE \'' + self.calibration + '\', 1')
-        self.query('*OPC?')
+        self.start_operation('SENSE1:CORRECTION:CSET:ACTIVATE \'' + self.calibration + '\', 1').wait()
+        self._state_known = True
 
     def fire(self) -> None:
-        self.write('INITIATE1:IMMEDIATE')
-        self.query('*OPC?')
+        self.start_sweep().wait()
+
+    def start_sweep(self) -> Operation:
+        """Triggers a sweep, the returned handle reports when it is done."""
+        return self.start_operation('INITIATE1:IMMEDIATE')
 
     def save_snp(self, path: str, file_num: str) -> None:
         """Writes VNA data to a .s24p at path"""
+        self.start_save_snp(path, file_num).wait()
+
+    def start_save_snp(self, path: str, file_num: str) -> Operation:
+        """Starts writing VNA data to a .s24p at path,
+        the returned handle reports when it is done."""
         # Manual wants this for .snp save command
-        self.write('SENSE1:CORRECTION:CACHE:MODE 1')
+        self.set('SENSE1:CORRECTION:CACHE:MODE', 1)
 
         cmd = 'CALCULATE1:MEASURE1:DATA:SNP:PORTS:SAVE'
         args = f' \'{VNA.port_list}\', \'{path}\\output_{file_num}.s24p\', fast'
-        self.write(cmd + args)
-
-        self.query('*OPC?')
+        return self.start_operation(cmd + args)
+
+    def read_snp(self) -> numpy.ndarray:
+        """Queries the SNP data of the last sweep, see initialize(). Returns rows of
+        the frequency and the real and imaginary parts of each parameter, the
+        layout of touchstone.parse()."""
+        width = 1 + 2 * VNA.port_count ** 2
+        # A new buffer each time, the last one may still be queued for writing
+        buffer = numpy.empty(width * self.num_points())
+        self.query_binary(f'CALCULATE1:MEASURE1:DATA:SNP:PORTS? \'{VNA.port_list}\'', buffer)
+
+        # The response is the frequencies, then each parameter's real and
+        # imaginary parts, a block of every point for each
+        return buffer.reshape(width, -1).T
 
     @staticmethod
     def set_port_list() -> None:
@@ -10,6 +10,7 @@ Author: Noah Stieler, 2023
 import os.path
 
 import gui
+import segment
 from gui.parameter import input_dict
 from .imaging import VNA
 from pygrbl import PyGRBLMachine
@@ -19,12 +20,25 @@ def input_validate(vna: VNA, grbl_machine: PyGRBLMachine) -> bool:
     """Checks all user input for errors/invalid entries"""
     check_list = ['num_points', 'ifbw', 'freq_start', 'freq_stop']
 
+    try:
+        segments = segment.from_input()
+    except (ValueError, OSError) as e:
+        gui.bottom_bar.message_display(f'Invalid segment table: {e}', 'red')
+        return False
+    if segments is not None:
+        # Frequencies, points and IF bandwidth are taken from the segment table
+        check_list = []
+        error = segment.validate(segments, vna.p_ranges)
+        if error != '':
+            gui.bottom_bar.message_display(error, 'red')
+            return False
+
     for item in check_list:
         if not (vna.p_ranges[item][0] <= input_dict[item].value <= vna.p_ranges[item][1]):
             gui.bottom_bar.message_display('\"' + input_dict[item].name + f'\" must be in range: ' +
                                            str(vna.p_ranges[item]), 'red')
             return False
-    if not (input_dict['freq_stop'].value > input_dict['freq_start'].value):
+    if segments is None and not (input_dict['freq_stop'].value > input_dict['freq_start'].value):
         gui.bottom_bar.message_display('Start frequency must be less than stop frequency.', 'red')
         return False
     elif not os.path.isdir(input_dict['output_dir'].value):
@@ -12,18 +12,26 @@ Hardware:
 
 Author: Noah Stieler, 2023
 """
+import time
+import tkinter as tk
+from tkinter import filedialog
 import serial.tools.list_ports
 
 import pygrbl
 
 from gui.parameter import input_dict
 from gui.button import button_dict
+import journal
 import out
+import segment
+import visa
 from display_resources import display_resources
 from .data_handler import format_meta_data
 from .gui import calibration, position
 from .imaging import *
 from .input_validate import input_validate
+from .plan import compile_plan
+from engine import Engine, Step, format_duration
 from . import pygrbl_handler
 
 """
@@ -36,6 +44,14 @@ pygrbl.core.BAUD_RATE = 9600
 
 VISA_ADDRESS_VNA = 'TCPIP0::Localhost::hislip0::INSTR'
 
+# 'VNA disk' has the VNA save each .s24p, the others query the data
+# and write it on the host as a .s24p or a binary .npy, see out.snp_write()
+SNP_SAVE_OPTIONS = ('VNA disk', 'Host Touchstone', 'Host binary')
+
+# Seconds between gui refreshes during a scan, so the gui
+# does not compete with the engine thread
+OBSERVE_INTERVAL = 0.02
+
 # Defaults for this device
 WORKING_AREA_RADIUS = 50
 WORKING_AREA_HEIGHT = 100
@@ -45,15 +61,16 @@ pos_list = []
 pos_index = 0
 
 state = 'idle'
-abort = False
-
 vna = None
 grbl_machine = None
 
+# Runs the compiled scan, the gui observes it up to observed_index
+engine = None
+observed_index = 0
+
 
 def main() -> None:
     global state
-    global abort
     global pos_list, pos_index
 
     gui.core.create_gui(position.custom_position_box)
@@ -63,11 +80,16 @@ def main() -> None:
     input_dict['ifbw'] = gui.tab_home.add_parameter_num('IF bandwidth (Hz)')
     input_dict['freq_start'] = gui.tab_home.add_parameter_num('Start frequency (Hz)')
     input_dict['freq_stop'] = gui.tab_home.add_parameter_num('Stop frequency (Hz)')
+    input_dict['sweep_type'] = gui.tab_home.add_parameter_option('Sweep type', segment.SWEEP_OPTIONS)
+    input_dict['segment_table'] = gui.tab_home.add_parameter_string('Segment table (.csv or list)')
+    input_dict['snp_save'] = gui.tab_home.add_parameter_option('SNP save', SNP_SAVE_OPTIONS)
 
     # Define button functionality
     button_dict['connect'].command(on_button_connect)
     button_dict['disp_res'].command(display_resources)
+    button_dict['refresh_ranges'].command(on_button_refresh_ranges)
     button_dict['run'].command(on_button_run)
+    button_dict['resume'].command(on_button_resume)
     button_dict['stop'].command(abort_scan)
 
     # Set up hardware gui
@@ -100,44 +122,83 @@ def main() -> None:
         if state == 'idle':
             gui.parameter.update()
         if state == 'scan':
-            t = threading.Thread(target=vna.fire)
-            t.start()
+            observe_scan()
+            time.sleep(OBSERVE_INTERVAL)
+
+
+def observe_scan() -> None:
+    """Follows the engine from the gui thread,
+    acquisition itself never waits for the gui."""
+    global observed_index, pos_index, state
+
+    index = engine.index
+    if index == observed_index and not engine.done:
+        return
+    observed_index = index
+
+    try:
+        gui.bottom_bar.progress_bar_set(engine.progress)
+    except tk.TclError:
+        pass
+
+    if not engine.done:
+        pos_index = engine.plan[index].args.get('pos_index', pos_index)
+        if not engine.stopping:
+            gui.bottom_bar.message_display(
+                f'Scanning position {pos_index + 1}/{max(len(pos_list), 1)}, '
+                f'{format_duration(engine.remaining_time())} remaining.', 'blue')
+        return
+
+    if engine.error is not None:
+        if isinstance(engine.error, pygrbl.PyGRBLException):
+            pygrbl_handler.pygrbl_exception(engine.error)
+        else:
+            gui.bottom_bar.message_display(f'Scan failed: {engine.error}', 'red')
+        abort_scan()
+        return
+    if engine.aborted:
+        abort_scan()
+        return
+
+    button_dict['stop'].set_state(0)
+    gui.bottom_bar.progress_bar_set(0)
+    summary = [out.snp_summary()]
+    if engine.step_count.get('save', 0) > 0:
+        summary.insert(0, f'save: {engine.step_time["save"] / engine.step_count["save"]:.2f} s/position')
+    gui.bottom_bar.message_display(f'Scan saved in {format_duration(engine.elapsed)}' +
+                                   ''.join(', ' + item for item in summary if item) + '.', 'green')
+    visa.instrumentation_dump(out.output['full_path'])
+    state = 'idle'
+
 
-            gui.bottom_bar.message_display('Scanning...', 'blue')
+"""
+    Plan step handlers, run on the engine thread, see plan.py
+"""
 
-            gui.core.update_during_thread_wait(t)
 
-            gui.bottom_bar.message_display('Scan complete.', 'blue')
-            vna.save_snp(out.output['full_path'], pos_index)
-            gui.bottom_bar.message_display('Scan saved.', 'green')
+def _step_move(step: Step) -> None:
+    grbl_machine.set_position(step.args['pos'])
 
-            state = 'next_pos'
 
-        if state == 'next_pos':
+def _step_sweep(step: Step) -> None:
+    vna.start_sweep().wait()
 
-            # All positions visited
-            if pos_index + 1 >= len(pos_list):
-                if input_dict['cnc_enable'].value:
-                    try:
-                        grbl_machine.set_position(pygrbl.Point(0, 0, 0))
-                    except pygrbl.PyGRBLException as e:
-                        pygrbl_handler.pygrbl_exception(e)
-                        abort_scan()
-                button_dict['stop'].toggle_state()
-                state = 'idle'
 
-            # Go to next position
-            else:
-                pos_index += 1
-                pos = pos_list[pos_index]
+def _step_save(step: Step) -> None:
+    time_start = time.perf_counter()
+    if vna.snp_transfer == 'query':
+        out.snp_write(step.args['pos_index'], vna.read_snp(), VNA.port_count)
+    else:
+        vna.start_save_snp(out.output['full_path'], step.args['pos_index']).wait()
+    if visa.VisaResource.instrumented:
+        # Time the scan is held up per position, for comparing the SNP save options
+        visa.record('host:save_snp', time.perf_counter() - time_start)
+    out.journal_commit({'event': 'position', 'pos_index': step.args['pos_index']})
 
-                try:
-                    grbl_machine.set_position(pos)
-                except pygrbl.PyGRBLException as e:
-                    pygrbl_handler.pygrbl_exception(e)
-                    abort_scan()
 
-                state = 'scan'
+def _step_finish(step: Step) -> None:
+    out.journal_commit({'event': 'done'})
+    out.close()
 
 
 def on_button_run() -> None:
@@ -145,19 +206,67 @@ def on_button_run() -> None:
     Checks that hardware is connected and ready,
     that all user input is valid. Assuming no errors,
     state is changed to 'scan'."""
-    global abort
-    abort = False
+    if not scan_ready():
+        return
 
+    start_scan()
+
+
+def on_button_resume() -> None:
+    """Continues an interrupted scan, selected by its output directory,
+    after the last position recorded in its journal. The scan's settings
+    must not have been changed."""
+    if not scan_ready():
+        return
+
+    root = filedialog.askdirectory(initialdir=input_dict['output_dir'].value,
+                                   title='Select the output of the interrupted scan')
+    if not root:
+        return
+
+    records = journal.load(root)
+    if len(records) == 0 or records[0]['device'] != 'device1':
+        gui.bottom_bar.message_display('No scan journal in the selected directory.', 'red')
+        return
+    if journal.resume_point(records)['done']:
+        gui.bottom_bar.message_display('The scan is already complete.', 'red')
+        return
+
+    differ = journal.compare_inputs(records[0]['inputs'], input_dict)
+    if len(differ) > 0:
+        gui.bottom_bar.message_display('Settings differ from the interrupted scan: ' +
+                                       ', '.join(differ) + '.', 'red')
+        return
+
+    start_scan(root, records)
+
+
+def scan_ready() -> bool:
+    """Checks that hardware is connected and ready, and that all user input is valid."""
+    if state != 'idle':
+        gui.bottom_bar.message_display('A scan is still stopping.', 'red')
+        return False
     if vna is None:
         gui.bottom_bar.message_display('Hardware setup failed.', 'red')
-        return
+        return False
 
     valid = input_validate(vna, grbl_machine)
     if not valid:
-        return
+        return False
 
     gui.bottom_bar.message_clear()
+    return True
 
+
+def start_scan(resume_root: str = None, records: list = None) -> None:
+    """Sets up the hardware and output and starts the engine. If resume_root
+    is given the scan journaled in records is continued in that directory,
+    with the positions it was started with."""
+    visa.instrumentation_reset()
+    visa.instrumentation_enable(input_dict['log_timing'].value)
+
+    vna.snp_transfer = 'save' if input_dict['snp_save'].value == 'VNA disk' else 'query'
+    out.snp_format = 'binary' if input_dict['snp_save'].value == 'Host binary' else 'touchstone'
     vna.initialize()
 
     """Set up positioning"""
@@ -169,33 +278,60 @@ def on_button_run() -> None:
     pygrbl.set_chamber(chamber)
 
     global pos_list, pos_index
-    first_pos = pygrbl.Point(0, 0, 0)
     pos_index = 0
+    home = None
     if input_dict['cnc_enable'].value:
-        pos_list = pygrbl.load_csv(input_dict['pos_list_path'].value, 3)
-        first_pos = pos_list[0]
-        try:
-            grbl_machine.set_position(first_pos)
-        except pygrbl.PyGRBLException as e:
-            pygrbl_handler.pygrbl_exception(e)
-            abort_scan()
-            return
+        if resume_root is not None:
+            pos_list = [pygrbl.Point(*pos) for pos in records[0]['positions']]
+        else:
+            pos_list = pygrbl.load_csv(input_dict['pos_list_path'].value, 3)
+        positions = pos_list
+        home = pygrbl.Point(0, 0, 0)
     else:
         pos_list = []
+        positions = [pygrbl.Point(0, 0, 0)]
 
-    out.init_root(input_dict['output_dir'].value, input_dict['output_name'].value)
-    out.create_meta_file(format_meta_data(vna, input_dict['description'].value))
-
-    button_dict['stop'].toggle_state()
+    resume = 0
+    if resume_root is not None:
+        resume = journal.resume_point(records)['pos_index']
+        out.resume_root(resume_root, resume)
+        out.journal_open({'event': 'resume', 'pos_index': resume})
+    else:
+        out.init_root(input_dict['output_dir'].value, input_dict['output_name'].value)
+        out.create_meta_file(format_meta_data(vna, input_dict['description'].value))
+        out.journal_open(journal.start_record('device1', input_dict,
+                                              [[pos.x, pos.y, pos.z] for pos in positions]))
+
+    """Compile the scan and run it on the engine thread"""
+    global engine, observed_index
+    scan_plan = compile_plan(positions, home, vna.predict_sweep_time(), resume)
+    engine = Engine(scan_plan, {
+        'move': _step_move,
+        'sweep': _step_sweep,
+        'save': _step_save,
+        'finish': _step_finish
+    })
+    observed_index = 0
+    engine.start()
+
+    button_dict['stop'].set_state(1)
 
     global state
     state = 'scan'
 
 def abort_scan() -> None:
-    global abort
-    abort = True
+    """Stops the scan after the step in progress. The gui is not held up
+    waiting for it, observe_scan() calls this again once the engine has stopped."""
+    if engine is not None and not engine.done:
+        engine.abort()
+        button_dict['stop'].set_state(0)
+        gui.bottom_bar.message_display('Stopping after the current step...', 'blue')
+        return
+
+    out.abort()
 
-    button_dict['stop'].toggle_state()
+    visa.instrumentation_dump(out.output['full_path'])
+    button_dict['stop'].set_state(0)
 
     global state
     state = 'idle'
@@ -225,6 +361,16 @@ def on_button_connect() -> None:
         gui.tab_hardware.set_indicator(1, 'Resource not found.', 'red')
 
 
+def on_button_refresh_ranges() -> None:
+    """Queries the VNA parameter ranges again instead of using the cached ones."""
+    if vna is None:
+        gui.bottom_bar.message_display('VNA is not connected.', 'red')
+        return
+
+    vna.refresh_parameter_ranges()
+    gui.bottom_bar.message_display('VNA parameter ranges refreshed.', 'green')
+
+
 def on_apply_calib() -> None:
     """Stores the selected calibration and calibrates the VNA"""
     vna.calibration = calibration.get_selected()
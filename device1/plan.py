@@ -0,0 +1,37 @@
+"""
+Algae ~ Automated Target Positioning System
+Electromagnetic Imaging Lab, University of Manitoba
+
+Compiles a device1 scan into an acquisition plan, see engine.
+
+Steps:
+    move    moves the CNC to args['pos']
+    sweep   sweeps every port
+    save    saves the sweep of position args['pos_index'] to a .s24p file
+    finish  closes the journal, last step of the plan
+
+Author: Noah Stieler, 2023
+"""
+
+from engine import Step
+
+
+def compile_plan(positions: list, home=None, sweep_estimate: float = 0.0, resume: int = 0) -> list:
+    """Returns the steps that sweep and save each position. If home is given
+    the CNC moves to each position and then to home at the end, otherwise
+    the target is not moved. sweep_estimate is the predicted seconds per sweep.
+    Positions before resume are skipped, they were saved by an interrupted scan."""
+    plan = []
+    for pos_index, pos in enumerate(positions):
+        if pos_index < resume:
+            continue
+        if home is not None:
+            plan.append(Step('move', {'pos': pos}))
+        plan.append(Step('sweep', {'pos_index': pos_index}, sweep_estimate))
+        plan.append(Step('save', {'pos_index': pos_index}))
+
+    if home is not None:
+        plan.append(Step('move', {'pos': home}))
+    plan.append(Step('finish'))
+
+    return plan
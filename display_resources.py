@@ -12,11 +12,12 @@ import pyvisa as visa
 import serial.tools.list_ports
 
 import gui
+from visa import VisaResource
 
 
 def display_resources() -> None:
     """Lists available resources and creates a popup to display them."""
-    visa_resource_manager = visa.ResourceManager()
+    visa_resource_manager = VisaResource.get_manager()
     r_list = visa_resource_manager.list_resources()
     r_display = 'VISA:\n'
     for address in r_list:
@@ -0,0 +1,136 @@
+"""
+Algae ~ Automated Target Positioning System
+Electromagnetic Imaging Lab, University of Manitoba
+
+Runs a scan compiled ahead of time into an acquisition plan,
+a list of steps such as moves, sweeps and file boundaries.
+
+The plan is executed on its own thread, each step kind handled by a
+function supplied by the device. The gui only observes the engine,
+so redrawing does not slow down acquisition, and the plan can be
+inspected beforehand, ex. to predict how long the scan takes.
+
+Handlers run on the engine thread and must not touch tkinter.
+
+Author: Noah Stieler, 2023
+"""
+
+import threading
+import time
+from dataclasses import dataclass, field
+
+
+@dataclass
+class Step:
+    kind: str
+    args: dict = field(default_factory=dict)
+    # Predicted duration in seconds, used until a step of this kind has been timed
+    estimate: float = 0.0
+
+
+class Engine:
+    def __init__(self, plan: list, handlers: dict):
+        """handlers maps each step kind to a function taking the step."""
+        for step in plan:
+            if step.kind not in handlers:
+                raise ValueError(f'No handler for step kind \'{step.kind}\'.')
+
+        self.plan = plan
+        self.handlers = handlers
+
+        # Number of steps completed, steps before this index are done
+        self.index = 0
+        self.error = None
+        self.aborted = False
+
+        # Seconds spent on each step kind and the number of steps timed
+        self.step_time = {}
+        self.step_count = {}
+
+        self._abort = threading.Event()
+        self._done = threading.Event()
+        self._time_start = None
+        self._time_stop = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self) -> None:
+        self._time_start = time.perf_counter()
+        self._thread.start()
+
+    def abort(self) -> None:
+        """Stops the engine after the step in progress. Returns at once,
+        done is set once the engine has stopped."""
+        self._abort.set()
+
+    @property
+    def stopping(self) -> bool:
+        """True once abort() has been called."""
+        return self._abort.is_set()
+
+    @property
+    def done(self) -> bool:
+        """True once every step has run, or the engine stopped on an error or abort."""
+        return self._done.is_set()
+
+    @property
+    def current(self) -> Step:
+        """Step in progress, or None if the engine is not running one."""
+        if self.done or self.index >= len(self.plan):
+            return None
+        return self.plan[self.index]
+
+    @property
+    def progress(self) -> float:
+        """Fraction of the steps completed, weighted by their predicted duration."""
+        total = self.predict(self.plan)
+        if total == 0:
+            return self.index / max(len(self.plan), 1)
+        return 1 - self.predict(self.plan[self.index:]) / total
+
+    @property
+    def elapsed(self) -> float:
+        if self._time_start is None:
+            return 0.0
+        stop = self._time_stop if self._time_stop is not None else time.perf_counter()
+        return stop - self._time_start
+
+    def predict(self, steps: list) -> float:
+        """Predicts the seconds taken by the steps, using the measured
+        average of each step kind once one has run."""
+        total = 0.0
+        for step in steps:
+            if self.step_count.get(step.kind, 0) > 0:
+                total += self.step_time[step.kind] / self.step_count[step.kind]
+            else:
+                total += step.estimate
+        return total
+
+    def remaining_time(self) -> float:
+        return self.predict(self.plan[self.index:])
+
+    def _run(self) -> None:
+        try:
+            while self.index < len(self.plan):
+                if self._abort.is_set():
+                    self.aborted = True
+                    return
+
+                step = self.plan[self.index]
+                time_start = time.perf_counter()
+                self.handlers[step.kind](step)
+                duration = time.perf_counter() - time_start
+
+                self.step_time[step.kind] = self.step_time.get(step.kind, 0.0) + duration
+                self.step_count[step.kind] = self.step_count.get(step.kind, 0) + 1
+                self.index += 1
+        except Exception as e:  # Reported to the gui, which aborts the scan
+            self.error = e
+        finally:
+            self._time_stop = time.perf_counter()
+            self._done.set()
+
+
+def format_duration(seconds: float) -> str:
+    """Formats seconds as h:mm:ss."""
+    seconds = int(round(seconds))
+    return f'{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}'
@@ -5,8 +5,6 @@ Electromagnetic Imaging Lab, University of Manitoba
 Author: Noah Stieler, 2023
 """
 
-from ctypes import windll
-
 import gui.core
 import gui.tab_hardware
 import gui.tab_home
@@ -15,4 +13,8 @@ import gui.device_select
 
 # VERY IMPORTANT
 # This removes blur on all text.
-windll.shcore.SetProcessDpiAwareness(1)
+try:
+    from ctypes import windll
+    windll.shcore.SetProcessDpiAwareness(1)
+except ImportError:  # Not running on Windows, ex. with simulated hardware
+    pass
@@ -40,12 +40,15 @@ def create(frame_base: tk.Frame) -> None:
     frame_right.rowconfigure(index=0, weight=1)
 
     button_run = ttk.Button(frame_right, text='Run')
+    button_resume = ttk.Button(frame_right, text='Resume')
     button_stop = ttk.Button(frame_right, text='Stop', state=tk.DISABLED)
     button_run.grid(row=0, column=0, padx=15)
+    button_resume.grid(row=0, column=1, padx=15)
     if enable_button_stop:
-        button_stop.grid(row=0, column=1, padx=15)
+        button_stop.grid(row=0, column=2, padx=15)
 
     button_dict['run'] = ButtonItem(button_run)
+    button_dict['resume'] = ButtonItem(button_resume)
     button_dict['stop'] = ButtonItem(button_stop)
 
 
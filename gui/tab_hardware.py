@@ -108,6 +108,18 @@ def create(frame_content_base: tk.Frame, custom_position_box) -> tk.Frame:
     button_dr.grid(row=0, column=1, padx=15)
     button_dict['disp_res'] = ButtonItem(button_dr)
 
+    button_rr = ttk.Button(frame_buttons, text='Refresh ranges')
+    button_rr.grid(row=0, column=2)
+    button_dict['refresh_ranges'] = ButtonItem(button_rr)
+
+    # Records the time taken by each VISA command, written to the output directory
+    label_timing = tk.Label(frame_buttons, text='Log timing: ')
+    label_timing.grid(row=0, column=3, padx=(15, 0))
+    checkbox = ttk.Checkbutton(frame_buttons)
+    checkbox.state(['!alternate'])
+    checkbox.grid(row=0, column=4)
+    input_dict['log_timing'] = InputItemBoolean(checkbox, 'Log timing', 0)
+
     _create_positioning(frame_hardware, custom_position_box)
 
     return frame_page_base
@@ -47,6 +47,47 @@ def add_parameter_num(display_name: str) -> parameter.InputItemNumber:
     return parameter.InputItemNumber(entry, display_name, 0)
 
 
+def add_parameter_string(display_name: str) -> parameter.InputItemString:
+    global _parameter_row_count
+    _frame_parameter_box.rowconfigure(index=_parameter_row_count, weight=1)
+
+    new_frame = tk.Frame(_frame_parameter_box)
+    new_frame.grid(row=_parameter_row_count, column=0, pady=pady_content, sticky='nsew')
+
+    tk.Label(new_frame, text=display_name).pack(padx=padx_content, side=tk.LEFT)
+    entry = tk.Entry(new_frame, justify=tk.RIGHT)
+    entry.pack(padx=padx_content, side=tk.RIGHT)
+
+    _parameter_row_count += 1
+
+    return parameter.InputItemString(entry, display_name, '')
+
+
+def add_parameter_option(display_name: str, options: tuple) -> parameter.InputItemOptionMenu:
+    """Adds an option menu, the item's value is the selected option."""
+    global _parameter_row_count
+    _frame_parameter_box.rowconfigure(index=_parameter_row_count, weight=1)
+
+    new_frame = tk.Frame(_frame_parameter_box)
+    new_frame.grid(row=_parameter_row_count, column=0, pady=pady_content, sticky='nsew')
+
+    input_item = parameter.InputItemOptionMenu(None, display_name, options[0])
+
+    def on_change(*args) -> None:
+        """Args is a tuple containing the selected option at index 0."""
+        input_item.value = args[0]
+
+    tk.Label(new_frame, text=display_name).pack(padx=padx_content, side=tk.LEFT)
+    optionmenu_var = tk.StringVar()
+    optionmenu = ttk.OptionMenu(new_frame, optionmenu_var, options[0], *options, command=on_change)
+    optionmenu.pack(padx=padx_content, side=tk.RIGHT)
+    input_item.widget = optionmenu
+
+    _parameter_row_count += 1
+
+    return input_item
+
+
 def checkbox_row_begin():
     global _column_count, _new_frame
     _column_count = 0
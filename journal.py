@@ -0,0 +1,110 @@
+"""
+Algae ~ Automated Target Positioning System
+Electromagnetic Imaging Lab, University of Manitoba
+
+Append-only journal of a scan, so an interrupted scan can be resumed.
+
+The journal is 'journal.jsonl' in the output root, one JSON record
+per line, synced to disk as each is appended:
+    start       the settings, positions and port pairs of the scan
+    resume      the scan was resumed, from 'pos_index' and 'pairs'
+    pair        'pairs' pairs of position 'pos_index' are written, 'offsets'
+                and 'entries' are the size and entry count of each open .json file
+    position    position 'pos_index' is written and its files are complete
+    done        the scan finished
+
+A record is appended only once the data it describes is on disk, see
+out.journal_commit(). A line torn by a crash is ignored.
+
+Author: Noah Stieler, 2023
+"""
+
+import json
+import os
+import os.path
+
+FILE_NAME = 'journal.jsonl'
+
+# Inputs that may differ when a scan is resumed, ex. after the CNC's
+# serial port has been enumerated again
+IGNORED_INPUTS = ('output_dir', 'output_name', 'log_timing', 'snp_save',
+                  'address_vna', 'address_switch', 'address_serial', 'address_cnc')
+
+
+class Journal:
+    def __init__(self, directory: str):
+        """Opens the journal of the output root directory for appending."""
+        self.path = os.path.join(directory, FILE_NAME)
+        self._file = open(self.path, 'a', encoding='utf-8')
+
+    def append(self, record: dict) -> None:
+        self._file.write(json.dumps(record) + '\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self) -> None:
+        self._file.close()
+
+
+def start_record(device: str, input_dict: dict, positions: list, **plan) -> dict:
+    """Record that begins a journal. positions are lists of coordinates,
+    plan holds anything else needed to compile the same plan again."""
+    record = {'event': 'start', 'device': device, 'inputs': inputs_snapshot(input_dict),
+              'positions': positions}
+    record.update(plan)
+    return record
+
+
+def inputs_snapshot(input_dict: dict) -> dict:
+    """Values of the gui inputs, by key."""
+    return {key: item.value for key, item in input_dict.items()
+            if isinstance(item.value, (str, int, float, bool))}
+
+
+def compare_inputs(recorded: dict, input_dict: dict) -> list:
+    """Returns the display names of the inputs that differ from the recorded values."""
+    differ = []
+    for key, value in recorded.items():
+        if key in IGNORED_INPUTS or key not in input_dict:
+            continue
+        if input_dict[key].value != value:
+            differ.append(input_dict[key].name)
+    return differ
+
+
+def load(directory: str) -> list:
+    """Returns the records of the output root's journal,
+    an empty list if it has none."""
+    path = os.path.join(directory, FILE_NAME)
+    if not os.path.isfile(path):
+        return []
+
+    records = []
+    with open(path, 'r', encoding='utf-8') as file:
+        for line in file:
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:  # Torn by a crash, nothing after it was committed
+                break
+    if len(records) == 0 or records[0].get('event') != 'start':
+        return []
+    return records
+
+
+def resume_point(records: list) -> dict:
+    """Returns where to resume the scan of the journal:
+        pos_index   first position not completely written
+        pairs       pairs of that position written, in the order of the plan
+        offsets     size of each of its .json files, by s-parameter
+        entries     entries in each of its .json files, by s-parameter
+        done        the scan finished"""
+    point = {'pos_index': 0, 'pairs': 0, 'offsets': {}, 'entries': {}, 'done': False}
+    for record in records:
+        if record['event'] == 'pair':
+            point.update(pos_index=record['pos_index'], pairs=record['pairs'],
+                         offsets=record['offsets'], entries=record['entries'])
+        elif record['event'] == 'position':
+            point.update(pos_index=record['pos_index'] + 1, pairs=0, offsets={}, entries={})
+        elif record['event'] == 'done':
+            point['done'] = True
+    return point
@@ -4,17 +4,89 @@ Electromagnetic Imaging Lab, University of Manitoba
 
 Handles file structure and JSON output.
 
+Writes are queued and carried out in order on a writer thread,
+so formatting and disk latency, ex. on a network share, do not hold
+up acquisition. The queue is bounded, callers block once it is full.
+flush() waits for every queued write. An error on the writer thread
+is raised by the next call from the scan, later writes are skipped
+until it has been raised.
+
+Each unit of the scan that has been written is recorded in the run's
+journal, so an interrupted scan can be resumed, see journal.py.
+
 Author: Noah Stieler, 2023
 """
 
+import os
 import os.path
 import json
+import queue
+import threading
+import time
+
+import numpy
+
+import compression
+import dataset
+import journal
+import touchstone
 
 _OUTPUT_JSON_INDENT = '\t'
 
+# 'json' writes a folder per position with a .json file per s-parameter,
+# 'dataset' writes one chunked binary container per run, see dataset.py
+backend = 'json'
+_dataset = None
+
+# True writes the metadata that is the same for the whole run and the
+# frequencies once, to meta.json, see create_meta_file(). The header of
+# each .json file then only holds RECORD_KEYS. reader.py combines the two.
+normalized = False
+# Metadata that changes between positions and files
+RECORD_KEYS = dataset.POSITION_KEYS + ('s_parameter',)
+
+# Significant digits of the values in .json files. None writes the
+# shortest repr that round-trips, 17 digits at most. 'float32' rounds to
+# single precision and writes 9 digits, which round-trip to the same float32.
+# The dataset backend always stores full precision.
+precision = None
+PRECISION_OPTIONS = ('Full', 'Float32', '8 digits', '6 digits')
+
+# Format strings for a list of values, keyed by (length, digits)
+_formats = {}
+
+# 'gzip', 'zstd' or None, the .json files are compressed on the writer
+# thread as they are written, see compression.py
+compression_method = None
+compression_level = 6
+
+# 'touchstone' writes SNP data queried from a VNA as a .s<n>p file,
+# 'binary' only as the .npy sidecar that touchstone.read() memory-maps
+snp_format = 'touchstone'
+# SNP files written and the seconds spent writing them, see snp_summary()
+snp_stats = {'files': 0, 'write_time': 0.0}
+
+# False writes on the calling thread
+asynchronous = True
+# Writes that can be waiting, each is one call, ex. one sweep of one s-parameter
+queue_size = 256
+# 'none' leaves flushing to the OS, 'complete' syncs each file to disk
+# when it is completed, 'always' after every write
+fsync_policy = 'complete'
+
+_queue = None
+_writer = None
+_error = None
+
+_journal = None
+# Set when continuing a run in an existing root, see resume_root()
+_resume = False
+
 # Stores currently open files.
 # Each key is an s-parameter ['S11', 'S12', 'S21', 'S22']
 _open_files = {}
+# Number of data entries written to each open file
+_entry_count = {}
 
 _root_default_name = 'algae_output'
 
@@ -29,7 +101,15 @@ output = {
 
 
 def init_root(output_dir: str, root_name: str) -> None:
-    """Create root directory for output."""
+    """Create root directory for output.
+    Writes still queued from a previous run are finished first."""
+    _drain()
+    global _dataset, _resume
+    _dataset = None
+    _resume = False
+    compression.reset()
+    snp_stats.update(files=0, write_time=0.0)
+
     output['pos'] = 0
     output['dir_dest'] = output_dir
     output['root_name'] = root_name
@@ -38,7 +118,7 @@ def init_root(output_dir: str, root_name: str) -> None:
     index = 0
     while not dir_created:
         try:
-            full_path = output['dir_dest'] + '\\' + output['root_name']
+            full_path = os.path.join(output['dir_dest'], output['root_name'])
             if index != 0:
                 full_path = full_path + f'_{index}'
 
@@ -52,11 +132,29 @@ def init_root(output_dir: str, root_name: str) -> None:
             output['root_name'] = _root_default_name
 
 
-def create_meta_file(meta: dict) -> None:
-    file = open(output['full_path'] + '\\meta.json', 'w', encoding='utf-8')
+def resume_root(full_path: str, pos_index: int) -> None:
+    """Continues writing to the existing root of an interrupted run,
+    from position pos_index. Positions after it are overwritten."""
+    _drain()
+    global _dataset, _resume
+    _dataset = None
+    _resume = True
+    compression.reset()
+
+    output['full_path'] = full_path
+    output['dir_dest'], output['root_name'] = os.path.split(full_path)
+    output['pos_index'] = pos_index
+
+
+def create_meta_file(meta: dict, freqs: list = None) -> None:
+    """Writes the run's metadata, and frequencies if given, to meta.json in the root."""
+    file = open(os.path.join(output['full_path'], 'meta.json'), 'w', encoding='utf-8')
     json_meta = json.dumps(meta, indent=_OUTPUT_JSON_INDENT)
     file.write('{\n')
-    file.write('\"meta\": ' + json_meta + '\n}')
+    file.write('\"meta\": ' + json_meta)
+    if freqs is not None:
+        file.write(',\n\"freq\": ' + json.dumps(freqs))
+    file.write('\n}')
     file.close()
 
 
@@ -65,41 +163,347 @@ def mkdir_new_pos(first_position:bool = False) -> None:
     if first_position:
         output['pos_index'] = 0
 
-    output['dir_cur'] = output['full_path'] + '\\pos' + str(output['pos_index'])
-    os.mkdir(output['dir_cur'])
+    output['dir_cur'] = os.path.join(output['full_path'], 'pos' + str(output['pos_index']))
+    if backend == 'json':
+        # May exist if a resumed run was interrupted before writing to it
+        _submit(os.makedirs, output['dir_cur'], exist_ok=True)
     output['pos_index'] += 1
 
 
 def out_file_init(s_parameter: str, meta: dict, freqs: list) -> None:
-    """Initializes .json files with header information."""
-    f_name = output['dir_cur'] + '\\' + s_parameter + '.json'
-    _open_files[s_parameter] = open(f_name, 'w', encoding='utf-8')
+    """Initializes .json files with header information.
+    If normalized only the RECORD_KEYS of meta are written."""
+    if backend == 'dataset':
+        _submit(_dataset_init, output['full_path'], output['pos_index'] - 1,
+                s_parameter, meta, freqs)
+    elif normalized:
+        meta = {key: meta[key] for key in RECORD_KEYS if key in meta}
+        _submit(_file_init, _file_path(s_parameter), s_parameter, meta, None)
+    else:
+        _submit(_file_init, _file_path(s_parameter), s_parameter, meta, freqs)
+
+
+def out_file_data_write(s_parameter: str, key: str, real: list, imag: list) -> None:
+    """Writes a single sweep to .json files.
+    key is 't<tran>r<refl>' for a port pair, or 'p<port>' for a per port reflection.
+    real and imag must not be modified afterwards, they are written later."""
+    if backend == 'dataset':
+        _submit(_dataset_write, s_parameter, key, real, imag)
+    else:
+        _submit(_file_data_write, s_parameter, key, real, imag)
+
+
+def out_file_complete(s_parameter: str) -> None:
+    """Closes the data and the file, the file is valid JSON
+    even if the scan was aborted part way through."""
+    if backend == 'dataset':
+        _submit(_dataset_complete, s_parameter)
+    else:
+        _submit(_file_complete, s_parameter)
+
+
+def reopen_position(pos_index: int, offsets: dict, entries: dict) -> None:
+    """Reopens the .json files of a position of a resumed run. Each is
+    truncated to its size in offsets, the end of the last entry in the journal."""
+    output['dir_cur'] = os.path.join(output['full_path'], 'pos' + str(pos_index))
+    output['pos_index'] = pos_index + 1
+    for s_parameter in offsets:
+        _submit(_file_reopen, _file_path(s_parameter),
+                s_parameter, offsets[s_parameter], entries[s_parameter])
+
+
+def snp_write(pos_index: int, rows: numpy.ndarray, port_count: int) -> None:
+    """Writes the SNP data of a position queried from a VNA to
+    'output_<pos_index>.s<port_count>p' in the root, in snp_format.
+    rows are laid out as touchstone.parse() returns them and must not
+    be changed once passed."""
+    path = os.path.join(output['full_path'], f'output_{pos_index}.s{port_count}p')
+    _submit(_snp_write, path, rows, port_count)
+
+
+def journal_open(record: dict) -> None:
+    """Opens the root's journal and appends record, ex. journal.start_record()."""
+    global _journal
+    _drain()
+    _journal = journal.Journal(output['full_path'])
+    _journal.append(record)
+
+
+def journal_commit(record: dict) -> None:
+    """Appends record to the journal once every earlier write is on disk.
+    'pair' records get the offsets and entry counts of the open .json files."""
+    _submit(_journal_commit, record)
+
+
+def set_precision(option: str) -> None:
+    """Sets precision from one of PRECISION_OPTIONS."""
+    global precision
+    if option == 'Full':
+        precision = None
+    elif option == 'Float32':
+        precision = 'float32'
+    else:
+        precision = int(option.split()[0])
+
+
+def set_compression(option: str) -> None:
+    """Sets the compression from one of compression.OPTIONS."""
+    global compression_method, compression_level
+    compression_method, compression_level = compression.parse_option(option)
+
+
+def compression_summary() -> str:
+    """Compression ratio and CPU time of the run, empty if it is not compressed."""
+    if compression_method is None or backend == 'dataset':
+        return ''
+    return compression.summary()
+
+
+def snp_summary() -> str:
+    """Time spent writing SNP files on the host, empty if none were written."""
+    if snp_stats['files'] == 0:
+        return ''
+    return f'host write: {snp_stats["write_time"] / snp_stats["files"]:.2f} s/position'
+
+
+def precision_meta():
+    """Precision of the written values for the metadata,
+    'full', 'float32' or the number of significant digits."""
+    if precision is None or backend == 'dataset':
+        return 'full'
+    return precision
+
+
+def close() -> None:
+    """Called once the run is over. Closes the dataset container and
+    waits for every write, raises any error from the writer."""
+    _submit(_close)
+    flush()
+
+
+def abort() -> None:
+    """Completes any open files and closes the dataset and journal so the
+    output is readable, once every queued write is done. Errors are discarded.
+    The journal is left as it was, so the run can be resumed."""
+    _drain()
+    try:
+        for s_parameter in list(_open_files):
+            _file_complete(s_parameter)
+        _close()
+    except OSError:
+        pass
+
+
+def flush() -> None:
+    """Blocks until every queued write is done, raises any error from the writer."""
+    if _queue is not None:
+        _queue.join()
+    _raise_error()
+
+
+"""
+    Writer, these run on the writer thread
+"""
+
+
+def _file_path(s_parameter: str) -> str:
+    """Path of the s-parameter's file in the current position."""
+    path = os.path.join(output['dir_cur'], s_parameter + '.json')
+    if compression_method is not None:
+        path += compression.EXTENSIONS[compression_method]
+    return path
+
+
+def _open(path: str, mode: str):
+    """Opens a .json file for writing, compressed if it has a compression extension.
+    The compression is set from the extension as a resumed file must keep it."""
+    for method, extension in compression.EXTENSIONS.items():
+        if path.endswith(extension):
+            return compression.CompressedWriter(open(path, mode + 'b'), method, compression_level)
+    return open(path, mode, encoding='utf-8')
+
+
+def _file_init(path: str, s_parameter: str, meta: dict, freqs: list) -> None:
+    _open_files[s_parameter] = _open(path, 'w')
+    _entry_count[s_parameter] = 0
 
     json_meta = json.dumps(meta, indent=_OUTPUT_JSON_INDENT)
-    json_freqs = json.dumps(freqs)
 
     _open_files[s_parameter].write('{\n')  # Required for JSON formatting
     _open_files[s_parameter].write('\"meta\": ' + json_meta + ',\n')
-    _open_files[s_parameter].write('\"freq\": ' + json_freqs + ',\n')
+    if freqs is not None:  # None when the frequencies are in meta.json
+        _open_files[s_parameter].write('\"freq\": ' + json.dumps(freqs) + ',\n')
     _open_files[s_parameter].write('"data": {\n')
 
 
-def out_file_data_write(s_parameter: str, tran: int, refl: int,
-                        real: list, imag: list, close_data: bool) -> None:
-    """Writes a single sweep to .json files."""
-    _open_files[s_parameter].write(_OUTPUT_JSON_INDENT + f'"t{tran}r{refl}"' + ': {\n')
-    _open_files[s_parameter].write(
-        2 * _OUTPUT_JSON_INDENT + '"real": ' + str(real) + ',\n')
-    _open_files[s_parameter].write(
-        2 * _OUTPUT_JSON_INDENT + '"imag": ' + str(imag))
+def _file_data_write(s_parameter: str, key: str, real: list, imag: list) -> None:
+    file = _open_files[s_parameter]
+    if _entry_count[s_parameter] > 0:
+        file.write(',\n')
+
+    file.write(_OUTPUT_JSON_INDENT + f'"{key}"' + ': {\n')
+    file.write(2 * _OUTPUT_JSON_INDENT + '"real": ' + _format_values(real) + ',\n')
+    file.write(2 * _OUTPUT_JSON_INDENT + '"imag": ' + _format_values(imag))
+    file.write('\n' + 2 * _OUTPUT_JSON_INDENT + '}')
+
+    _entry_count[s_parameter] += 1
+    if fsync_policy == 'always':
+        _sync(file)
+
+
+def _file_reopen(path: str, s_parameter: str, offset: int, entries: int) -> None:
+    with open(path, 'r+b') as file:
+        file.truncate(offset)
+    _open_files[s_parameter] = _open(path, 'a')
+    _entry_count[s_parameter] = entries
 
-    if close_data:
-        _open_files[s_parameter].write('\n' + 2 * _OUTPUT_JSON_INDENT + '}\n}')
+
+def _file_complete(s_parameter: str) -> None:
+    if s_parameter in _open_files and not _open_files[s_parameter].closed:
+        file = _open_files.pop(s_parameter)
+        file.write('\n}\n}')  # Required for JSON formatting
+        if isinstance(file, compression.CompressedWriter):
+            file.end_member()
+        if fsync_policy != 'none':
+            _sync(file)
+        file.close()
+
+
+def _format_values(values: list) -> str:
+    """Formats values as a JSON array at the set precision.
+    One %-format of the whole list is several times faster than str()."""
+    if precision is None:
+        text = str(values)
     else:
-        _open_files[s_parameter].write('\n' + 2 * _OUTPUT_JSON_INDENT + '},\n')
+        digits = precision
+        if precision == 'float32':
+            values = numpy.asarray(values, dtype=numpy.float32).tolist()
+            digits = 9
 
+        key = (len(values), digits)
+        if key not in _formats:
+            _formats[key] = '[' + ', '.join([f'%.{digits}g'] * len(values)) + ']'
+        text = _formats[key] % tuple(values)
 
-def out_file_complete(s_parameter: str) -> None:
-    if not _open_files[s_parameter].closed:
-        _open_files[s_parameter].write('\n}')  # Required for JSON formatting
-        _open_files[s_parameter].close()
+    # Not finite values are written the way the json module reads them
+    if 'n' in text:
+        text = text.replace('nan', 'NaN').replace('inf', 'Infinity')
+    return text
+
+
+def _dataset_init(full_path: str, pos_index: int, s_parameter: str, meta: dict, freqs: list) -> None:
+    """The container is created with the first position's metadata."""
+    global _dataset
+    if _dataset is None:
+        _dataset = dataset.DatasetWriter(full_path, meta, freqs, resume=_resume,
+                                         sync=fsync_policy != 'none')
+
+    _dataset.begin_position(pos_index, meta)
+    _dataset.begin_s_parameter(s_parameter)
+
+
+def _dataset_write(s_parameter: str, key: str, real: list, imag: list) -> None:
+    _dataset.write(s_parameter, key, real, imag)
+
+
+def _dataset_complete(s_parameter: str) -> None:
+    if _dataset is not None:
+        _dataset.end_s_parameter(s_parameter)
+
+
+def _snp_write(path: str, rows: numpy.ndarray, port_count: int) -> None:
+    time_start = time.perf_counter()
+    if snp_format == 'binary':
+        file = open(touchstone.sidecar_path(path), 'wb')
+        numpy.save(file, numpy.ascontiguousarray(rows))
+    else:
+        file = open(path, 'w', encoding='utf-8')
+        touchstone.write(file, rows, port_count)
+    if fsync_policy != 'none':
+        _sync(file)
+    file.close()
+
+    snp_stats['files'] += 1
+    snp_stats['write_time'] += time.perf_counter() - time_start
+
+
+def _journal_commit(record: dict) -> None:
+    if _journal is None:
+        return
+
+    for file in _open_files.values():
+        # A resumed file is cut at the end of a member
+        if isinstance(file, compression.CompressedWriter):
+            file.end_member()
+        _sync(file)
+    if record['event'] == 'pair':
+        record = dict(record,
+                      offsets={s_parameter: file.tell() for s_parameter, file in _open_files.items()},
+                      entries={s_parameter: _entry_count[s_parameter] for s_parameter in _open_files})
+    _journal.append(record)
+
+
+def _close() -> None:
+    global _journal
+    if _dataset is not None:
+        _dataset.close()
+    if _journal is not None:
+        _journal.close()
+        _journal = None
+
+
+def _sync(file) -> None:
+    file.flush()
+    os.fsync(file.fileno())
+
+
+"""
+    Queue
+"""
+
+
+def _submit(function, *args, check_error: bool = True, **kwargs) -> None:
+    """Runs function(*args, **kwargs) on the writer thread, after every
+    earlier write. Blocks while the queue is full."""
+    if check_error:
+        _raise_error()
+
+    if not asynchronous:
+        function(*args, **kwargs)
+        return
+
+    global _queue, _writer
+    if _writer is None or not _writer.is_alive():
+        _queue = queue.Queue(maxsize=queue_size)
+        _writer = threading.Thread(target=_write_loop, args=(_queue,), daemon=True)
+        _writer.start()
+    _queue.put((function, args, kwargs))
+
+
+def _write_loop(write_queue: queue.Queue) -> None:
+    global _error
+    while True:
+        function, args, kwargs = write_queue.get()
+        try:
+            # Once an error occurs the scan is aborted, skip the rest
+            if _error is None:
+                function(*args, **kwargs)
+        except Exception as e:  # Raised by the next call from the scan
+            _error = e
+        finally:
+            write_queue.task_done()
+
+
+def _drain() -> None:
+    """Waits for every queued write and discards any error."""
+    global _error
+    if _queue is not None:
+        _queue.join()
+    _error = None
+
+
+def _raise_error() -> None:
+    global _error
+    if _error is not None:
+        error, _error = _error, None
+        raise error
@@ -0,0 +1,450 @@
+"""
+Algae ~ Automated Target Positioning System
+Electromagnetic Imaging Lab, University of Manitoba
+
+Reads the output of a run as one lazy array, so imaging code does
+not have to parse whole output files to get a few port pairs.
+
+    run = reader.open_run('algae_output')
+    s21 = run[3, 0, 5, 'S21']      # position 3, tran port 1, refl port 6
+    block = run[:, :, :, 'S11', 0]  # every position and pair at one frequency
+
+The array is indexed [position, tran, refl, s_parameter, freq], the same
+as dataset.py: port indices are port numbers minus one, s_parameter is an
+index into dataset.S_PARAMETERS or its name, and entries that were not
+measured are NaN. Only the entries that are indexed are read.
+
+Layouts:
+    json     device0 'pos<n>/<S>.json' files, plain or compressed, see out.py.
+             A normalized run's metadata and frequencies are in 'meta.json'.
+             The byte range of every entry is indexed once and cached in
+             'index.npz' in the run directory, the index is rebuilt if any
+             file changes. Entries are read with a seek, or by decompressing
+             the one member holding them, see compression.py.
+    dataset  device0 'data.h5' or 'data.zarr', see dataset.py
+    snp      device1 'output_<n>.s24p' files, one position at a time,
+             memory-mapped from a binary sidecar, see touchstone.py
+
+If the run measured one triangle of pairs, see device0.port_pairs.reciprocal(),
+the other triangle is derived from the mirrored pair.
+
+Author: Noah Stieler, 2023
+"""
+
+import json
+import os
+import os.path
+import re
+import zlib
+
+import numpy
+
+import compression
+import dataset
+import journal
+import touchstone
+
+INDEX_NAME = 'index.npz'
+
+_POSITION_DIR = re.compile(r'pos(\d+)')
+# A .npy alone was written by out.snp_write() in binary, see touchstone.py
+_SNP_FILE = re.compile(r'output_(\d+)\.s(\d+)p(?:\.npy)?')
+_JSON_FILE = re.compile(r'(S\d\d)\.json(' + '|'.join(re.escape(extension)
+                                                      for extension in compression.EXTENSIONS.values()) + ')?')
+
+
+def open_run(path: str):
+    """Opens the output of a run, path is its root directory,
+    or a 'data.h5' or 'data.zarr' container."""
+    if os.path.basename(os.path.normpath(path)) in ('data.h5', 'data.zarr'):
+        return Run(_DatasetSource(path))
+
+    for name in ('data.h5', 'data.zarr'):
+        if os.path.exists(os.path.join(path, name)):
+            return Run(_DatasetSource(os.path.join(path, name)))
+
+    names = os.listdir(path)
+    if any(_SNP_FILE.fullmatch(name) for name in names):
+        return Run(_SnpSource(path))
+    if any(_POSITION_DIR.fullmatch(name) for name in names):
+        return Run(_JsonSource(path))
+
+    raise FileNotFoundError(f'No run output in \'{path}\'.')
+
+
+def list_files(path: str) -> tuple:
+    """Returns the layout of the run at path, 'json' or 'snp', and its output files by position,
+    {pos_index: {s_parameter: path}} for 'json' and {pos_index: path} for 'snp'.
+    A device1 position saved in binary is listed by the path of its .s24p, see touchstone.read()."""
+    files = {}
+    for name in os.listdir(path):
+        match = _SNP_FILE.fullmatch(name)
+        if match is not None:
+            name = os.path.splitext(name)[0] if name.endswith('.npy') else name
+            files[int(match.group(1))] = os.path.join(path, name)
+    if len(files) > 0:
+        return 'snp', files
+
+    for name in os.listdir(path):
+        match = _POSITION_DIR.fullmatch(name)
+        if match is not None:
+            directory = os.path.join(path, name)
+            position = files[int(match.group(1))] = {}
+            for file_name in sorted(os.listdir(directory)):
+                file_match = _JSON_FILE.fullmatch(file_name)
+                if file_match is not None:
+                    position[file_match.group(1)] = os.path.join(directory, file_name)
+    return 'json', files
+
+
+class Run:
+    def __init__(self, source):
+        self._source = source
+        self.shape = source.shape
+        self.freqs = source.freqs
+        self.meta = source.meta
+        # Metadata that changes between positions, ex. 'posx' and 'posy'
+        self.positions = source.positions
+        self.reciprocity = self.meta.get('reciprocity', 'off')
+        # Runs from before it was recorded were derived the same way
+        self.mirror_s_parameters = self.meta.get('mirror_s_parameters', dataset.MIRROR_S_PARAMETERS)
+
+    @property
+    def ndim(self) -> int:
+        return len(self.shape)
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def __getitem__(self, key) -> numpy.ndarray:
+        if not isinstance(key, tuple):
+            key = (key,)
+        if len(key) > len(self.shape):
+            raise IndexError('Too many indices, the run is indexed [position, tran, refl, s_parameter, freq].')
+        key = key + (slice(None),) * (len(self.shape) - len(key))
+        if isinstance(key[3], str):
+            key = key[:3] + (dataset.S_PARAMETERS.index(key[3]),) + key[4:]
+        elif isinstance(key[3], (list, tuple)):
+            key = key[:3] + ([dataset.S_PARAMETERS.index(sp) if isinstance(sp, str) else sp
+                              for sp in key[3]],) + key[4:]
+
+        indices = [numpy.arange(size)[k] for size, k in zip(self.shape, key)]
+        squeeze = tuple(axis for axis, index in enumerate(indices) if numpy.ndim(index) == 0)
+        indices = [numpy.atleast_1d(index) for index in indices]
+
+        values = numpy.empty([len(index) for index in indices], dtype=numpy.complex128)
+        for i, pos_index in enumerate(indices[0]):
+            for j, sp_index in enumerate(indices[3]):
+                block = self.block(pos_index, dataset.S_PARAMETERS[sp_index], indices[1], indices[2])
+                values[i, :, :, j, :] = block[:, :, indices[4]]
+        return values.squeeze(axis=squeeze) if squeeze else values
+
+    def block(self, pos_index: int, s_parameter: str, trans=None, refls=None) -> numpy.ndarray:
+        """Returns the [tran, refl, freq] values of one position and s-parameter,
+        trans and refls select port indices, all ports if None."""
+        ports = numpy.arange(self.shape[1])
+        trans = ports if trans is None else numpy.asarray(trans)
+        refls = ports if refls is None else numpy.asarray(refls)
+
+        values = self._source.read(int(pos_index), s_parameter, trans, refls)
+        if self.reciprocity == 'off':
+            return values
+
+        # The unmeasured triangle is the transpose of the mirrored s-parameter
+        missing = numpy.isnan(values[:, :, 0]) & (trans[:, None] != refls[None, :])
+        if missing.any():
+            mirror = self._source.read(int(pos_index), self.mirror_s_parameters[s_parameter], refls, trans)
+            values[missing] = mirror.transpose(1, 0, 2)[missing]
+        return values
+
+    def close(self) -> None:
+        self._source.close()
+
+
+class _DatasetSource:
+    def __init__(self, path: str):
+        self._reader = dataset.DatasetReader(path)
+        self.shape = tuple(self._reader.shape)
+        self.freqs = self._reader.freqs
+        self.meta = self._reader.meta
+        self.positions = self._reader.positions
+
+    def read(self, pos_index: int, s_parameter: str, trans, refls) -> numpy.ndarray:
+        return numpy.array(self._reader.block(pos_index, s_parameter)[numpy.ix_(trans, refls)])
+
+    def close(self) -> None:
+        self._reader.close()
+
+
+class _JsonSource:
+    # Columns of the entry index
+    FILE, MEMBER, MEMBER_SIZE, REAL, REAL_SIZE, IMAG, IMAG_SIZE = range(7)
+
+    def __init__(self, path: str):
+        self.path = path
+        files = self._list_files()
+        if not self._load_index(files):
+            self._build_index(files)
+
+        self.shape = (len(self.positions), dataset.DatasetWriter.port_count, dataset.DatasetWriter.port_count,
+                      len(dataset.S_PARAMETERS), len(self.freqs))
+
+    def read(self, pos_index: int, s_parameter: str, trans, refls) -> numpy.ndarray:
+        values = numpy.full((len(trans), len(refls), len(self.freqs)), complex('nan'))
+        table = self._table[pos_index, dataset.S_PARAMETERS.index(s_parameter)]
+        for i, tran in enumerate(trans):
+            for j, refl in enumerate(refls):
+                entry = table[tran, refl]
+                if entry >= 0:
+                    values[i, j].real, values[i, j].imag = self._read_entry(self._entries[entry])
+        return values
+
+    def close(self) -> None:
+        pass
+
+    def _read_entry(self, entry: numpy.ndarray) -> tuple:
+        path = os.path.join(self.path, self._files[entry[self.FILE]][0])
+        with open(path, 'rb') as file:
+            if path.endswith('.json'):
+                file.seek(entry[self.REAL])
+                real = file.read(entry[self.REAL_SIZE])
+                file.seek(entry[self.IMAG])
+                imag = file.read(entry[self.IMAG_SIZE])
+            else:
+                file.seek(entry[self.MEMBER])
+                member = _decompress_member(path, file.read(entry[self.MEMBER_SIZE]))
+                real = member[entry[self.REAL]:entry[self.REAL] + entry[self.REAL_SIZE]]
+                imag = member[entry[self.IMAG]:entry[self.IMAG] + entry[self.IMAG_SIZE]]
+        return _parse_values(real), _parse_values(imag)
+
+    def _list_files(self) -> list:
+        """Returns [relative path, size, modification time] of every output file."""
+        files = []
+        for name in sorted(os.listdir(self.path)):
+            if _POSITION_DIR.fullmatch(name) is None:
+                continue
+            for file_name in sorted(os.listdir(os.path.join(self.path, name))):
+                if _JSON_FILE.fullmatch(file_name) is None:
+                    continue
+                stat = os.stat(os.path.join(self.path, name, file_name))
+                files.append([name + '/' + file_name, stat.st_size, stat.st_mtime_ns])
+        return files
+
+    def _load_index(self, files: list) -> bool:
+        """Loads the cached index, returns False if there is none or it is out of date."""
+        path = os.path.join(self.path, INDEX_NAME)
+        if not os.path.isfile(path):
+            return False
+
+        with numpy.load(path) as index:
+            header = json.loads(str(index['header']))
+            if header['files'] != files:
+                return False
+            self._table = index['table']
+            self._entries = index['entries']
+        self._files = header['files']
+        self.freqs = numpy.asarray(header['freq'])
+        self.meta = header['meta']
+        self.positions = header['positions']
+        return True
+
+    def _build_index(self, files: list) -> None:
+        """Scans every file for the byte ranges of its entries and caches them."""
+        pos_count = 1 + max([int(_POSITION_DIR.fullmatch(name.split('/')[0]).group(1))
+                             for name, size, mtime in files], default=-1)
+        port_count = dataset.DatasetWriter.port_count
+        self._table = numpy.full((pos_count, len(dataset.S_PARAMETERS), port_count, port_count), -1,
+                                 dtype=numpy.int64)
+        self._files = files
+        self.freqs = numpy.empty(0)
+        self.meta = {}
+        self.positions = [{} for i in range(pos_count)]
+
+        # Set for a normalized run, see out.normalized
+        run = read_meta_file(self.path)
+        self.meta = run.get('meta', {})
+        self.freqs = numpy.asarray(run.get('freq', []))
+
+        entries = []
+        for file_index, (name, size, mtime) in enumerate(files):
+            pos_index = int(_POSITION_DIR.fullmatch(name.split('/')[0]).group(1))
+            s_parameter = _JSON_FILE.fullmatch(name.split('/')[1]).group(1)
+            sp_index = dataset.S_PARAMETERS.index(s_parameter)
+
+            with open(os.path.join(self.path, name), 'rb') as file:
+                raw = file.read()
+            path = os.path.join(self.path, name)
+            members = [(0, len(raw), raw)] if name.endswith('.json') else _members(path, raw)
+
+            for member_offset, member_size, text in members:
+                if member_offset == 0:
+                    header = _parse_header(text)
+                    if header is not None:
+                        self.meta.update({key: value for key, value in header['meta'].items()
+                                          if key not in dataset.POSITION_KEYS and key != 's_parameter'})
+                        self.positions[pos_index] = {key: header['meta'][key] for key in dataset.POSITION_KEYS
+                                                     if key in header['meta']}
+                        if 'freq' in header:
+                            self.freqs = numpy.asarray(header['freq'])
+
+                for key, real, imag in _scan_entries(text):
+                    tran, refl = dataset.entry_index(key)
+                    self._table[pos_index, sp_index, tran, refl] = len(entries)
+                    entries.append((file_index, member_offset, member_size) + real + imag)
+
+        self._entries = numpy.array(entries, dtype=numpy.int64).reshape(-1, 7)
+
+        header = {'files': files, 'freq': self.freqs.tolist(), 'meta': self.meta, 'positions': self.positions}
+        try:
+            with open(os.path.join(self.path, INDEX_NAME), 'wb') as file:
+                numpy.savez(file, header=json.dumps(header), table=self._table, entries=self._entries)
+        except OSError:  # Read only, the index is built again next time
+            pass
+
+
+class _SnpSource:
+    def __init__(self, path: str):
+        self.path = path
+        self._files = {}
+        for name in os.listdir(path):
+            match = _SNP_FILE.fullmatch(name)
+            if match is not None:
+                self._files[int(match.group(1))] = os.path.splitext(name)[0] if name.endswith('.npy') else name
+
+        port_count = int(_SNP_FILE.fullmatch(next(iter(self._files.values()))).group(2))
+        self._cached = None, None
+
+        self.meta = read_meta_file(path).get('meta', {})
+
+        # Positions are only stored in the journal, see journal.py
+        self.positions = [{} for i in range(max(self._files) + 1)]
+        records = journal.load(path)
+        if len(records) > 0:
+            for position, pos in zip(self.positions, records[0]['positions']):
+                position.update(zip(('posx', 'posy', 'posz'), pos))
+
+        freqs, matrix = self._load(0)
+        self.freqs = freqs
+        self.shape = (len(self.positions), port_count, port_count, len(dataset.S_PARAMETERS), len(freqs))
+
+    def read(self, pos_index: int, s_parameter: str, trans, refls) -> numpy.ndarray:
+        freqs, matrix = self._load(pos_index)
+        if matrix is None:
+            return numpy.full((len(trans), len(refls), len(self.freqs)), complex('nan'))
+
+        # matrix is [freq, receive, drive], port 1 of the pair is tran and port 2 is refl
+        receive, drive = {'S11': (trans, None), 'S21': (refls, trans),
+                          'S12': (trans, refls), 'S22': (refls, None)}[s_parameter]
+        if drive is None:  # Reflection of one port, the same for every pair using it
+            values = matrix[:, receive, receive].T
+            if s_parameter == 'S11':
+                return numpy.repeat(values[:, None, :], len(refls), axis=1)
+            return numpy.repeat(values[None, :, :], len(trans), axis=0)
+        values = matrix[:, receive[:, None], drive[None, :]].transpose(1, 2, 0)
+        return values if s_parameter == 'S12' else values.transpose(1, 0, 2)
+
+    def close(self) -> None:
+        self._cached = None, None
+
+    def _load(self, pos_index: int) -> tuple:
+        """Returns the frequencies and [freq, receive, drive] matrix of a position,
+        memory-mapped from its sidecar, see touchstone.py. The last position read is kept."""
+        if self._cached[0] == pos_index:
+            return self._cached[1]
+
+        result = None, None
+        if pos_index in self._files:
+            result = touchstone.read(os.path.join(self.path, self._files[pos_index]))
+        self._cached = pos_index, result
+        return result
+
+
+def read_file(path: str) -> dict:
+    """Reads a whole .json output file, plain or compressed. Returns
+        meta        the file's metadata, None if the header is cut short
+        freq        the frequencies
+        entries     complex values by output key, ex. 't1r2'
+        complete    the file was closed, see out.out_file_complete()
+    The metadata and frequencies of a normalized run are completed from its meta.json."""
+    with open(path, 'rb') as file:
+        raw = file.read()
+    members = [(0, len(raw), raw)] if path.endswith('.json') else _members(path, raw)
+
+    result = {'meta': None, 'freq': numpy.empty(0), 'entries': {}, 'complete': False}
+    for member_offset, member_size, text in members:
+        if member_offset == 0:
+            header = _parse_header(text)
+            if header is not None and 'freq' not in header:
+                run = read_meta_file(os.path.dirname(os.path.dirname(os.path.abspath(path))))
+                header = {'meta': dict(run.get('meta', {}), **header['meta']), 'freq': run.get('freq', [])}
+            if header is not None:
+                result['meta'] = header['meta']
+                result['freq'] = numpy.asarray(header['freq'])
+        for key, real, imag in _scan_entries(text):
+            real = _parse_values(text[real[0]:real[0] + real[1]])
+            imag = _parse_values(text[imag[0]:imag[0] + imag[1]])
+            result['entries'][key] = real + 1j * imag
+        result['complete'] = _END.search(text.rstrip()) is not None
+    return result
+
+
+def read_meta_file(path: str) -> dict:
+    """Returns the 'meta.json' of the run at path, see out.create_meta_file(),
+    empty if it has none."""
+    meta_path = os.path.join(path, 'meta.json')
+    if not os.path.isfile(meta_path):
+        return {}
+    with open(meta_path, 'r', encoding='utf-8') as file:
+        return json.load(file)
+
+
+def _members(path: str, raw: bytes) -> list:
+    """Splits a compressed file into (raw offset, raw size, decompressed text) per member."""
+    members = []
+    offset = 0
+    while offset < len(raw):
+        if path.endswith(compression.EXTENSIONS['gzip']):
+            decompressor = zlib.decompressobj(31)
+        else:
+            compression.check_available('zstd')
+            decompressor = compression.zstandard.ZstdDecompressor().decompressobj()
+        text = decompressor.decompress(raw[offset:])
+        if not decompressor.eof:  # Cut short by a crash
+            break
+        size = len(raw) - offset - len(decompressor.unused_data)
+        members.append((offset, size, text))
+        offset += size
+    return members
+
+
+def _decompress_member(path: str, raw: bytes) -> bytes:
+    if path.endswith(compression.EXTENSIONS['gzip']):
+        return zlib.decompress(raw, 31)
+    return compression.zstandard.ZstdDecompressor().decompressobj().decompress(raw)
+
+
+def _parse_header(text: bytes):
+    """Returns the 'meta' and 'freq' of a file's header, or None if it is cut short."""
+    end = text.find(b'"data": {')
+    if end < 0:
+        return None
+    return json.loads(text[:end].rstrip().rstrip(b',') + b'}')
+
+
+# An entry as written by out._file_data_write(), plain .json files
+# written in text mode on Windows end their lines in CRLF
+_ENTRY = re.compile(rb'\t"(\w+)": \{\r?\n\t\t"real": (\[[^\]]*\]),\r?\n\t\t"imag": (\[[^\]]*\])')
+# The end written by out.out_file_complete()
+_END = re.compile(rb'\r?\n\}\r?\n\}$')
+
+
+def _scan_entries(text: bytes):
+    """Yields the key and (offset, size) of the real and imaginary arrays of each entry."""
+    for match in _ENTRY.finditer(text):
+        yield match.group(1).decode(), \
+            (match.start(2), match.end(2) - match.start(2)), \
+            (match.start(3), match.end(3) - match.start(3))
+
+
+def _parse_values(text: bytes) -> numpy.ndarray:
+    return numpy.fromstring(text[1:-1].decode(), sep=',')
@@ -0,0 +1,158 @@
+"""
+Algae ~ Automated Target Positioning System
+Electromagnetic Imaging Lab, University of Manitoba
+
+Segmented sweeps, a table of frequency bands each with its own
+number of points, IF bandwidth and optionally source power.
+Wide IF bandwidths can be used where the signal is strong,
+and narrow ones only where they are needed.
+
+Tables are read from a .csv file, or typed as a list, with one
+'start,stop,points,ifbw[,power]' segment per line or separated by ';'.
+Frequencies are in Hz and power is in dBm. Segments must be in
+ascending order and must not overlap.
+
+Author: Noah Stieler, 2023
+"""
+
+import os.path
+from dataclasses import dataclass, asdict
+
+import numpy
+
+from gui.parameter import input_dict
+from visa import VisaResource
+
+SWEEP_OPTIONS = ('Linear', 'Segment')
+
+
+@dataclass
+class Segment:
+    start: float
+    stop: float
+    points: int
+    ifbw: float
+    power: float = None
+
+
+def parse(text: str) -> list:
+    """Parses segments separated by new lines or semicolons.
+    Lines that do not start with a number, ex. a csv header, are skipped.
+    Raises ValueError for malformed segments."""
+    segments = []
+    for entry in text.replace(';', '\n').splitlines():
+        values = [value.strip() for value in entry.split(',') if value.strip() != '']
+        if len(values) == 0 or not _is_number(values[0]):
+            continue
+        if len(values) not in (4, 5):
+            raise ValueError(f'Segment "{entry.strip()}" needs start, stop, points, ifbw and optionally power.')
+
+        points = float(values[2])
+        if points != int(points):
+            raise ValueError(f'Segment "{entry.strip()}" must have a whole number of points.')
+
+        power = float(values[4]) if len(values) == 5 else None
+        segments.append(Segment(float(values[0]), float(values[1]), int(points), float(values[3]), power))
+    return segments
+
+
+def load(text: str) -> list:
+    """Loads segments from a .csv file if text is a path, otherwise parses text as a list."""
+    if os.path.isfile(text):
+        with open(text, 'r', encoding='utf-8') as file:
+            return parse(file.read())
+    return parse(text)
+
+
+def from_input() -> list:
+    """Returns the segments entered in the gui, or None for a linear sweep.
+    Raises ValueError if the table can not be read."""
+    if 'sweep_type' not in input_dict or input_dict['sweep_type'].value.lower() != 'segment':
+        return None
+    return load(input_dict['segment_table'].value)
+
+
+def validate(segments: list, p_ranges: dict) -> str:
+    """Checks the segments against the VNA parameter ranges.
+    Returns an error message, or an empty string if the table is valid."""
+    if len(segments) == 0:
+        return 'Segment table is empty.'
+
+    previous_stop = None
+    for i, segment in enumerate(segments):
+        name = f'Segment {i + 1}'
+        if not (p_ranges['freq_start'][0] <= segment.start <= p_ranges['freq_start'][1]) \
+                or not (p_ranges['freq_stop'][0] <= segment.stop <= p_ranges['freq_stop'][1]):
+            return f'{name} frequencies must be in range: {p_ranges["freq_start"]}'
+        if segment.points < 1 or (segment.points > 1 and not segment.start < segment.stop):
+            return f'{name} start frequency must be less than stop frequency.'
+        if not (p_ranges['ifbw'][0] <= segment.ifbw <= p_ranges['ifbw'][1]):
+            return f'{name} IF bandwidth must be in range: {p_ranges["ifbw"]}'
+        if segment.power is not None and 'power' in p_ranges \
+                and not (p_ranges['power'][0] <= segment.power <= p_ranges['power'][1]):
+            return f'{name} power must be in range: {p_ranges["power"]}'
+        if previous_stop is not None and segment.start <= previous_stop:
+            return f'{name} overlaps the previous segment.'
+        previous_stop = segment.stop
+
+    total_points = sum(segment.points for segment in segments)
+    if not (p_ranges['num_points'][0] <= total_points <= p_ranges['num_points'][1]):
+        return f'Total number of points must be in range: {p_ranges["num_points"]}'
+
+    return ''
+
+
+def freq_axis(segments: list) -> numpy.ndarray:
+    """Frequencies of a segmented sweep, each segment is swept linearly."""
+    return numpy.concatenate([numpy.linspace(segment.start, segment.stop, segment.points)
+                              for segment in segments])
+
+
+def apply(vna: VisaResource, segments: list) -> None:
+    """Sends the segment table and selects the segment sweep.
+    Should be called inside vna.batch(). The table is only
+    sent again if it differs from the one last applied."""
+    table = str([asdict(segment) for segment in segments])
+
+    if vna.shadow.get('segment_table') != table:
+        vna.write('SENSE1:SEGMENT:DELETE:ALL')
+        for n, segment in enumerate(segments, start=1):
+            header = f'SENSE1:SEGMENT{n}'
+            vna.write(f'{header}:ADD')
+            vna.write(f'{header}:FREQUENCY:START {segment.start}')
+            vna.write(f'{header}:FREQUENCY:STOP {segment.stop}')
+            vna.write(f'{header}:SWEEP:POINTS {segment.points}')
+            vna.write(f'{header}:BWIDTH {segment.ifbw}')
+            if segment.power is not None:
+                vna.write(f'{header}:POWER1 {segment.power}')
+            vna.write(f'{header}:STATE ON')
+        vna.shadow['segment_table'] = table
+
+    # Without these the channel IF bandwidth and power are used for every segment
+    vna.set('SENSE1:SEGMENT:BWIDTH:CONTROL', 'ON')
+    vna.set('SENSE1:SEGMENT:POWER:CONTROL',
+            'ON' if any(segment.power is not None for segment in segments) else 'OFF')
+    vna.set('SENSE1:SWEEP:TYPE', 'SEGMENT')
+
+
+def meta_data(segments: list) -> dict:
+    """Metadata entries describing the sweep, merged into a file's metadata."""
+    if segments is None:
+        return {'sweep_type': 'linear'}
+
+    return {
+        'sweep_type': 'segment',
+        'freq_start': segments[0].start,
+        'freq_stop': segments[-1].stop,
+        'num_points': sum(segment.points for segment in segments),
+        'if_bandwidth': None,  # See segments
+        'segments': [asdict(segment) for segment in segments]
+    }
+
+
+def _is_number(text: str) -> bool:
+    try:
+        float(text)
+    except ValueError:
+        return False
+    return True
@@ -0,0 +1,539 @@
+"""
+Algae ~ Automated Target Positioning System
+Electromagnetic Imaging Lab, University of Manitoba
+
+Simulated VISA instruments, used in place of pyvisa when no
+hardware is available.
+
+Selected by prefixing an address with 'SIM::' (ex. 'SIM::E8363B') or by
+setting the environment variable ALGAE_SIM=1, in which case every address
+is simulated and the instrument model is chosen from the default addresses.
+
+Timing and noise are set in config, or by environment variables
+of the form ALGAE_SIM_<KEY> ex. ALGAE_SIM_REALTIME=0
+
+Author: Noah Stieler, 2023
+"""
+
+import math
+import os
+import re
+import time
+
+import numpy
+import pyvisa as visa
+
+ADDRESS_PREFIX = 'SIM::'
+
+config = {
+    'realtime': True,  # Sleep to emulate sweep and bus timing
+    'sweep_factor': 1.2,  # Sweep time per point is sweep_factor / IFBW
+    'sweep_overhead': 0.005,  # Seconds added to every sweep
+    'latency': 0.0005,  # Seconds per bus transaction
+    'bytes_per_second': 1e6,  # Bus throughput, GPIB is around 1 MB/s
+    'noise': 1e-3,  # Standard deviation of noise added to each trace at noise_ifbw
+    'noise_ifbw': 1e5,  # Noise scales with the square root of the IFBW
+    'seed': 0
+}
+
+for _key in config:
+    _env = os.environ.get('ALGAE_SIM_' + _key.upper())
+    if _env is not None:
+        config[_key] = type(config[_key])(float(_env))
+
+# Port pair currently routed by the simulated switch matrix
+_switch_state = {'tran': 1, 'refl': 2}
+
+_rng = numpy.random.default_rng(config['seed'])
+
+
+def enabled(address: str) -> bool:
+    """Returns true if the address should be opened with the simulated backend."""
+    return address.startswith(ADDRESS_PREFIX) or \
+        os.environ.get('ALGAE_SIM', '0') not in ('', '0')
+
+
+class SimResourceManager:
+    """Stands in for pyvisa.ResourceManager."""
+    default_addresses = {
+        'GPIB0::16::INSTR': 'E8363B',
+        'GPIB0::15::INSTR': '87050A',
+        'TCPIP0::Localhost::hislip0::INSTR': 'M9802A'
+    }
+
+    def list_resources(self) -> tuple:
+        return tuple(ADDRESS_PREFIX + model for model in _models)
+
+    def open_resource(self, address: str):
+        if address.startswith(ADDRESS_PREFIX):
+            model = address[len(ADDRESS_PREFIX):]
+        else:
+            model = SimResourceManager.default_addresses.get(address, '')
+
+        if model not in _models:
+            raise visa.VisaIOError(visa.constants.StatusCode.error_resource_not_found)
+        return _models[model](address)
+
+
+class SimResource:
+    """Base simulated message based resource.
+    Handles message splitting, common commands and bus timing."""
+    idn = 'Algae,Simulated Instrument,0,0'
+    options = '""'
+
+    def __init__(self, address: str):
+        self.address = address
+        self.read_termination = None
+        self.write_termination = None
+        self.timeout = 2000  # Time in milliseconds
+
+        self.settings = {}
+
+        # Time at which a pending *OPC raises a service request
+        self._srq_at = None
+        self._status_byte = 0
+
+        # Responses to queries sent with write(), see read_bytes()
+        self._output = bytearray()
+
+    def close(self) -> None:
+        pass
+
+    def enable_event(self, event_type, mechanism, context=None) -> None:
+        pass
+
+    def discard_events(self, event_type, mechanism) -> None:
+        self._status_byte = 0
+
+    def wait_on_event(self, event_type, timeout: int, capture_timeout: bool = False):
+        """Waits up to timeout milliseconds for the service request of a pending *OPC."""
+        if self._srq_at is not None:
+            remaining = self._srq_at - time.perf_counter() if config['realtime'] else 0
+            if remaining <= timeout / 1000:
+                if remaining > 0:
+                    time.sleep(remaining)
+                self._srq_at = None
+                self._status_byte = 0x60  # Request service and event status summary
+                return None
+
+        if config['realtime'] and timeout > 0:
+            time.sleep(timeout / 1000)
+        raise visa.VisaIOError(visa.constants.StatusCode.error_timeout)
+
+    def read_stb(self) -> int:
+        status_byte = self._status_byte
+        self._status_byte = 0
+        return status_byte
+
+    def write(self, message: str) -> int:
+        _transfer(len(message))
+        for cmd in _split_message(message):
+            result = self._command(cmd, binary=True)
+            if result is not None:
+                self._output += _response_bytes(result)
+        return len(message)
+
+    def read_bytes(self, count: int, chunk_size: int = None, break_on_termchar: bool = False) -> bytes:
+        """Reads the response of a query sent with write()."""
+        if len(self._output) < count:
+            raise visa.VisaIOError(visa.constants.StatusCode.error_timeout)
+        data = bytes(self._output[:count])
+        del self._output[:count]
+        _transfer(count)
+        return data
+
+    def read_raw(self, size: int = None) -> bytes:
+        """Reads the response of a query sent with write() up to its terminator."""
+        end = self._output.find(b'\n')
+        if end < 0:
+            raise visa.VisaIOError(visa.constants.StatusCode.error_timeout)
+        return self.read_bytes(end + 1)
+
+    def query(self, message: str) -> str:
+        response = ''
+        for cmd in _split_message(message):
+            result = self._command(cmd)
+            if result is not None:
+                response = result
+
+        _transfer(len(message) + len(response))
+        return response
+
+    def _command(self, cmd: str, binary: bool = False):
+        """Executes a single command, returns the response to a query or None."""
+        header, _, args = cmd.partition(' ')
+        header = header.upper()
+        args = args.strip()
+
+        if header == '*IDN?':
+            return self.idn
+        if header == '*OPT?':
+            return self.options
+        if header == '*OPC?':
+            self._wait_complete()
+            return '1'
+        if header == '*OPC':
+            self._srq_at = max(time.perf_counter(), self._completion_time())
+            return None
+        if header == '*ESR?':
+            return '+1' if self._srq_at is None else '+0'
+        if header in ('*RST', '*CLS', '*WAI', '*ESE', '*SRE'):
+            if header == '*RST':
+                self.reset()
+            if header == '*CLS':
+                self._status_byte = 0
+            return None
+
+        return self.command(header, args, binary)
+
+    def command(self, header: str, args: str, binary: bool):
+        """Instrument specific commands, overridden by each model."""
+        if header.endswith('?'):
+            return self.settings.get(header[:-1], '0')
+        self.settings[header] = args
+        return None
+
+    def reset(self) -> None:
+        self.settings = {}
+
+    def _wait_complete(self) -> None:
+        pass
+
+    def _completion_time(self) -> float:
+        """Time at which pending operations finish."""
+        return 0
+
+
+class SimVNA(SimResource):
+    """Behaviour shared by the simulated network analyzers."""
+    port_count = 2
+    limits = {}
+    defaults = {}
+
+    def __init__(self, address: str):
+        super().__init__(address)
+        self._sweep_end = 0
+        self.reset()
+
+    def reset(self) -> None:
+        self.settings = dict(self.defaults)
+        self.segments = {}
+        self._sweep_end = 0
+
+    @property
+    def segmented(self) -> bool:
+        return self.settings.get('SENSE1:SWEEP:TYPE', 'LINEAR').upper().startswith('SEGM')
+
+    def active_segments(self) -> list:
+        """Segments that are switched on, in order, each a dict of settings."""
+        return [self.segments[n] for n in sorted(self.segments)
+                if self.segments[n].get('STATE', 'OFF').upper() in ('ON', '1')]
+
+    @property
+    def num_points(self) -> int:
+        if self.segmented:
+            return sum(int(float(seg['SWEEP:POINTS'])) for seg in self.active_segments())
+        return int(float(self.settings['SENSE1:SWEEP:POINTS']))
+
+    @property
+    def sweep_time(self) -> float:
+        """Seconds taken by one sweep, derived from points and IFBW."""
+        ifbw = float(self.settings['SENSE1:BANDWIDTH'])
+        if not self.segmented:
+            return config['sweep_overhead'] + self.num_points * config['sweep_factor'] / ifbw
+
+        per_segment = self.settings.get('SENSE1:SEGMENT:BWIDTH:CONTROL', 'OFF').upper() in ('ON', '1')
+        sweep_time = config['sweep_overhead']
+        for seg in self.active_segments():
+            seg_ifbw = float(seg['BWIDTH']) if per_segment else ifbw
+            sweep_time += int(float(seg['SWEEP:POINTS'])) * config['sweep_factor'] / seg_ifbw
+        return sweep_time
+
+    def noise_level(self) -> numpy.ndarray:
+        """Standard deviation of the noise at each point, derived from the IFBW of its segment."""
+        ifbw = float(self.settings['SENSE1:BANDWIDTH'])
+        if not self.segmented:
+            bandwidths = numpy.full(self.num_points, ifbw)
+        else:
+            per_segment = self.settings.get('SENSE1:SEGMENT:BWIDTH:CONTROL', 'OFF').upper() in ('ON', '1')
+            bandwidths = numpy.concatenate([numpy.full(int(float(seg['SWEEP:POINTS'])),
+                                                       float(seg['BWIDTH']) if per_segment else ifbw)
+                                            for seg in self.active_segments()])
+        return config['noise'] * numpy.sqrt(bandwidths / config['noise_ifbw'])
+
+    def freq_axis(self) -> numpy.ndarray:
+        if self.segmented:
+            return numpy.concatenate([numpy.linspace(float(seg['FREQUENCY:START']),
+                                                     float(seg['FREQUENCY:STOP']),
+                                                     int(float(seg['SWEEP:POINTS'])))
+                                      for seg in self.active_segments()])
+        return numpy.linspace(float(self.settings['SENSE1:FREQUENCY:START']),
+                              float(self.settings['SENSE1:FREQUENCY:STOP']),
+                              self.num_points)
+
+    def segment_command(self, header: str, args: str) -> bool:
+        """Handles the SENSE1:SEGMENT<n> commands, returns false for any other command."""
+        if header == 'SENSE1:SEGMENT:DELETE:ALL':
+            self.segments = {}
+            return True
+
+        match = re.fullmatch(r'SENSE1:SEGMENT(\d+):(.+)', header)
+        if match is None:
+            return False
+
+        seg = self.segments.setdefault(int(match.group(1)), {
+            'STATE': 'OFF', 'SWEEP:POINTS': '21', 'BWIDTH': self.settings['SENSE1:BANDWIDTH'],
+            'FREQUENCY:START': self.settings['SENSE1:FREQUENCY:START'],
+            'FREQUENCY:STOP': self.settings['SENSE1:FREQUENCY:STOP']
+        })
+        if match.group(2) != 'ADD':
+            seg[match.group(2)] = args
+        return True
+
+    def trigger(self) -> None:
+        self._sweep_end = time.perf_counter() + self.sweep_time
+
+    def _wait_complete(self) -> None:
+        remaining = self._sweep_end - time.perf_counter()
+        if config['realtime'] and remaining > 0:
+            time.sleep(remaining)
+
+    def _completion_time(self) -> float:
+        return self._sweep_end
+
+    def setting_query(self, header: str, args: str):
+        """Answers 'HEADER?' and 'HEADER? MIN/MAX' queries."""
+        header = header[:-1]
+        if args.upper() in ('MIN', 'MAX') and header in self.limits:
+            return _format_number(self.limits[header][args.upper() == 'MAX'])
+        return self.settings.get(header, '0')
+
+    def trace(self, port_out: int, port_in: int) -> numpy.ndarray:
+        """Returns a complex trace for the physical port pair,
+        a reflection if the ports are equal."""
+        freqs = self.freq_axis()
+        noise = self.noise_level() * (_rng.standard_normal(len(freqs)) +
+                                      1j * _rng.standard_normal(len(freqs)))
+        if port_out == port_in:
+            delay = 1e-9 * (1 + 0.01 * port_out)
+            return 0.2 * numpy.exp(-2j * math.pi * freqs * delay) + noise
+
+        # Ports are spaced evenly around a ring
+        distance = abs(math.sin(math.pi * (port_out - port_in) / 24))
+        delay = 2e-9 * (1 + distance)
+        return 0.5 / (1 + 4 * distance) * numpy.exp(-2j * math.pi * freqs * delay) + noise
+
+    def format_data(self, values: numpy.ndarray, binary: bool):
+        if binary:
+            return values
+        return ','.join(['%+.12E' % value for value in values])
+
+
+class SimPNA(SimVNA):
+    """Agilent E8363B PNA Network Analyzer, device0."""
+    idn = 'Agilent Technologies,E8363B,SIM00000,A.09.90.02'
+    options = '"014,080,081,UNL"'
+    limits = {
+        'SENSE1:SWEEP:POINTS': (1, 16001),
+        'SENSE1:BANDWIDTH': (1, 40000),
+        'SENSE1:FREQUENCY:START': (10e6, 40e9),
+        'SENSE1:FREQUENCY:STOP': (10e6, 40e9),
+        'SOURCE1:POWER1': (-27, 3)
+    }
+    defaults = {
+        'SENSE1:SWEEP:POINTS': '201',
+        'SENSE1:BANDWIDTH': '35000',
+        'SENSE1:FREQUENCY:START': '10000000',
+        'SENSE1:FREQUENCY:STOP': '40000000000',
+        'SOURCE1:POWER1': '-15',
+        'FORMAT:DATA': 'ASCII,0'
+    }
+
+    def reset(self) -> None:
+        super().reset()
+        self.parameters = {}
+        self.selected = ''
+        self.swept_ports = dict(_switch_state)
+
+    def trigger(self) -> None:
+        # Traces stay in memory, unaffected by later switch changes
+        super().trigger()
+        self.swept_ports = dict(_switch_state)
+
+    def command(self, header: str, args: str, binary: bool):
+        if header in ('SYSTEM:FPRESET', 'SYSTEM:PRESET'):
+            self.reset()
+        elif header == 'CALCULATE1:PARAMETER:DEFINE':
+            self.parameters[_quoted(args)[0]] = args.split(',')[-1].strip().upper()
+        elif header == 'CALCULATE1:PARAMETER:SELECT':
+            self.selected = _quoted(args)[0]
+        elif header in ('INIT:IMM', 'INITIATE:IMMEDIATE', 'INITIATE1:IMMEDIATE'):
+            self.trigger()
+        elif header == 'CALCULATE:DATA?':
+            trace = self._s_parameter(self.parameters[self.selected])
+            values = numpy.empty(2 * len(trace))
+            values[0::2] = trace.real
+            values[1::2] = trace.imag
+            return self.format_data(values, binary)
+        elif header == 'SENSE1:X?':
+            return self.format_data(self.freq_axis(), binary)
+        elif header == 'CALCULATE1:DATA:SNP:PORTS?':
+            values = [self.freq_axis()]
+            for s_parameter in ('S11', 'S21', 'S12', 'S22'):
+                trace = self._s_parameter(s_parameter)
+                values.extend([trace.real, trace.imag])
+            return self.format_data(numpy.concatenate(values), binary)
+        elif self.segment_command(header, args):
+            pass
+        elif header.endswith('?'):
+            return self.setting_query(header, args)
+        else:
+            if header == 'SOURCE1:POWER1':
+                args = args.upper().replace('DBM', '')
+            self.settings[header] = args
+        return None
+
+    def _s_parameter(self, s_parameter: str) -> numpy.ndarray:
+        """VNA port 1 is routed to the tran port, port 2 to the refl port."""
+        ports = {'1': self.swept_ports['tran'], '2': self.swept_ports['refl']}
+        return self.trace(ports[s_parameter[2]], ports[s_parameter[1]])
+
+
+class SimSwitchMatrix(SimResource):
+    """Agilent 87050A Option K24 Multiport Test Set, device0."""
+    idn = 'Agilent Technologies,87050A,SIM00000,K24'
+
+    def command(self, header: str, args: str, binary: bool):
+        if header.startswith('TRAN_'):
+            _switch_state['tran'] = int(header[5:])
+        elif header.startswith('REFL_'):
+            _switch_state['refl'] = int(header[5:])
+        return None
+
+
+class SimPXIVNA(SimVNA):
+    """Keysight M9802A PXI Vector Network Analyzer (x4), device1."""
+    idn = 'Keysight Technologies,M9802A,SIM00000,A.13.95.06'
+    options = '"020,S93088"'
+    port_count = 24
+    limits = {
+        'SENSE1:SWEEP:POINTS': (1, 100003),
+        'SENSE1:BANDWIDTH': (1, 15e6),
+        'SENSE1:FREQUENCY:START': (300e3, 9e9),
+        'SENSE1:FREQUENCY:STOP': (300e3, 9e9)
+    }
+    defaults = {
+        'SENSE1:SWEEP:POINTS': '201',
+        'SENSE1:BANDWIDTH': '100000',
+        'SENSE1:FREQUENCY:START': '300000',
+        'SENSE1:FREQUENCY:STOP': '9000000000'
+    }
+    calibrations = ('CalSet_1', 'CalSet_2')
+
+    def command(self, header: str, args: str, binary: bool):
+        if header == 'SYSTEM:PRESET':
+            self.reset()
+        elif header in ('INITIATE1:IMMEDIATE', 'INITIATE:IMMEDIATE', 'INIT:IMM'):
+            self.trigger()
+        elif header == 'CSET:CATALOG?':
+            return '"' + ','.join(SimPXIVNA.calibrations) + '"'
+        elif header == 'CALCULATE1:MEASURE1:DATA:SNP:PORTS:SAVE':
+            ports, path = _quoted(args)[:2]
+            self._save_snp(ports, path)
+        elif header == 'CALCULATE1:MEASURE1:DATA:SNP:PORTS?':
+            port_list = [int(port) for port in _quoted(args)[0].split(',')]
+            data = self.snp_data(port_list).reshape(self.num_points, -1)
+            values = [self.freq_axis()]
+            for column in data.T:
+                values.extend([column.real, column.imag])
+            return self.format_data(numpy.concatenate(values), binary)
+        elif self.segment_command(header, args):
+            pass
+        elif header.endswith('?'):
+            return self.setting_query(header, args)
+        else:
+            self.settings[header] = args
+        return None
+
+    def _save_snp(self, ports: str, path: str) -> None:
+        """Writes a Touchstone v1 file in RI format to the host path."""
+        port_list = [int(port) for port in ports.split(',')]
+        data = self.snp_data(port_list)
+
+        path = path.replace('\\', os.sep)
+        with open(path, 'w', encoding='utf-8') as file:
+            file.write('!Simulated ' + self.idn + '\n')
+            file.write('# Hz S RI R 50\n')
+            for i, freq in enumerate(self.freq_axis()):
+                file.write('%.6f' % freq)
+                for row in range(len(port_list)):
+                    for column in range(len(port_list)):
+                        value = data[i, row, column]
+                        # Touchstone v1 allows at most four complex pairs per line
+                        if column != 0 and column % 4 == 0:
+                            file.write('\n')
+                        file.write(' %.9e %.9e' % (value.real, value.imag))
+                    file.write('\n')
+
+    def snp_data(self, port_list: list) -> numpy.ndarray:
+        """Returns complex data indexed [freq, row, column]."""
+        data = numpy.empty((self.num_points, len(port_list), len(port_list)), dtype=complex)
+        for row, port_in in enumerate(port_list):
+            for column, port_out in enumerate(port_list):
+                data[:, row, column] = self.trace(port_out, port_in)
+        return data
+
+
+_models = {
+    'E8363B': SimPNA,
+    '87050A': SimSwitchMatrix,
+    'M9802A': SimPXIVNA
+}
+
+
+def _split_message(message: str) -> list:
+    """Splits a SCPI message on semicolons outside of quotes.
+    Leading colons, which return to the root of the command tree, are removed."""
+    commands = []
+    current = ''
+    quote = ''
+    for char in message.strip():
+        if char in '\'"':
+            if quote == '':
+                quote = char
+            elif quote == char:
+                quote = ''
+        if char == ';' and quote == '':
+            commands.append(current)
+            current = ''
+        else:
+            current += char
+    commands.append(current)
+
+    return [cmd.strip().lstrip(':') for cmd in commands if cmd.strip() != '']
+
+
+def _quoted(args: str) -> list:
+    """Returns the quoted strings in a list of command arguments."""
+    return [single or double for single, double in re.findall(r'\'([^\']*)\'|"([^"]*)"', args)]
+
+
+def _response_bytes(result) -> bytes:
+    """Encodes a query response, values as a little endian REAL,64 block."""
+    if isinstance(result, str):
+        return (result + '\n').encode()
+    data = numpy.asarray(result, dtype='<f8').tobytes()
+    length = str(len(data))
+    return b'#' + str(len(length)).encode() + length.encode() + data + b'\n'
+
+
+def _transfer(byte_count: int) -> None:
+    """Emulates the time taken by a bus transaction."""
+    if config['realtime']:
+        time.sleep(config['latency'] + byte_count / config['bytes_per_second'])
+
+
+def _format_number(value) -> str:
+    if isinstance(value, int):
+        return '%+d' % value
+    return '%+.12E' % value
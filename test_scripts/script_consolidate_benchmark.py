@@ -0,0 +1,41 @@
+"""
+Algae ~ Automated Target Positioning System
+Electromagnetic Imaging Lab, University of Manitoba
+
+Times consolidate.py on a simulated device1 run with an increasing
+number of worker processes, up to the number of cores.
+
+Usage: python test_scripts/script_consolidate_benchmark.py [positions] [num_points]
+
+Author: Noah Stieler, 2023
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import consolidate
+from script_touchstone_benchmark import write_file
+
+if __name__ == '__main__':
+    positions = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    num_points = int(sys.argv[2]) if len(sys.argv) > 2 else 201
+
+    directory = tempfile.mkdtemp()
+    for pos_index in range(positions):
+        write_file(os.path.join(directory, f'output_{pos_index}.s24p'), num_points)
+    size = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+    print(f'{positions} positions, {num_points} points, {size / 1e6:.1f} MB')
+
+    workers = 1
+    while workers <= os.cpu_count():
+        time_start = time.perf_counter()
+        consolidate.consolidate(directory, workers, force=True)
+        elapsed = time.perf_counter() - time_start
+        print(f'  {workers:3d} workers {elapsed:8.3f} s  {size / 1e6 / elapsed:8.1f} MB/s')
+        workers *= 2
+    shutil.rmtree(directory)
@@ -0,0 +1,100 @@
+"""
+Algae ~ Automated Target Positioning System
+Electromagnetic Imaging Lab, University of Manitoba
+
+Compares write speed and size of the .json output, compressed and
+not, and the chunked dataset containers, using simulated traces, and the time
+the caller is blocked with writes made synchronously or on out's
+writer thread.
+
+Usage: python test_scripts/script_output_benchmark.py [positions] [num_points]
+
+Author: Noah Stieler, 2023
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import compression
+import dataset
+import out
+
+S_PARAMS = ['S11', 'S21', 'S12', 'S22']
+PORTS = 24
+
+
+def make_traces(num_points: int) -> dict:
+    """Noisy traces like the simulator's, one per port pair, as real and imaginary lists."""
+    rng = numpy.random.default_rng(0)
+    freqs = numpy.linspace(1e9, 8e9, num_points)
+    traces = {}
+    for tran in range(1, PORTS + 1):
+        for refl in range(1, PORTS + 1):
+            if tran == refl:
+                continue
+            delay = 2e-9 * (1 + abs(numpy.sin(numpy.pi * (tran - refl) / PORTS)))
+            trace = 0.2 * numpy.exp(-2j * numpy.pi * freqs * delay)
+            trace += 1e-3 * (rng.standard_normal(num_points) + 1j * rng.standard_normal(num_points))
+            traces[(tran, refl)] = (trace.real.tolist(), trace.imag.tolist())
+    return traces, freqs.tolist()
+
+
+def run(backend: str, container: str, positions: int, traces: dict, freqs: list,
+        asynchronous: bool = True, compression_option: str = 'None') -> None:
+    directory = tempfile.mkdtemp()
+    out.backend = backend
+    out.asynchronous = asynchronous
+    out.set_compression(compression_option)
+    dataset.DatasetWriter.container = container
+
+    time_start = time.perf_counter()
+    out.init_root(directory, 'benchmark')
+    for pos_index in range(positions):
+        out.mkdir_new_pos(first_position=pos_index == 0)
+        for s_parameter in S_PARAMS:
+            meta = {'s_parameter': s_parameter, 'num_points': len(freqs),
+                    'posx': pos_index, 'posy': 0, 'date': '', 'time': ''}
+            out.out_file_init(s_parameter, meta, freqs)
+        for (tran, refl), (real, imag) in traces.items():
+            for s_parameter in S_PARAMS:
+                out.out_file_data_write(s_parameter, f't{tran}r{refl}', real, imag)
+        for s_parameter in S_PARAMS:
+            out.out_file_complete(s_parameter)
+    blocked = time.perf_counter() - time_start
+    out.close()
+    elapsed = time.perf_counter() - time_start
+
+    size = 0
+    for root, dirs, files in os.walk(out.output['full_path']):
+        size += sum(os.path.getsize(os.path.join(root, name)) for name in files)
+
+    name = backend if backend == 'json' else f'{backend} ({container})'
+    name += '' if asynchronous else ', sync'
+    name += '' if compression_option == 'None' else f', {compression_option}'
+    print(f'{name:26s} {elapsed:7.2f} s  {positions * len(traces) * len(S_PARAMS) / elapsed:8.0f} traces/s'
+          f'  {size / 1e6:8.1f} MB  caller blocked {blocked:6.2f} s  {out.compression_summary()}')
+    shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    args = [int(arg) for arg in sys.argv[1:]]
+    positions, num_points = (args + [2, 1601][len(args):])[:2]
+
+    traces, freqs = make_traces(num_points)
+    print(f'{positions} positions, {len(traces)} pairs, {len(S_PARAMS)} s-parameters, {num_points} points')
+    run('json', 'auto', positions, traces, freqs, asynchronous=False)
+    run('json', 'auto', positions, traces, freqs)
+    run('json', 'auto', positions, traces, freqs, compression_option='gzip 1')
+    if compression.zstandard is not None:
+        run('json', 'auto', positions, traces, freqs, compression_option='zstd 3')
+    run('dataset', 'chunks', positions, traces, freqs, asynchronous=False)
+    run('dataset', 'chunks', positions, traces, freqs)
+    if dataset.h5py is not None:
+        run('dataset', 'hdf5', positions, traces, freqs)
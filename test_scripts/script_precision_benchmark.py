@@ -0,0 +1,53 @@
+"""
+Algae ~ Automated Target Positioning System
+Electromagnetic Imaging Lab, University of Manitoba
+
+Compares the speed and size of the values written to the .json
+output at each precision, see out.precision, and checks that the
+written arrays are valid JSON.
+
+Usage: python test_scripts/script_precision_benchmark.py [num_points ...]
+
+Author: Noah Stieler, 2023
+"""
+
+import json
+import os
+import sys
+import time
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import out
+
+PRECISIONS = [None, 'float32', 8, 6]
+REPEATS = 200
+
+
+def run(num_points: int) -> None:
+    rng = numpy.random.default_rng(0)
+    values = (0.2 * rng.standard_normal(num_points)).tolist()
+
+    print(f'{num_points} points')
+    time_full = None
+    for precision in PRECISIONS:
+        out.precision = precision
+        text = out._format_values(values)  # Format string is built on the first call
+        time_start = time.perf_counter()
+        for i in range(REPEATS):
+            text = out._format_values(values)
+        elapsed = (time.perf_counter() - time_start) / REPEATS
+        if time_full is None:
+            time_full = elapsed
+
+        error = numpy.max(numpy.abs(numpy.array(json.loads(text)) - values))
+        name = 'full' if precision is None else str(precision)
+        print(f'  {name:8s} {1e3 * elapsed:7.3f} ms/trace  x{time_full / elapsed:4.1f}'
+              f'  {len(text) / 1e3:8.1f} kB  max error {error:.1e}')
+
+
+if __name__ == '__main__':
+    for arg in sys.argv[1:] or ['1601', '20001']:
+        run(int(arg))
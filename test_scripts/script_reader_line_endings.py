@@ -0,0 +1,97 @@
+"""
+Algae ~ Automated Target Positioning System
+Electromagnetic Imaging Lab, University of Manitoba
+
+Checks that reader.py and consolidate.py read .json output with either
+line ending. Plain .json files are written in text mode, so on Windows
+their lines end in CRLF, while compressed output always ends them in LF.
+
+Usage: python test_scripts/script_reader_line_endings.py
+
+Author: Noah Stieler, 2023
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import consolidate
+import out
+import reader
+
+NUM_POINTS = 11
+S_PARAMETERS = ('S21', 'S11')
+
+
+def write_run(directory: str) -> tuple:
+    """Writes a run of one position, returns its root and the values written."""
+    rng = numpy.random.default_rng(0)
+    freqs = numpy.linspace(1e9, 2e9, NUM_POINTS).tolist()
+    out.asynchronous = False
+    out.init_root(directory, 'line_endings')
+    out.mkdir_new_pos(True)
+
+    values = {}
+    for s_parameter in S_PARAMETERS:
+        out.out_file_init(s_parameter, {'s_parameter': s_parameter, 'posx': 0, 'posy': 0}, freqs)
+    for tran, refl in [(1, 2), (2, 1), (3, 4)]:
+        for s_parameter in S_PARAMETERS:
+            key = f't{tran}r{refl}'
+            value = rng.standard_normal(NUM_POINTS) + 1j * rng.standard_normal(NUM_POINTS)
+            out.out_file_data_write(s_parameter, key, value.real.tolist(), value.imag.tolist())
+            values[(s_parameter, key)] = value
+    for s_parameter in S_PARAMETERS:
+        out.out_file_complete(s_parameter)
+    out.close()
+    return out.output['full_path'], values
+
+
+def to_crlf(root: str) -> None:
+    """Rewrites the .json files the way text mode writes them on Windows."""
+    for s_parameter in S_PARAMETERS:
+        path = os.path.join(root, 'pos0', s_parameter + '.json')
+        with open(path, 'rb') as file:
+            text = file.read().replace(b'\r\n', b'\n')
+        with open(path, 'wb') as file:
+            file.write(text.replace(b'\n', b'\r\n'))
+
+
+def check(root: str, values: dict, name: str) -> None:
+    for s_parameter in S_PARAMETERS:
+        content = reader.read_file(os.path.join(root, 'pos0', s_parameter + '.json'))
+        assert content['complete'], f'{name} {s_parameter} not complete'
+        assert len(content['entries']) == 3, f'{name} {s_parameter} has {len(content["entries"])} entries'
+        for key, value in content['entries'].items():
+            assert numpy.array_equal(value, values[(s_parameter, key)]), f'{name} {s_parameter} {key} differs'
+
+    run = reader.open_run(root)
+    for (s_parameter, key), value in values.items():
+        tran, refl = (int(port) - 1 for port in key[1:].split('r'))
+        assert numpy.array_equal(run[0, tran, refl, s_parameter], value), f'{name} open_run {key} differs'
+    run.close()
+
+    issues = consolidate.consolidate(root, force=True)
+    assert len(issues) == 0, f'{name} consolidate: {issues}'
+    run = reader.open_run(os.path.join(root, 'data.zarr'))
+    for (s_parameter, key), value in values.items():
+        tran, refl = (int(port) - 1 for port in key[1:].split('r'))
+        assert numpy.array_equal(run[0, tran, refl, s_parameter], value), f'{name} consolidate {key} differs'
+    run.close()
+    shutil.rmtree(os.path.join(root, 'data.zarr'))
+    print(f'{name}: ok')
+
+
+if __name__ == '__main__':
+    directory = tempfile.mkdtemp()
+    root, values = write_run(directory)
+    check(root, values, 'LF')
+
+    to_crlf(root)
+    os.remove(os.path.join(root, reader.INDEX_NAME))
+    check(root, values, 'CRLF')
+    shutil.rmtree(directory)
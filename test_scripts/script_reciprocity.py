@@ -0,0 +1,101 @@
+"""
+Algae ~ Automated Target Positioning System
+Electromagnetic Imaging Lab, University of Manitoba
+
+Checks that a reciprocal device0 scan is only accepted when the mirror
+of every s-parameter read per pair is selected, see device0/port_pairs.py,
+and that reader.py fills the skipped triangle from the mirror recorded
+in the run metadata.
+
+Usage: python test_scripts/script_reciprocity.py
+
+Author: Noah Stieler, 2023
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import dataset
+import out
+import reader
+from device0 import port_pairs
+from device0.imaging import VNA
+from gui.parameter import input_dict, InputItemBoolean, InputItemOptionMenu
+
+NUM_POINTS = 11
+PORTS = 4
+
+
+def check_validation() -> None:
+    # (reciprocity, reflection, s-parameters selected, accepted)
+    cases = [
+        ('Off', 'Per pair', ['S21'], True),
+        ('Upper (t<r)', 'Per pair', ['S21'], False),
+        ('Lower (t>r)', 'Per pair', ['S12'], False),
+        ('Upper (t<r)', 'Per pair', ['S21', 'S12'], True),
+        ('Upper (t<r)', 'Per pair', ['S21', 'S12', 'S11'], False),
+        ('Upper (t<r)', 'Per port', ['S21', 'S12', 'S11'], True),
+        ('Upper (t<r)', 'Per pair', ['S11', 'S21', 'S12', 'S22'], True)
+    ]
+    input_dict['port_mask'] = InputItemOptionMenu(None, 'Port mask', 'All')
+    for reciprocity, reflection, s_params, accepted in cases:
+        input_dict['reciprocity'] = InputItemOptionMenu(None, 'Reciprocity', reciprocity)
+        input_dict['reflection'] = InputItemOptionMenu(None, 'Reflection', reflection)
+        for s_param in VNA.s_params:
+            input_dict[s_param] = InputItemBoolean(None, s_param, int(s_param in s_params))
+        try:
+            port_pairs.from_input()
+            error = None
+        except ValueError as e:
+            error = e
+        assert (error is None) == accepted, f'{reciprocity} {reflection} {s_params}: {error}'
+        print(f'  {reciprocity:12s} {reflection:9s} {"+".join(s_params):16s} '
+              f'{"accepted" if accepted else "rejected: " + str(error)}')
+
+
+def check_reader() -> None:
+    """Writes the upper triangle of S21 and S12 and reads back the lower."""
+    rng = numpy.random.default_rng(0)
+    freqs = numpy.linspace(1e9, 2e9, NUM_POINTS).tolist()
+    directory = tempfile.mkdtemp()
+    out.asynchronous = False
+    out.init_root(directory, 'reciprocity')
+    out.mkdir_new_pos(True)
+
+    meta = {'posx': 0, 'posy': 0, 'reciprocity': 'upper', 'mirror_s_parameters': dataset.MIRROR_S_PARAMETERS}
+    values = {}
+    for s_parameter in ('S21', 'S12'):
+        out.out_file_init(s_parameter, dict(meta, s_parameter=s_parameter), freqs)
+    for tran, refl in port_pairs.reciprocal(port_pairs.dense(1, PORTS), 'upper'):
+        for s_parameter in ('S21', 'S12'):
+            value = rng.standard_normal(NUM_POINTS) + 1j * rng.standard_normal(NUM_POINTS)
+            out.out_file_data_write(s_parameter, port_pairs.pair_key(tran, refl),
+                                    value.real.tolist(), value.imag.tolist())
+            values[(s_parameter, tran - 1, refl - 1)] = value
+    for s_parameter in ('S21', 'S12'):
+        out.out_file_complete(s_parameter)
+    out.close()
+
+    run = reader.open_run(out.output['full_path'])
+    for (s_parameter, tran, refl), value in values.items():
+        assert numpy.array_equal(run[0, tran, refl, s_parameter], value)
+        mirror = dataset.MIRROR_S_PARAMETERS[s_parameter]
+        assert numpy.array_equal(run[0, refl, tran, mirror], value), f'{mirror} t{refl + 1}r{tran + 1} not derived'
+    block = run[0, :PORTS, :PORTS, ['S21', 'S12'], 0]
+    off_diagonal = ~numpy.eye(PORTS, dtype=bool)
+    assert numpy.isfinite(block[off_diagonal]).all(), 'NaN in the derived triangle'
+    run.close()
+    shutil.rmtree(directory)
+    print('  reader derives the skipped triangle')
+
+
+if __name__ == '__main__':
+    check_validation()
+    check_reader()
+    print('ok')
@@ -0,0 +1,72 @@
+"""
+Algae ~ Automated Target Positioning System
+Electromagnetic Imaging Lab, University of Manitoba
+
+Measures acquisition loop throughput against the simulated instruments.
+Runs without hardware, ex. on a plain Linux machine.
+
+Usage: python test_scripts/script_sim_throughput.py [num_points] [ifbw] [pairs]
+
+Author: Noah Stieler, 2023
+"""
+
+import os
+import sys
+import time
+
+os.environ.setdefault('ALGAE_SIM', '1')
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from gui.parameter import input_dict, InputItemNumber, InputItemBoolean
+from device0.imaging import VNA, Switches, create_vna, create_switches
+from device1.imaging import create_vna as create_vna_device1
+
+
+def set_parameters(num_points: int, ifbw: float) -> None:
+    """Fills input_dict as if the values were entered in the gui."""
+    input_dict['num_points'] = InputItemNumber(None, 'Number of points', num_points)
+    input_dict['ifbw'] = InputItemNumber(None, 'IF bandwidth (Hz)', ifbw)
+    input_dict['freq_start'] = InputItemNumber(None, 'Start frequency (Hz)', 1e9)
+    input_dict['freq_stop'] = InputItemNumber(None, 'Stop frequency (Hz)', 8e9)
+    input_dict['power'] = InputItemNumber(None, 'Power (dBm)', 0)
+    for s_param in VNA.s_params:
+        input_dict[s_param] = InputItemBoolean(None, s_param, 1)
+
+
+def device0_throughput(pairs: int) -> None:
+    vna = create_vna('GPIB0::16::INSTR')
+    switches = create_switches('GPIB0::15::INSTR')
+    vna.initialize()
+    switches.initialize()
+
+    time_start = time.perf_counter()
+    for i in range(pairs):
+        tran = i % Switches.PORT_MAX + 1
+        refl = (i + 1) % Switches.PORT_MAX + 1
+        switches.set_tran(tran)
+        switches.set_refl(refl)
+        vna.format_output(vna.fire())
+    elapsed = time.perf_counter() - time_start
+
+    print(f'device0: {pairs / elapsed:.2f} pairs/s, {vna.transfer_summary()}')
+
+
+def device1_throughput(positions: int) -> None:
+    vna = create_vna_device1('TCPIP0::Localhost::hislip0::INSTR')
+    vna.resource.timeout = 60 * 1000
+
+    time_start = time.perf_counter()
+    for i in range(positions):
+        vna.fire()
+    elapsed = time.perf_counter() - time_start
+
+    print(f'device1: {positions / elapsed:.2f} sweeps/s')
+
+
+if __name__ == '__main__':
+    args = [float(arg) for arg in sys.argv[1:]]
+    num_points, ifbw, pairs = (args + [1601, 10000, 48][len(args):])[:3]
+
+    set_parameters(int(num_points), ifbw)
+    device0_throughput(int(pairs))
+    device1_throughput(4)
@@ -0,0 +1,85 @@
+"""
+Algae ~ Automated Target Positioning System
+Electromagnetic Imaging Lab, University of Manitoba
+
+Compares reading a simulated device1 .s24p file with a naive line
+by line reader, touchstone.parse(), and the memory-mapped sidecar.
+
+Usage: python test_scripts/script_touchstone_benchmark.py [num_points]
+
+Author: Noah Stieler, 2023
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import touchstone
+
+PORTS = 24
+
+
+def write_file(path: str, num_points: int) -> None:
+    """Writes a 24 port RI file, four parameters per line like the VNA."""
+    rng = numpy.random.default_rng(0)
+    freqs = numpy.linspace(1e9, 8e9, num_points)
+    with open(path, 'w', encoding='utf-8') as file:
+        file.write('!Simulated\n# Hz S RI R 50\n')
+        for freq in freqs:
+            values = ['%.9e' % value for value in rng.standard_normal(2 * PORTS ** 2)]
+            lines = [' '.join(values[i:i + 8]) for i in range(0, len(values), 8)]
+            file.write('%.1f ' % freq + '\n'.join(lines) + '\n')
+
+
+def read_naive(path: str) -> tuple:
+    """Reads the file a line and a value at a time."""
+    freqs = []
+    values = []
+    row = []
+    with open(path, 'r', encoding='utf-8') as file:
+        for line in file:
+            line = line.split('!')[0].strip()
+            if not line or line.startswith('#'):
+                continue
+            for token in line.split():
+                row.append(float(token))
+            if len(row) == 1 + 2 * PORTS ** 2:
+                freqs.append(row[0])
+                values.append([complex(row[i], row[i + 1]) for i in range(1, len(row), 2)])
+                row = []
+    return numpy.array(freqs), numpy.array(values).reshape(-1, PORTS, PORTS)
+
+
+def run(name: str, function, size: int) -> numpy.ndarray:
+    time_start = time.perf_counter()
+    freqs, values = function()
+    # Touch every value, a memory-map is otherwise not read
+    total = numpy.sum(values)
+    elapsed = time.perf_counter() - time_start
+    print(f'  {name:24s} {elapsed:8.3f} s  {size / 1e6 / elapsed:8.1f} MB/s')
+    return total
+
+
+if __name__ == '__main__':
+    num_points = int(sys.argv[1]) if len(sys.argv) > 1 else 1601
+
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'output_0.s24p')
+    write_file(path, num_points)
+    size = os.path.getsize(path)
+    print(f'{num_points} points, {size / 1e6:.1f} MB')
+
+    totals = [
+        run('naive', lambda: read_naive(path), size),
+        run('parse', lambda: touchstone.read(path, cache=False), size),
+        run('parse, write sidecar', lambda: touchstone.read(path), size),
+        run('sidecar', lambda: touchstone.read(path), size)
+    ]
+    assert numpy.allclose(totals, totals[0])
+    shutil.rmtree(directory)
@@ -0,0 +1,137 @@
+"""
+Algae ~ Automated Target Positioning System
+Electromagnetic Imaging Lab, University of Manitoba
+
+Reads Touchstone v1 files, such as the .s24p files saved by device1.
+
+The whole file is tokenized by NumPy at once, continuation lines need
+no special handling as a frequency's values are read as one flat row.
+The option line sets the frequency unit and RI, MA or DB format.
+
+The parsed values are written to a binary sidecar next to the file,
+'<file>.npy', rows of the frequency in Hz followed by the real and
+imaginary parts of each parameter. Later reads memory-map the sidecar
+instead of parsing, it is written again if the file is newer. A sidecar
+without its file, as written by out.snp_write(), is read the same way.
+
+Author: Noah Stieler, 2023
+"""
+
+import os
+import os.path
+import re
+
+import numpy
+
+# Bytes searched for the option line
+_HEADER_SIZE = 1 << 16
+_FREQ_UNITS = {'HZ': 1.0, 'KHZ': 1e3, 'MHZ': 1e6, 'GHZ': 1e9}
+_COMMENT = re.compile(rb'![^\n]*')
+_OPTION = re.compile(rb'^[ \t]*#([^\n]*)', re.MULTILINE)
+_PORTS = re.compile(r'\.s(\d+)p$', re.IGNORECASE)
+
+
+def read(path: str, cache: bool = True) -> tuple:
+    """Returns the frequencies in Hz and the [freq, receive, drive] matrix of
+    complex parameters, ex. S21 is [:, 1, 0]. If cache is set the values are
+    memory-mapped from the sidecar, which is written first if needed. Without
+    cache no sidecar is written, one is only read if the file itself is missing."""
+    if cache:
+        rows = _read_sidecar(path)
+        if rows is None:
+            rows = parse(path)
+            if _write_sidecar(path, rows):
+                rows = _read_sidecar(path)
+    elif not os.path.isfile(path) and os.path.isfile(sidecar_path(path)):
+        rows = _read_sidecar(path)
+    else:
+        rows = parse(path)
+
+    port_count = port_count_of(path)
+    # The real and imaginary parts are adjacent, view them as complex without copying
+    values = rows[:, 1:].view(numpy.complex128).reshape(len(rows), port_count, port_count)
+    if port_count == 2:  # Two port files list S11, S21, S12, S22
+        values = values.transpose(0, 2, 1)
+    return rows[:, 0], values
+
+
+def parse(path: str) -> numpy.ndarray:
+    """Parses a file into rows of the frequency in Hz and the real and
+    imaginary parts of each parameter, in the order of the file."""
+    with open(path, 'rb') as file:
+        text = file.read()
+
+    # The option line comes before the data, only it is searched for
+    option = _OPTION.search(_COMMENT.sub(b'', text[:_HEADER_SIZE]))
+    if option is not None:
+        text = text[text.index(option.group(0)) + len(option.group(0)):]
+    option = option.group(1).decode().upper().split() if option is not None else []
+    if b'!' in text:
+        text = _COMMENT.sub(b'', text)
+
+    port_count = port_count_of(path)
+    width = 1 + 2 * port_count ** 2
+    values = numpy.fromstring(text.decode(), sep=' ')
+    if len(values) % width != 0:
+        raise ValueError(f'\'{path}\' has {len(values)} values, not a multiple of {width}.')
+    rows = values.reshape(-1, width)
+
+    # Touchstone defaults are GHz and MA
+    unit = next((_FREQ_UNITS[item] for item in option if item in _FREQ_UNITS), 1e9)
+    rows[:, 0] *= unit
+
+    a, b = rows[:, 1::2], rows[:, 2::2]
+    if 'RI' not in option:
+        magnitude = 10 ** (a / 20) if 'DB' in option else a
+        angle = numpy.radians(b)
+        rows[:, 1::2], rows[:, 2::2] = magnitude * numpy.cos(angle), magnitude * numpy.sin(angle)
+    return rows
+
+
+def write(file, rows: numpy.ndarray, port_count: int) -> None:
+    """Writes rows, laid out as parse() returns them, as a Touchstone v1 file
+    in Hz and RI format to the open text file. Each row of the matrix starts
+    a new line, of at most four parameters."""
+    pair = '%.9e %.9e'
+    if port_count == 2:
+        lines = [' '.join([pair] * 4)]
+    else:
+        lines = [' '.join([pair] * min(4, port_count - start))
+                 for row in range(port_count) for start in range(0, port_count, 4)]
+
+    file.write('# Hz S RI R 50\n')
+    numpy.savetxt(file, rows, fmt='%.6f ' + '\n'.join(lines))
+
+
+def port_count_of(path: str) -> int:
+    match = _PORTS.search(path)
+    if match is None:
+        raise ValueError(f'\'{path}\' is not a Touchstone .snp file.')
+    return int(match.group(1))
+
+
+def sidecar_path(path: str) -> str:
+    return path + '.npy'
+
+
+def _read_sidecar(path: str):
+    """Memory-maps the sidecar, None if there is none or it is older than the file."""
+    sidecar = sidecar_path(path)
+    if not os.path.isfile(sidecar):
+        return None
+    if os.path.isfile(path) and os.path.getmtime(sidecar) < os.path.getmtime(path):
+        return None
+    return numpy.load(sidecar, mmap_mode='r')
+
+
+def _write_sidecar(path: str, rows: numpy.ndarray) -> bool:
+    """Writes to a temporary file first, so an interrupted write leaves
+    no sidecar. Returns False if it could not be written."""
+    sidecar = sidecar_path(path)
+    try:
+        with open(sidecar + '.tmp', 'wb') as file:
+            numpy.save(file, rows)
+        os.replace(sidecar + '.tmp', sidecar)
+    except OSError:  # Read only, the file is parsed again next time
+        return False
+    return True
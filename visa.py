@@ -7,21 +7,68 @@ Contains the base class for all VISA resources.
 Author: Noah Stieler, 2023
 """
 
+import json
+import math
+import os
+import re
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import numpy
 import pyvisa as visa
 
+import sim
+
+# Values queried from instruments that only change with hardware or firmware,
+# stored per address along with the identity of the instrument they came from.
+CACHE_PATH = os.path.join(os.path.expanduser('~'), '.algae', 'instrument_cache.json')
+
+# Commands that return the instrument to its default state
+_PRESET_COMMANDS = ('*RST', 'SYSTEM:PRESET', 'SYSTEM:FPRESET')
+
+_NUMBER = re.compile(r'[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?')
+
+# Per command timing, see instrumentation_enable()
+TIMING_FILE_NAME = 'visa_timing.json'
+_TIMING_WINDOW = 1000  # Most recent calls kept per command for percentiles
+_timing = {}
+_timing_lock = threading.Lock()
+
 
 class VisaResource:
     manager: visa.ResourceManager = None
+    sim_manager: sim.SimResourceManager = None
 
-    def __init__(self, address: str):
-        if VisaResource.manager is None:
-            VisaResource.manager = visa.ResourceManager()
+    # Longest message sent when batching writes, kept well under instrument input buffers
+    max_message_length = 1024
+
+    # Read settings back from the instrument before skipping a write in set(),
+    # catches changes made from the front panel at the cost of a query
+    shadow_verify = False
+
+    # Wait for operations to complete with a service request instead of *OPC?,
+    # which leaves the session free while the instrument is busy
+    use_srq = False
+
+    # Set by instrumentation_enable(), checked before timing any call
+    instrumented = False
 
+    def __init__(self, address: str):
         self.address = address
         self.resource = None
 
+        # Writes queued by batch(), None when not batching
+        self._batch = None
+        self._identity = None
+
+        # Settings last applied by set(), cleared by presets
+        self.shadow = {}
+        self._srq_enabled = False
+
         try:
-            self.resource = VisaResource.manager.open_resource(address)
+            self.resource = VisaResource.get_manager(address).open_resource(address)
         except visa.VisaIOError:
             pass
 
@@ -37,8 +84,386 @@ class VisaResource:
         except visa.errors.InvalidSession:
             pass
 
+    @staticmethod
+    def get_manager(address: str = ''):
+        """Returns the simulated resource manager if simulation is
+        enabled for the address, otherwise the pyvisa manager."""
+        if sim.enabled(address):
+            if VisaResource.sim_manager is None:
+                VisaResource.sim_manager = sim.SimResourceManager()
+            return VisaResource.sim_manager
+
+        if VisaResource.manager is None:
+            VisaResource.manager = visa.ResourceManager()
+        return VisaResource.manager
+
+    @contextmanager
+    def batch(self):
+        """Writes inside the context are queued and sent as semicolon
+        joined messages, which saves a bus transaction per command.
+        Queries flush the queue first so commands stay in order."""
+        if self._batch is not None:  # Already batching
+            yield
+            return
+
+        self._batch = []
+        try:
+            yield
+        finally:
+            self.flush()
+            self._batch = None
+
+    def flush(self) -> None:
+        """Sends any queued writes."""
+        if not self._batch:
+            return
+
+        message = VisaResource._join(self._batch)
+        self._batch.clear()
+        self._write_raw(message)
+
+    def start_operation(self, cmd: str) -> 'Operation':
+        """Sends cmd and returns a handle that reports when the instrument
+        has finished it, without blocking the caller."""
+        if not self.use_srq:
+            self.write(cmd)
+            return Operation(self, cmd, threaded=True)
+
+        if not self._srq_enabled:
+            # Operation complete sets bit 0 of the event status register,
+            # which is summarized by bit 5 of the status byte to request service
+            self.write('*ESE 1')
+            self.write('*SRE 32')
+            self.resource.enable_event(visa.constants.EventType.service_request,
+                                       visa.constants.EventMechanism.queue)
+            self._srq_enabled = True
+
+        self.resource.discard_events(visa.constants.EventType.service_request,
+                                     visa.constants.EventMechanism.queue)
+        with self.batch():
+            self.write('*CLS')
+            self.write(cmd)
+            self.write('*OPC')
+        return Operation(self, cmd, threaded=False)
+
+    def set(self, header: str, value, key: str = None) -> bool:
+        """Writes 'header value' unless the value is the one last applied.
+        key identifies the setting in the shadow if the header alone does not,
+        ex. a measurement definition. Returns true if the write was sent."""
+        value = str(value)
+        if key is None:
+            key = header
+
+        if self.shadow.get(key) == value:
+            # Settings identified by a custom key can not be queried with header?
+            if not self.shadow_verify or key != header:
+                return False
+            if VisaResource._same_value(self.query(header + '?'), value):
+                return False
+
+        self.write(header + ' ' + value)
+        self.shadow[key] = value
+        return True
+
     def write(self, cmd: str) -> None:
-        self.resource.write(cmd)
+        if cmd.upper() in _PRESET_COMMANDS:
+            self.shadow.clear()
+
+        if self._batch is None:
+            self._write_raw(cmd)
+            return
+
+        if self._batch and len(VisaResource._join(self._batch + [cmd])) > self.max_message_length:
+            self.flush()
+        self._batch.append(cmd)
 
     def query(self, cmd: str) -> str:
-        return self.resource.query(cmd)
+        self.flush()
+        if not VisaResource.instrumented:
+            return self.resource.query(cmd)
+
+        time_start = time.perf_counter()
+        response = self.resource.query(cmd)
+        record(_mnemonic(cmd), time.perf_counter() - time_start, len(cmd) + len(response))
+        return response
+
+    def query_binary(self, cmd: str, buffer: numpy.ndarray) -> int:
+        """Queries an IEEE 488.2 definite-length block of little endian
+        64-bit floats and reads it straight into the preallocated buffer.
+        Raises MissingDataException if the response is not such a block
+        or does not hold len(buffer) values. Returns the number of bytes received."""
+        self.flush()
+        time_start = time.perf_counter()
+        self.resource.write(cmd)
+
+        # Block header is '#', one digit for the digit count, the digits, then the data
+        header = self.resource.read_bytes(2)
+        if header[:1] != b'#' or not header[1:2].isdigit() or header[1:2] == b'0':
+            # Not a definite-length block, ex. an error string or ASCII data
+            if not header.endswith(b'\n'):
+                self.resource.read_raw()  # Discarded up to the terminator
+            raise MissingDataException(0, len(buffer))
+        digits = int(header[1:2])
+        data_bytes = int(self.resource.read_bytes(digits))
+        if data_bytes != buffer.nbytes:
+            self.resource.read_bytes(data_bytes + 1)  # Discarded with the terminator
+            raise MissingDataException(data_bytes // buffer.itemsize, len(buffer))
+        buffer[:] = numpy.frombuffer(self.resource.read_bytes(data_bytes), dtype='<f8')
+        self.resource.read_bytes(1)  # Terminating newline
+        byte_count = 2 + digits + data_bytes + 1
+
+        if VisaResource.instrumented:
+            record(_mnemonic(cmd), time.perf_counter() - time_start, len(cmd) + byte_count)
+        return byte_count
+
+    def _write_raw(self, message: str) -> None:
+        if not VisaResource.instrumented:
+            self.resource.write(message)
+            return
+
+        time_start = time.perf_counter()
+        self.resource.write(message)
+        record(_mnemonic(message), time.perf_counter() - time_start, len(message))
+
+    def identity(self) -> str:
+        """Returns the *IDN? and *OPT? responses, which identify the
+        instrument's model, serial number, firmware and options."""
+        if self._identity is None:
+            self._identity = self.query('*IDN?').strip() + ';' + self.query('*OPT?').strip()
+        return self._identity
+
+    def cache_load(self, key: str):
+        """Returns the value cached for this instrument, or None if there is none.
+        Entries stored by a different instrument at this address are ignored."""
+        entry = _cache_read().get(self.address)
+        if entry is None or entry.get('identity') != self.identity():
+            return None
+        return entry.get(key)
+
+    def cache_store(self, key: str, value) -> None:
+        """Caches a JSON serializable value for this instrument. Replaces the
+        address' entry if the instrument's identity has changed."""
+        cache = _cache_read()
+        entry = cache.get(self.address)
+        if entry is None or entry.get('identity') != self.identity():
+            entry = {'identity': self.identity()}
+            cache[self.address] = entry
+        entry[key] = value
+
+        try:
+            os.makedirs(os.path.dirname(CACHE_PATH), exist_ok=True)
+            with open(CACHE_PATH + '.tmp', 'w', encoding='utf-8') as file:
+                json.dump(cache, file, indent='\t')
+            os.replace(CACHE_PATH + '.tmp', CACHE_PATH)
+        except OSError:  # Caching is only an optimization
+            pass
+
+    @staticmethod
+    def _same_value(actual: str, expected: str) -> bool:
+        """Compares a queried setting to the value that was written.
+        Numbers are compared by value ignoring units, and the instrument may
+        answer with the short form of a mnemonic, ex. LIN for LINEAR."""
+        aliases = {'ON': '1', 'OFF': '0'}
+        actual = actual.strip().strip('\'"').upper()
+        expected = expected.strip().upper()
+        actual = aliases.get(actual, actual)
+        expected = aliases.get(expected, expected)
+
+        match_actual = _NUMBER.match(actual)
+        match_expected = _NUMBER.match(expected)
+        if match_actual is not None and match_expected is not None:
+            return math.isclose(float(match_actual.group()), float(match_expected.group()),
+                                rel_tol=1e-9)
+
+        return expected.startswith(actual) and actual != ''
+
+    @staticmethod
+    def _join(commands: list) -> str:
+        """Joins commands into one SCPI message. Each command after the first
+        is prefixed with a colon so it is parsed from the root of the command tree."""
+        message = commands[0]
+        for cmd in commands[1:]:
+            if cmd.startswith(('*', ':')):
+                message += ';' + cmd
+            else:
+                message += ';:' + cmd
+        return message
+
+
+class Operation:
+    """Handle to an operation started by VisaResource.start_operation(),
+    ex. a sweep. done() polls without blocking and wait() blocks until
+    completion, raising any error from the instrument session.
+
+    With service requests the session is free to use while waiting,
+    otherwise *OPC? is queried on a separate thread and the session must
+    not be used until the operation is done."""
+
+    def __init__(self, resource: VisaResource, cmd: str, threaded: bool):
+        self.resource = resource
+        self.cmd = cmd
+        self.time_started = time.perf_counter()
+        self.time_done = None
+
+        self._error = None
+        self._thread = None
+        if threaded:
+            self._thread = threading.Thread(target=self._query_opc, daemon=True)
+            self._thread.start()
+
+    def done(self) -> bool:
+        if self.time_done is not None:
+            return True
+
+        if self._thread is not None:
+            if self._thread.is_alive():
+                return False
+            self._thread.join()
+        elif not self._wait_srq(0):
+            return False
+
+        self._complete()
+        return True
+
+    def wait(self) -> None:
+        """Blocks until the operation is complete, limited by the resource timeout."""
+        if self.time_done is None:
+            if self._thread is not None:
+                self._thread.join()
+            elif not self._wait_srq(self.resource.resource.timeout):
+                raise visa.VisaIOError(visa.constants.StatusCode.error_timeout)
+            self._complete()
+
+        if self._error is not None:
+            raise self._error
+
+    @property
+    def duration(self) -> float:
+        """Seconds from start to completion, or so far if not done."""
+        end = self.time_done if self.time_done is not None else time.perf_counter()
+        return end - self.time_started
+
+    def _complete(self) -> None:
+        self.time_done = time.perf_counter()
+        if VisaResource.instrumented:
+            record(_mnemonic(self.cmd) + ' (operation)', self.duration)
+
+    def _query_opc(self) -> None:
+        try:
+            self.resource.query('*OPC?')
+        except Exception as e:  # Raised by wait() on the calling thread
+            self._error = e
+
+    def _wait_srq(self, timeout: int) -> bool:
+        """Waits up to timeout milliseconds for the service request.
+        Returns false if it has not arrived."""
+        try:
+            self.resource.resource.wait_on_event(visa.constants.EventType.service_request, timeout)
+        except visa.VisaIOError as e:
+            if e.error_code == visa.constants.StatusCode.error_timeout:
+                return False
+            raise
+
+        # Reading the status byte clears the request
+        self.resource.resource.read_stb()
+        return True
+
+
+class MissingDataException(Exception):
+    """Raised when the parsed vna data does not match two floats per frequency"""
+
+    def __init__(self, actual_num_count: int, expected_num_count: int):
+        self.actual_num_count = actual_num_count
+        self.expected_num_count = expected_num_count
+
+    def get_message(self) -> str:
+        msg = f'MissingDataException:\n\texpected {self.expected_num_count} floating point numbers' \
+              f'\n\treceived from vna {self.actual_num_count} floating point numbers'
+        return msg
+
+
+def instrumentation_enable(enabled: bool) -> None:
+    """Turns timing of every VISA call on or off. Timing is off by default."""
+    VisaResource.instrumented = enabled
+
+
+def instrumentation_reset() -> None:
+    with _timing_lock:
+        _timing.clear()
+
+
+def record(name: str, duration: float, byte_count: int = 0) -> None:
+    """Records the duration and bytes transferred of one call. Also used
+    for host side stages, ex. parsing, so they appear in the same summary."""
+    with _timing_lock:
+        stats = _timing.get(name)
+        if stats is None:
+            stats = {
+                'count': 0,
+                'total_time': 0.0,
+                'bytes': 0,
+                'max_time': 0.0,
+                'histogram': {},  # Count of calls per power of two microseconds
+                'recent': deque(maxlen=_TIMING_WINDOW)
+            }
+            _timing[name] = stats
+
+        stats['count'] += 1
+        stats['total_time'] += duration
+        stats['bytes'] += byte_count
+        stats['max_time'] = max(stats['max_time'], duration)
+        stats['recent'].append(duration)
+
+        bucket = '<' + str(2 ** int(duration * 1e6).bit_length()) + 'us'
+        stats['histogram'][bucket] = stats['histogram'].get(bucket, 0) + 1
+
+
+def instrumentation_summary() -> dict:
+    """Returns the timing statistics of each command, slowest total first."""
+    summary = {}
+    with _timing_lock:
+        items = sorted(_timing.items(), key=lambda item: item[1]['total_time'], reverse=True)
+        for name, stats in items:
+            recent = sorted(stats['recent'])
+            summary[name] = {
+                'count': stats['count'],
+                'total_time': stats['total_time'],
+                'mean_time': stats['total_time'] / stats['count'],
+                'max_time': stats['max_time'],
+                'p50_time': recent[len(recent) // 2],
+                'p90_time': recent[int(0.9 * (len(recent) - 1))],
+                'p99_time': recent[int(0.99 * (len(recent) - 1))],
+                'bytes': stats['bytes'],
+                'bytes_per_second': stats['bytes'] / stats['total_time'] if stats['total_time'] > 0 else 0,
+                'histogram': dict(sorted(stats['histogram'].items(), key=lambda item: int(item[0][1:-2])))
+            }
+    return summary
+
+
+def instrumentation_dump(directory: str) -> None:
+    """Writes the timing summary to the directory, ex. the output root of a scan."""
+    if not VisaResource.instrumented or not os.path.isdir(directory):
+        return
+
+    with open(os.path.join(directory, TIMING_FILE_NAME), 'w', encoding='utf-8') as file:
+        json.dump(instrumentation_summary(), file, indent='\t')
+
+
+def _mnemonic(message: str) -> str:
+    """Returns the command header used to group timings,
+    port numbers of switch commands are replaced with XX.
+    A batch is timed as one write, grouped under each of its
+    headers in order, ex. 'BATCH:SENSE1:FREQ:START;SENSE1:FREQ:STOP'."""
+    headers = [re.sub(r'_\d+$', '_XX', cmd.strip().split(' ')[0].upper())
+               for cmd in message.split(';') if cmd.strip() != '']
+    if len(headers) > 1:
+        return 'BATCH:' + ';'.join(headers)
+    return headers[0] if headers else ''
+
+
+def _cache_read() -> dict:
+    try:
+        with open(CACHE_PATH, 'r', encoding='utf-8') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}